@@ -13,8 +13,15 @@ from langchain_core.messages import HumanMessage
 from agent_schema import AgentState
 from langgraph.checkpoint.mongodb import MongoDBSaver
 from pymongo import MongoClient
+from write_behind import write_behind, BufferedCollection
+from checkpoint_cache import CachedCheckpointSaver, mongo_latest_id
+from tracing import traced_node, TracedCheckpointSaver
+from generation import node_params
 import os
-from langchain_core.prompts import ChatPromptTemplate 
+import logging
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+logger = logging.getLogger(__name__)
 
 MONGO_URI=os.getenv("MONGO_URI",)
 client = MongoClient(MONGO_URI)
@@ -24,6 +31,54 @@ collection = db["Checkpoints"]
 
 graph = StateGraph(AgentState)
 
+# Mark each Anthropic request's history as a prompt-cache breakpoint (see with_cache_breakpoint)
+ANTHROPIC_PROMPT_CACHE = os.getenv("ANTHROPIC_PROMPT_CACHE", "true").lower() == "true"
+
+# Built once. The fixed system message leads and the history follows as separate messages,
+# so each turn's request starts with the previous one's and the providers' prefix caches apply.
+SHORT_ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Make sure you answer user in small answer and not big"),
+    MessagesPlaceholder("messages"),
+])
+
+
+def with_document_context(state: AgentState, messages: list) -> list:
+    """Prepend this turn's retrieved document excerpts to the latest user message, for the call only"""
+    context = state.get("document_context")
+    if not context or not messages or getattr(messages[-1], "type", None) != "human":
+        return messages
+    question = messages[-1].content
+    return messages[:-1] + [HumanMessage(content=(
+        f"Relevant excerpts from documents attached to this chat:\n\n{context}\n\n"
+        f"Use these excerpts when they help; if they don't cover the question, say so.\n\n"
+        f"{question}"
+    ))]
+
+
+def with_cache_breakpoint(messages: list) -> list:
+    """Mark the end of the history before this turn's message for Anthropic's prompt cache, for the call only
+
+    That history is sent unchanged next turn, which then reads it from the
+    cache. This turn's message isn't marked: it carries the turn's document
+    excerpts, which aren't resent. Prefixes under the model's minimum
+    cacheable length are simply not cached.
+    """
+    if len(messages) < 2:
+        return messages
+    index = len(messages) - 2
+    content = messages[index].content
+    if isinstance(content, str):
+        if not content.strip():
+            return messages
+        blocks = [{"type": "text", "text": content}]
+    else:
+        blocks = list(content)
+    if not blocks or not isinstance(blocks[-1], dict):
+        return messages
+    blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+    # Copy rather than mutate: the originals belong to the (cached) checkpoint state
+    return messages[:index] + [messages[index].model_copy(update={"content": blocks})] + messages[index + 1:]
+
 
 def classify_model(state: AgentState):
     selected = list(state["selected_models"].keys())
@@ -33,77 +88,57 @@ def classify_model(state: AgentState):
 
 
 def OpenAI(state: AgentState) -> AgentState:
-    print("OpenAI called ...")
-    openai_messages = state["openai_messages"]
+    openai_messages = with_document_context(state, state["openai_messages"])
     openai_model_name = state["selected_models"]["OpenAI"]
-    print(openai_model_name)
+    logger.debug("OpenAI node using %s", openai_model_name, extra={"event": "node_called"})
     if openai_model_name in ['openai/gpt-oss-120b','openai/gpt-oss-20b']:
-        response = llm_ChatGroq(openai_model_name).invoke(openai_messages)
+        response = llm_ChatGroq(openai_model_name, params=node_params(state, "OpenAI")).invoke(openai_messages)
     else:
-        response = llm_ChatOpenAI(openai_model_name).invoke(openai_messages)
+        response = llm_ChatOpenAI(openai_model_name, params=node_params(state, "OpenAI")).invoke(openai_messages)
     return {"openai_messages": response}
 
 
 def Google(state: AgentState) -> AgentState:
-    print("Google called ...")
-    system_prompt="""Make sure you answer user in small answer and not big"""
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("user", "{input}")
-    ])
-    
-    google_messages = state["google_messages"]
+    google_messages = with_document_context(state, state["google_messages"])
     google_model_name = state["selected_models"]["Google"]
-    print(google_model_name)
-    chain = prompt | llm_ChatGoogleGenerativeAI(google_model_name)
-    response = chain.invoke(google_messages)
-    print("Gemini")
-    print(response)
+    logger.debug("Google node using %s", google_model_name, extra={"event": "node_called"})
+    chain = SHORT_ANSWER_PROMPT | llm_ChatGoogleGenerativeAI(google_model_name, params=node_params(state, "Google"))
+    response = chain.invoke({"messages": google_messages})
+    logger.debug("Google response", extra={"event": "node_response", "node": "Google", "content": response.content})
     return {"google_messages": response}
 
 def Groq(state: AgentState) -> AgentState:
-    print("Groq called..")
-    system_prompt="""Make sure you answer user in small answer and not big"""
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("user", "{input}")
-    ])
-    groq_messages = state["groq_messages"]
+    groq_messages = with_document_context(state, state["groq_messages"])
     groq_model_name = state["selected_models"]["Groq"]
-    print(groq_model_name)
-    chain = prompt | llm_ChatGroq(groq_model_name)
-    response = chain.invoke(groq_messages)
+    logger.debug("Groq node using %s", groq_model_name, extra={"event": "node_called"})
+    chain = SHORT_ANSWER_PROMPT | llm_ChatGroq(groq_model_name, params=node_params(state, "Groq"))
+    response = chain.invoke({"messages": groq_messages})
     # print(response)
     return {"groq_messages": response}
 
 def Meta(state:AgentState)->AgentState:
-    print("Meta called...")
-    meta_messages = state["meta_messages"]
+    meta_messages = with_document_context(state, state["meta_messages"])
     meta_model_name = state["selected_models"]["Meta"]
-    print(meta_model_name)
-    response = llm_ChatGroq(meta_model_name).invoke(meta_messages)
+    logger.debug("Meta node using %s", meta_model_name, extra={"event": "node_called"})
+    response = llm_ChatGroq(meta_model_name, params=node_params(state, "Meta")).invoke(meta_messages)
     return {"meta_messages":response}
 
 def Deepseek(state:AgentState)->AgentState:
-    print("DeepSeek called...")
-    deepseek_messages = state["deepseek_messages"]
+    deepseek_messages = with_document_context(state, state["deepseek_messages"])
     deepseek_model_name = state["selected_models"]["Deepseek"]
-    print(deepseek_model_name)
+    logger.debug("Deepseek node using %s", deepseek_model_name, extra={"event": "node_called"})
     if deepseek_model_name in ['deepseek-r1-distill-llama-70b']:
-        response = llm_ChatGroq(deepseek_model_name).invoke(deepseek_messages)
+        response = llm_ChatGroq(deepseek_model_name, params=node_params(state, "Deepseek")).invoke(deepseek_messages)
     else:
-        response = llm_ChatDeepseek(deepseek_model_name).invoke(deepseek_messages)
+        response = llm_ChatDeepseek(deepseek_model_name, params=node_params(state, "Deepseek")).invoke(deepseek_messages)
     return {"deepseek_messages":response}
 
-def Perplexity(state:AgentState)->AgentState:
-    print("Perplexity called...")
-    perplexity_messages = state["perplexity_messages"]
-    perplexity_model_name = state["selected_models"]["Perplexity"]
-    print(perplexity_model_name)
+def normalize_perplexity_messages(messages: list) -> list:
+    """Reshape a message list into the strict role alternation the Perplexity API requires"""
     # Perplexity API requires strict alternation of roles after optional system msgs.
     # 1) Keep only system/human/ai messages
     allowed = ("system", "human", "ai")
-    filtered = [m for m in perplexity_messages if getattr(m, "type", None) in allowed]
+    filtered = [m for m in messages if getattr(m, "type", None) in allowed]
 
     # 2) Merge consecutive messages of the same role
     merged = []
@@ -114,8 +149,8 @@ def Perplexity(state:AgentState)->AgentState:
             if msg.type == "human":
                 merged[-1] = HumanMessage(content=new_content)
             else:
-                # For system/ai, LangChain will coerce via content field on same class
-                merged[-1].content = new_content
+                # Copy rather than mutate: the originals belong to the (cached) checkpoint state
+                merged[-1] = prev.model_copy(update={"content": new_content})
         else:
             merged.append(msg)
 
@@ -144,45 +179,63 @@ def Perplexity(state:AgentState)->AgentState:
             # skip messages that break alternation
             pass
         idx += 1
+    return normalized_msgs
 
-    response = llm_ChatPerplexity(perplexity_model_name).invoke(normalized_msgs)
+def Perplexity(state:AgentState)->AgentState:
+    perplexity_messages = with_document_context(state, state["perplexity_messages"])
+    perplexity_model_name = state["selected_models"]["Perplexity"]
+    logger.debug("Perplexity node using %s", perplexity_model_name, extra={"event": "node_called"})
+    normalized_msgs = normalize_perplexity_messages(perplexity_messages)
+    response = llm_ChatPerplexity(perplexity_model_name, params=node_params(state, "Perplexity")).invoke(normalized_msgs)
     return {"perplexity_messages": response}
 
 def Anthropic(state: AgentState) -> AgentState:
-    print("Anthropic called...")
     # system_prompt="""Make sure you answer user in small answer and not big"""
     # prompt = ChatPromptTemplate.from_messages([
     #     ("system", system_prompt),
     #     ("user", "{input}")
     # ])
     
-    anthropic_messages = state["anthropic_messages"]
+    anthropic_messages = with_document_context(state, state["anthropic_messages"])
+    if ANTHROPIC_PROMPT_CACHE:
+        anthropic_messages = with_cache_breakpoint(anthropic_messages)
     anthropic_model_name = state["selected_models"]["Anthropic"]
-    print(anthropic_model_name)
+    logger.debug("Anthropic node using %s", anthropic_model_name, extra={"event": "node_called"})
     # chain = prompt| llm_ChatAnthropic(anthropic_model_name)
-    response = llm_ChatAnthropic(anthropic_model_name).invoke(anthropic_messages)
-    print(response)
+    response = llm_ChatAnthropic(anthropic_model_name, params=node_params(state, "Anthropic")).invoke(anthropic_messages)
+    logger.debug("Anthropic response", extra={"event": "node_response", "node": "Anthropic", "content": response.content})
     return {"anthropic_messages": response}
 
 
 def Alibaba(state:AgentState)->AgentState:
-    print("Alibaba called...")
-    alibaba_messages = state["alibaba_messages"]
+    alibaba_messages = with_document_context(state, state["alibaba_messages"])
     alibaba_model_name = state["selected_models"]["Alibaba"]
-    print(alibaba_model_name)
-    response = llm_ChatGroq(alibaba_model_name).invoke(alibaba_messages)
+    logger.debug("Alibaba node using %s", alibaba_model_name, extra={"event": "node_called"})
+    response = llm_ChatGroq(alibaba_model_name, params=node_params(state, "Alibaba")).invoke(alibaba_messages)
     return{"alibaba_messages":response}
 
+# Node functions by selected_models key, for running a model outside the graph (no checkpoint), e.g. batch evaluation
+MODEL_NODES = {
+    "OpenAI": OpenAI,
+    "Google": Google,
+    "Groq": Groq,
+    "Meta": Meta,
+    "Deepseek": Deepseek,
+    "Alibaba": Alibaba,
+    "Anthropic": Anthropic,
+    "Perplexity": Perplexity,
+}
+
 graph.add_node("classify_model", classify_model)
 
-graph.add_node("OpenAI", OpenAI)
-graph.add_node("Google", Google)
-graph.add_node("Groq", Groq)
-graph.add_node("Meta", Meta)
-graph.add_node("Deepseek", Deepseek)
-graph.add_node("Alibaba", Alibaba)
-graph.add_node("Anthropic", Anthropic)
-graph.add_node("Perplexity", Perplexity)
+graph.add_node("OpenAI", traced_node("OpenAI", OpenAI))
+graph.add_node("Google", traced_node("Google", Google))
+graph.add_node("Groq", traced_node("Groq", Groq))
+graph.add_node("Meta", traced_node("Meta", Meta))
+graph.add_node("Deepseek", traced_node("Deepseek", Deepseek))
+graph.add_node("Alibaba", traced_node("Alibaba", Alibaba))
+graph.add_node("Anthropic", traced_node("Anthropic", Anthropic))
+graph.add_node("Perplexity", traced_node("Perplexity", Perplexity))
 
 
 
@@ -212,6 +265,21 @@ graph.add_edge("Alibaba", END)
 graph.add_edge("Perplexity", END)
 
 checkpointer = MongoDBSaver(collection)
+if write_behind.enabled:
+    # Checkpoint upserts are queued and bulk-flushed off the request path;
+    # reads through these collections flush the thread's queued writes first, so history stays consistent.
+    checkpointer.checkpoint_collection = BufferedCollection(checkpointer.checkpoint_collection, write_behind)
+    checkpointer.writes_collection = BufferedCollection(checkpointer.writes_collection, write_behind)
+# A thread's newest checkpoint id, without loading the checkpoint; flushes that thread's queued writes first
+latest_checkpoint_id = mongo_latest_id(checkpointer.checkpoint_collection)
+if os.getenv("CHECKPOINT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"):
+    # Serve recently active threads' latest state from memory instead of Mongo. Unless turned off
+    # (single worker only), each hit is checked against the newest checkpoint id in Mongo first.
+    verify = os.getenv("CHECKPOINT_CACHE_VERIFY", "true").lower() in ("1", "true", "yes")
+    checkpointer = CachedCheckpointSaver(
+        checkpointer, latest_id=latest_checkpoint_id if verify else None)
+# Outermost, so spans show what each request actually waited for
+checkpointer = TracedCheckpointSaver(checkpointer)
 workflow = graph.compile(checkpointer=checkpointer)
 
 # config1 = {"configurable": {"thread_id": "111121a11111"}}
@@ -1,5 +1,5 @@
 
-from typing import TypedDict, List, Optional,Annotated,Dict
+from typing import TypedDict, List, Optional,Annotated,Dict,Any
 from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
@@ -14,3 +14,5 @@ class AgentState(TypedDict, total=False):
     perplexity_messages:Annotated[list[BaseMessage],add_messages]
     anthropic_messages:Annotated[list[BaseMessage],add_messages]
     selected_models: Dict[str,str]
+    document_context: Optional[str]  # retrieved excerpts for the current turn only
+    generation: Optional[Dict[str, Dict[str, Any]]]  # this turn's generation params per model (see generation.py)
@@ -1,16 +1,26 @@
 import os
+import re
 import time
+import random
 import logging
-from typing import Dict, List, Optional, Any
+from typing import Collection, Dict, List, Optional, Any
 from dataclasses import dataclass, field
 from enum import Enum
 from datetime import datetime, timedelta
 import json
 from dotenv import load_dotenv
+from cancellation import current_scope
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# "latency" prefers the fastest healthy key; "round_robin" keeps the original first-available order
+KEY_ROUTING = os.getenv("KEY_ROUTING", "latency").lower()
+ROUTING_EWMA_ALPHA = float(os.getenv("ROUTING_EWMA_ALPHA", "0.2"))
+ROUTING_ERROR_PENALTY = float(os.getenv("ROUTING_ERROR_PENALTY", "4"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "3"))
+ROUTING_TOLERANCE = float(os.getenv("ROUTING_TOLERANCE", "1.25"))
+ROUTING_EXPLORE = float(os.getenv("ROUTING_EXPLORE", "0.05"))
+
 class ProviderType(Enum):
     OPENAI = "openai"
     GOOGLE = "google"
@@ -28,6 +38,108 @@ class RateLimitInfo:
     tokens_per_minute: Optional[int] = None
     tokens_per_day: Optional[int] = None
 
+@dataclass
+class LatencyStats:
+    """Exponentially weighted call latency and error rate for a key or a (provider, model) backend"""
+    latency: Optional[float] = None  # seconds, successful calls only
+    error_rate: float = 0.0
+    samples: int = 0
+
+    def update(self, seconds: float, success: bool):
+        self.samples += 1
+        self.error_rate += ROUTING_EWMA_ALPHA * ((0.0 if success else 1.0) - self.error_rate)
+        if success:
+            self.latency = seconds if self.latency is None else self.latency + ROUTING_EWMA_ALPHA * (seconds - self.latency)
+
+    def score(self, prior: Optional[float] = None) -> float:
+        """Expected cost of the next call: latency inflated by recent errors (lower is better)"""
+        latency = self.latency if self.latency is not None else prior or 0.0
+        return latency * (1 + ROUTING_ERROR_PENALTY * self.error_rate) + self.error_rate
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "latency_ms_ewma": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate_ewma": round(self.error_rate, 4),
+            "samples": self.samples,
+        }
+
+# (remaining, reset) header names, formatted with "requests" or "tokens"
+RATE_LIMIT_HEADERS = (
+    ("x-ratelimit-remaining-{}", "x-ratelimit-reset-{}"),  # OpenAI, Groq, DeepSeek, Perplexity
+    ("anthropic-ratelimit-{}-remaining", "anthropic-ratelimit-{}-reset"),
+)
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: Optional[str], now: float) -> Optional[float]:
+    """Epoch time from a reset header: a duration ("6m0s", "20ms", "1.5"), or an RFC 3339 timestamp (Anthropic)"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return now + float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        return now + sum(float(n) * DURATION_SECONDS[u] for n, u in parts)
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def header_int(headers, name: str) -> Optional[int]:
+    try:
+        return int(float(headers[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@dataclass
+class LearnedLimits:
+    """A key's remaining budget as its provider last reported it in response headers"""
+    requests_remaining: Optional[int] = None
+    requests_reset: Optional[float] = None  # epoch seconds
+    tokens_remaining: Optional[int] = None
+    tokens_reset: Optional[float] = None
+    retry_until: Optional[float] = None  # from Retry-After on a 429
+    updated: float = 0.0
+
+    def exhausted_until(self, now: float) -> Optional[float]:
+        """When the key can be used again, or None if it has budget now"""
+        waits = [self.retry_until or 0.0]
+        if self.requests_remaining is not None and self.requests_remaining <= 0:
+            waits.append(self.requests_reset or 0.0)
+        if self.tokens_remaining is not None and self.tokens_remaining <= 0:
+            waits.append(self.tokens_reset or 0.0)
+        until = max(waits)
+        return until if until > now else None
+
+    def reserve(self) -> bool:
+        # Count a call as soon as the key is handed out; the next response's headers correct it
+        if self.requests_remaining is not None and (self.requests_reset or 0) > time.time():
+            self.requests_remaining -= 1
+            return True
+        return False
+
+    def unreserve(self):
+        if self.requests_remaining is not None:
+            self.requests_remaining += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        iso = lambda t: datetime.fromtimestamp(t).isoformat() if t else None
+        return {
+            "requests_remaining": self.requests_remaining,
+            "requests_reset": iso(self.requests_reset),
+            "tokens_remaining": self.tokens_remaining,
+            "tokens_reset": iso(self.tokens_reset),
+            "retry_until": iso(self.retry_until),
+            "updated": iso(self.updated),
+        }
+
+
 @dataclass
 class KeyUsage:
     """Track usage for a specific API key"""
@@ -38,6 +150,8 @@ class KeyUsage:
     consecutive_errors: int = 0
     is_blocked: bool = False
     block_until: Optional[float] = None
+    stats: LatencyStats = field(default_factory=LatencyStats)
+    learned: Optional[LearnedLimits] = None  # None until a response carried rate-limit headers
     
     def add_request(self, tokens: int = 0):
         """Add a request to usage tracking"""
@@ -67,6 +181,10 @@ class KeyUsage:
         """Check if this key is currently rate limited"""
         if self.is_blocked and self.block_until and time.time() < self.block_until:
             return True
+
+        # The provider's own numbers replace the static table once we have them
+        if self.learned is not None:
+            return self.learned.exhausted_until(time.time()) is not None
             
         # Check request limits
         if self.get_requests_in_window(60) >= rate_limits.requests_per_minute:
@@ -109,12 +227,17 @@ class APIKeyManager:
         self.key_usage: Dict[str, KeyUsage] = {}
         self.rate_limits = self._get_rate_limits()
         self.current_key_index: Dict[ProviderType, int] = {}
+        self.backend_stats: Dict[tuple, LatencyStats] = {}  # (provider, model) -> stats
+        self.routing = KEY_ROUTING
         
         # Load API keys from environment
         self._load_api_keys()
     
     def _get_rate_limits(self) -> Dict[ProviderType, RateLimitInfo]:
-        """Define rate limits for each provider"""
+        """Static rate limits per provider, the fallback for a key until its responses report its real budget
+
+        See record_headers. Gemini sends no rate-limit headers, so Google keys stay on this table.
+        """
         return {
             ProviderType.OPENAI: RateLimitInfo(
                 requests_per_minute=3500,
@@ -228,8 +351,8 @@ class APIKeyManager:
         
         logger.info(f"Loaded API keys: {[(p.value, len(keys)) for p, keys in self.provider_keys.items()]}")
     
-    def get_available_key(self, provider: ProviderType) -> Optional[tuple]:
-        """Get an available API key for the provider"""
+    def get_available_key(self, provider: ProviderType, exclude: Collection[str] = ()) -> Optional[tuple]:
+        """Get an available API key for the provider, skipping the key ids in ``exclude``"""
         if provider not in self.provider_keys:
             logger.error(f"No API keys configured for {provider.value}")
             return None
@@ -237,22 +360,121 @@ class APIKeyManager:
         keys = self.provider_keys[provider]
         rate_limits = self.rate_limits[provider]
         
+        if self.routing == "latency":
+            picked = self._fastest_key(provider, exclude)
+            if picked:
+                self._reserve(picked[1])
+            return picked
+
         # Try to find a non-rate-limited key starting from current index
         for i in range(len(keys)):
             key_index = (self.current_key_index[provider] + i) % len(keys)
             key_id = f"{provider.value}_{key_index + 1}"
             
-            if key_id in self.key_usage:
+            if key_id in self.key_usage and key_id not in exclude:
                 usage = self.key_usage[key_id]
                 if not usage.is_rate_limited(rate_limits):
                     # Update current key index for round-robin
                     self.current_key_index[provider] = key_index
+                    self._reserve(key_id)
                     return keys[key_index], key_id
         
         # All keys are rate limited
         logger.warning(f"All API keys for {provider.value} are rate limited")
         return None
     
+    def _fastest_key(self, provider: ProviderType, exclude: Collection[str]) -> Optional[tuple]:
+        """A random pick among the healthy keys scoring within ROUTING_TOLERANCE of the best
+
+        Spreading over the near-best keys keeps the single fastest one from
+        being driven into its rate limit. A ROUTING_EXPLORE share of picks go
+        to any healthy key, so a slow key's numbers get refreshed and its
+        recovery is noticed. Keys with fewer than ROUTING_MIN_SAMPLES calls
+        are tried first, in round-robin order.
+        """
+        keys = self.provider_keys[provider]
+        rate_limits = self.rate_limits[provider]
+        start = self.current_key_index[provider]
+        candidates = []
+        for i in range(len(keys)):
+            key_index = (start + i) % len(keys)
+            key_id = f"{provider.value}_{key_index + 1}"
+            usage = self.key_usage.get(key_id)
+            if usage is None or key_id in exclude or usage.is_rate_limited(rate_limits):
+                continue
+            if usage.stats.samples < ROUTING_MIN_SAMPLES:
+                # Warm up new keys in round-robin order before trusting their numbers
+                self.current_key_index[provider] = (key_index + 1) % len(keys)
+                return keys[key_index], key_id
+            candidates.append((key_index, key_id, usage))
+        if not candidates:
+            logger.warning(f"All API keys for {provider.value} are rate limited")
+            return None
+        if random.random() < ROUTING_EXPLORE:
+            key_index, key_id, _ = random.choice(candidates)
+            return keys[key_index], key_id
+        prior = self.provider_latency(provider)
+        scores = [(c[2].stats.score(prior), c) for c in candidates]
+        best = min(score for score, _ in scores)
+        key_index, key_id, _ = random.choice([c for score, c in scores if score <= best * ROUTING_TOLERANCE])
+        return keys[key_index], key_id
+
+    def _reserve(self, key_id: str):
+        """Count the call against the key's learned budget until its response reports the real numbers"""
+        learned = self.key_usage[key_id].learned
+        if learned is None or not learned.reserve():
+            return
+        scope = current_scope.get()
+        if scope is not None:
+            # Handed back if the client disconnects before this call is sent
+            scope.reserved(key_id, learned.unreserve)
+
+    def provider_latency(self, provider: ProviderType) -> Optional[float]:
+        """Mean EWMA latency across the provider's models, used for keys with no successful calls yet"""
+        latencies = [s.latency for (p, _), s in list(self.backend_stats.items()) if p is provider and s.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def record_latency(self, provider: ProviderType, key_id: str, model: str, seconds: float, success: bool):
+        """Feed one call's outcome into the key's and the (provider, model)'s moving averages"""
+        usage = self.key_usage.get(key_id)
+        if usage is not None:
+            usage.stats.update(seconds, success)
+        stats = self.backend_stats.get((provider, model))
+        if stats is None:
+            stats = self.backend_stats.setdefault((provider, model), LatencyStats())
+        stats.update(seconds, success)
+
+    def record_headers(self, provider: ProviderType, key_id: str, headers, status: int):
+        """Take a key's remaining budget from a response's rate-limit headers
+
+        Reads the OpenAI-style x-ratelimit-{remaining,reset}-{requests,tokens}
+        headers (OpenAI, Groq, DeepSeek, Perplexity), Anthropic's
+        anthropic-ratelimit-* headers and Retry-After. Responses without any
+        of them leave the key on the static table.
+        """
+        usage = self.key_usage.get(key_id)
+        if usage is None:
+            return
+        now = time.time()
+        learned = LearnedLimits(updated=now)
+        found = False
+        for remaining_name, reset_name in RATE_LIMIT_HEADERS:
+            for kind in ("requests", "tokens"):
+                remaining = header_int(headers, remaining_name.format(kind))
+                if remaining is None:
+                    continue
+                setattr(learned, f"{kind}_remaining", remaining)
+                setattr(learned, f"{kind}_reset", parse_reset(headers.get(reset_name.format(kind)), now))
+                found = True
+        if status == 429:
+            if not found and usage.learned is not None:
+                # A bare 429 keeps what we knew about the rest of the budget
+                learned = LearnedLimits(**{**usage.learned.__dict__, "updated": now})
+            learned.retry_until = parse_reset(headers.get("retry-after"), now) or now + 1
+            found = True
+        if found:
+            usage.learned = learned
+
     def record_request(self, provider: ProviderType, key_id: str, tokens: int = 0, success: bool = True):
         """Record a request for tracking"""
         if key_id in self.key_usage:
@@ -281,6 +503,9 @@ class APIKeyManager:
                 
                 if usage.is_blocked and usage.block_until:
                     next_time = datetime.fromtimestamp(usage.block_until)
+                elif usage.learned is not None:
+                    until = usage.learned.exhausted_until(time.time())
+                    next_time = datetime.fromtimestamp(until) if until else datetime.now()
                 else:
                     # Calculate when rate limits will reset
                     current_time = time.time()
@@ -321,6 +546,9 @@ class APIKeyManager:
                     "tokens_last_minute": usage.get_tokens_in_window(60),
                     "tokens_last_day": usage.get_tokens_in_window(86400),
                     "consecutive_errors": usage.consecutive_errors,
+                    **usage.stats.as_dict(),
+                    "limits_source": "headers" if usage.learned is not None else "static",
+                    "learned_limits": usage.learned.as_dict() if usage.learned is not None else None,
                     "block_until": datetime.fromtimestamp(usage.block_until).isoformat() if usage.block_until else None
                 })
         
@@ -338,6 +566,8 @@ class APIKeyManager:
                 "tokens_per_day": rate_limits.tokens_per_day
             },
             "keys": key_statuses,
+            "routing": self.routing,
+            "backends": {model: stats.as_dict() for (p, model), stats in list(self.backend_stats.items()) if p is provider},
             "next_available": self.get_next_available_time(provider).isoformat() if self.get_next_available_time(provider) else None
         }
     
@@ -0,0 +1,404 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import HumanMessage
+
+from agent import MODEL_NODES
+from metrics import is_rate_limit_error, observe_queue, registry
+from scheduler import scheduler, SchedulerRejected, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+CHAT_BATCH_MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", "32"))
+CHAT_BATCH_MAX_ATTEMPTS = int(os.getenv("CHAT_BATCH_MAX_ATTEMPTS", "4"))
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "50000"))
+CHAT_BATCH_ADMISSION_WAIT_SECONDS = float(os.getenv("CHAT_BATCH_ADMISSION_WAIT_SECONDS", "60"))
+# meta.json progress is rewritten after this many finished items or seconds, whichever comes first
+CHAT_BATCH_META_EVERY_ITEMS = int(os.getenv("CHAT_BATCH_META_EVERY_ITEMS", "50"))
+CHAT_BATCH_META_EVERY_SECONDS = float(os.getenv("CHAT_BATCH_META_EVERY_SECONDS", "2"))
+
+BATCH_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+ACTIVE = ("queued", "running")
+
+router = APIRouter()
+
+
+def parse_items(body: bytes, default_models: Optional[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """Validate a JSONL upload: one {"id"?, "user_query"|"prompt", "selected_models"?} object per line"""
+    items, seen = [], set()
+    for number, line in enumerate(body.decode("utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Line {number} is not valid JSON")
+        query = row.get("user_query") or row.get("prompt") if isinstance(row, dict) else None
+        models = row.get("selected_models") or default_models if isinstance(row, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            raise HTTPException(status_code=400, detail=f"Line {number} needs a user_query")
+        if not isinstance(models, dict) or not models:
+            raise HTTPException(status_code=400, detail=f"Line {number} needs selected_models (or pass a default)")
+        unknown = [name for name in models if name not in MODEL_NODES]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Line {number}: unknown models {unknown}")
+        item_id = str(row.get("id", number))
+        if item_id in seen:
+            raise HTTPException(status_code=400, detail=f"Line {number}: duplicate id {item_id}")
+        seen.add(item_id)
+        items.append({"id": item_id, "user_query": query, "selected_models": models})
+    if not items:
+        raise HTTPException(status_code=400, detail="No prompts in upload")
+    if len(items) > CHAT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {CHAT_BATCH_MAX_ITEMS} prompts per batch")
+    return items
+
+
+def reply_tokens(message) -> int:
+    return ((getattr(message, "usage_metadata", None) or {}).get("total_tokens")) or 0
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Provider 429s and exhausted key pools clear up with time; anything else won't"""
+    return is_rate_limit_error(error) or str(error).startswith("No available")
+
+
+class BatchRunner:
+    """Offline /chat evaluation jobs kept on disk
+
+    Each batch is a directory with ``input.jsonl``, ``meta.json`` and an
+    append-only ``output.jsonl``. Items run through the model nodes directly
+    (no graph, so nothing is checkpointed) at batch priority in the scheduler.
+    A batch resumes by skipping ids already in its output: on startup for
+    batches that were running, or on request. A flock on ``lock`` keeps two
+    processes from running the same batch. File work runs on worker threads;
+    progress in meta.json is written every few items or seconds, while the
+    output file is always current.
+    """
+
+    def __init__(self):
+        self.dir = os.getenv("CHAT_BATCH_DIR") or os.path.join(tempfile.gettempdir(), "allai-chat-batches")
+        os.makedirs(self.dir, exist_ok=True)
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.cancelled: set = set()
+        self.live: Dict[str, Dict[str, Any]] = {}  # batch_id -> up-to-date meta of batches running here
+        self._pool: Optional[ThreadPoolExecutor] = None
+        # Set by the app: checks a submitted account_id and returns the account to charge.
+        # Unset, every batch shares one "batch" account whatever it claims.
+        self.resolve_account: Optional[Callable[[Optional[str]], str]] = None
+
+    def path(self, batch_id: str, name: str = "") -> str:
+        if not BATCH_ID_RE.match(batch_id):
+            raise HTTPException(status_code=400, detail="Invalid batch id")
+        return os.path.join(self.dir, batch_id, name)
+
+    def read_meta(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path(batch_id, "meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, meta: Dict[str, Any]):
+        meta["updated_at"] = time.time()
+        path = self.path(meta["batch_id"], "meta.json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def create(self, items: List[Dict[str, Any]], account_id: str, concurrency: int, batch_id: Optional[str] = None) -> Dict[str, Any]:
+        batch_id = batch_id or uuid.uuid4().hex
+        os.makedirs(self.path(batch_id))
+        with open(self.path(batch_id, "input.jsonl"), "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+        meta = {
+            "batch_id": batch_id, "status": "queued", "account_id": account_id, "concurrency": concurrency,
+            "total": len(items), "done": 0, "failed": 0, "created_at": time.time(),
+        }
+        self.write_meta(meta)
+        return meta
+
+    def read_items(self, batch_id: str, skip: set) -> List[Dict[str, Any]]:
+        with open(self.path(batch_id, "input.jsonl"), "r", encoding="utf-8") as f:
+            return [item for item in map(json.loads, f) if item["id"] not in skip]
+
+    def completed(self, batch_id: str) -> Dict[str, bool]:
+        """id -> succeeded, from the output file; a torn last line from a crash is cut off"""
+        path = self.path(batch_id, "output.jsonl")
+        results: Dict[str, bool] = {}
+        if not os.path.exists(path):
+            return results
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            results[row["id"]] = not row.get("errors")
+        return results
+
+    def start(self, batch_id: str, retry_failed: bool = False) -> bool:
+        """Run (or resume) a batch in this process; False if it's already running somewhere"""
+        task = self.tasks.get(batch_id)
+        if task is not None and not task.done():
+            return False
+        self.cancelled.discard(batch_id)
+        self.tasks[batch_id] = asyncio.create_task(self.run(batch_id, retry_failed))
+        return True
+
+    def resume_interrupted(self):
+        """Restart batches a previous process left queued or running"""
+        for batch_id in sorted(os.listdir(self.dir)):
+            meta = BATCH_ID_RE.match(batch_id) and self.read_meta(batch_id)
+            if meta and meta["status"] in ACTIVE:
+                self.start(batch_id)
+
+    async def stop(self):
+        # Leaves status as running, so the next startup picks the batches up again
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def cancel(self, batch_id: str) -> bool:
+        task = self.tasks.get(batch_id)
+        if task is None or task.done():
+            return False
+        self.cancelled.add(batch_id)
+        return True
+
+    async def run(self, batch_id: str, retry_failed: bool):
+        lock = open(self.path(batch_id, "lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            logger.info("Batch %s is running in another process", batch_id)
+            return
+        try:
+            await self._run_locked(batch_id, retry_failed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Batch %s failed", batch_id)
+            meta = await asyncio.to_thread(self.read_meta, batch_id) or {"batch_id": batch_id}
+            meta.update(status="failed", error=str(e))
+            await asyncio.to_thread(self.write_meta, meta)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    async def _run_locked(self, batch_id: str, retry_failed: bool):
+        meta = await asyncio.to_thread(self.read_meta, batch_id)
+        completed = await asyncio.to_thread(self.completed, batch_id)
+        skip = {i for i, ok in completed.items() if ok or not retry_failed}
+        pending = await asyncio.to_thread(self.read_items, batch_id, skip)
+        meta.update(status="running", done=len(skip), failed=sum(1 for i in skip if not completed[i]))
+        meta.pop("error", None)
+        await asyncio.to_thread(self.write_meta, dict(meta))
+        logger.info("Batch %s: %d of %d items to run", batch_id, len(pending), meta["total"])
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=CHAT_BATCH_MAX_CONCURRENCY * 8, thread_name_prefix="chat-batch")
+        semaphore = asyncio.Semaphore(meta["concurrency"])
+        # One writer at a time: whole output lines, and meta.json's temp file isn't shared
+        write_lock = asyncio.Lock()
+        saved = {"done": meta["done"], "at": time.monotonic()}
+        self.live[batch_id] = meta
+
+        def append(out, line: str):
+            out.write(line)
+            out.flush()
+
+        out = await asyncio.to_thread(open, self.path(batch_id, "output.jsonl"), "a", encoding="utf-8")
+        try:
+            async def one(item):
+                async with semaphore:
+                    if batch_id in self.cancelled:
+                        return
+                    row = await self.run_item(meta["account_id"], item)
+                    async with write_lock:
+                        await asyncio.to_thread(append, out, json.dumps(row) + "\n")
+                        meta["done"] += 1
+                        meta["failed"] += 1 if row["errors"] else 0
+                        if (meta["done"] - saved["done"] >= CHAT_BATCH_META_EVERY_ITEMS
+                                or time.monotonic() - saved["at"] >= CHAT_BATCH_META_EVERY_SECONDS):
+                            saved.update(done=meta["done"], at=time.monotonic())
+                            await asyncio.to_thread(self.write_meta, dict(meta))
+            await asyncio.gather(*(one(item) for item in pending))
+        finally:
+            self.live.pop(batch_id, None)
+            await asyncio.to_thread(out.close)
+        meta["status"] = "cancelled" if batch_id in self.cancelled else "completed"
+        self.cancelled.discard(batch_id)
+        await asyncio.to_thread(self.write_meta, meta)
+
+    async def admit(self, account_id: str, query: str, calls: int):
+        """A batch-priority scheduler ticket for ``calls`` model calls; batch work waits its turn rather than failing"""
+        while True:
+            try:
+                return await scheduler.acquire_async(account_id, "batch", calls, estimate_tokens(len(query), calls),
+                                                     max_wait=CHAT_BATCH_ADMISSION_WAIT_SECONDS)
+            except SchedulerRejected as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def run_item(self, account_id: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        """Every model's answer to one item, retrying rate limits with backoff"""
+        loop = asyncio.get_running_loop()
+        models = item["selected_models"]
+        started = time.perf_counter()
+        results: Dict[str, Dict[str, Any]] = {}
+        todo = dict(models)
+        for attempt in range(CHAT_BATCH_MAX_ATTEMPTS):
+            ticket = await self.admit(account_id, item["user_query"], len(todo))
+            try:
+                calls = [loop.run_in_executor(self._pool, self.call_model, name, model, item["user_query"], started)
+                         for name, model in todo.items()]
+                attempts = dict(zip(todo, await asyncio.gather(*calls)))
+            finally:
+                scheduler.release(ticket)
+            ticket.settle(sum(r.get("tokens", 0) for r in attempts.values()))
+            results.update(attempts)
+            todo = {name: model for name, model in todo.items() if attempts[name].pop("retryable", False)}
+            if not todo or attempt + 1 == CHAT_BATCH_MAX_ATTEMPTS:
+                break
+            # Backs off without a ticket, so a rate-limited item holds no batch capacity meanwhile
+            await asyncio.sleep(min(30.0, 2 ** attempt))
+        return {
+            "id": item["id"],
+            "selected_models": models,
+            "responses": {name: r["content"] for name, r in results.items() if "content" in r},
+            "errors": {name: r["error"] for name, r in results.items() if "error" in r},
+            "tokens": {name: r.get("tokens", 0) for name, r in results.items()},
+            "latency_ms": {name: r["latency_ms"] for name, r in results.items()},
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    @staticmethod
+    def call_model(name: str, model: str, query: str, started: float) -> Dict[str, Any]:
+        """One attempt at a model's answer via its graph node; ``retryable`` marks an error worth another try"""
+        key = f"{name.lower()}_messages"
+        try:
+            reply = MODEL_NODES[name]({"selected_models": {name: model}, key: [HumanMessage(content=query)]})[key]
+            return {"content": reply.content, "tokens": reply_tokens(reply),
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+        except Exception as e:
+            return {"error": str(e)[:500], "retryable": is_retryable(e),
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    def active_counts(self):
+        running = [batch_id for batch_id, task in self.tasks.items() if not task.done()]
+        pending = 0
+        for batch_id in running:
+            meta = self.live.get(batch_id) or self.read_meta(batch_id) or {}
+            pending += meta.get("total", 0) - meta.get("done", 0)
+        return [("running_batches", len(running)), ("pending_items", pending)]
+
+
+@router.post("/chat/batch", status_code=202)
+async def submit_batch(request: Request, account_id: Optional[str] = None, concurrency: int = CHAT_BATCH_CONCURRENCY,
+                       selected_models: Optional[str] = None, batch_id: Optional[str] = None):
+    """Start a batch from a JSONL body; resubmitting an existing batch_id resumes it instead"""
+    if batch_id and batch_runner.read_meta(batch_id):
+        started = batch_runner.start(batch_id)
+        return {**batch_runner.read_meta(batch_id), "resumed": started}
+    try:
+        default_models = json.loads(selected_models) if selected_models else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="selected_models must be a JSON object")
+    items = parse_items(await request.body(), default_models)
+    concurrency = max(1, min(concurrency, CHAT_BATCH_MAX_CONCURRENCY))
+    account = "batch"
+    if batch_runner.resolve_account is not None:
+        account = await asyncio.to_thread(batch_runner.resolve_account, account_id)
+    meta = await asyncio.to_thread(batch_runner.create, items, account, concurrency, batch_id)
+    batch_runner.start(meta["batch_id"])
+    return meta
+
+
+@router.get("/chat/batch/{batch_id}")
+def get_batch(batch_id: str):
+    # Batches running here have fresher progress in memory than in meta.json
+    live = batch_runner.live.get(batch_id)
+    meta = dict(live) if live is not None else batch_runner.read_meta(batch_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return meta
+
+
+@router.get("/chat/batch/{batch_id}/results")
+async def get_batch_results(batch_id: str, follow: bool = False):
+    """Result lines as NDJSON; with follow, keeps streaming until the batch stops"""
+    path = batch_runner.path(batch_id, "output.jsonl")
+    if batch_runner.read_meta(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    def read_from(position: int) -> bytes:
+        if not os.path.exists(path):
+            return b""
+        with open(path, "rb") as f:
+            f.seek(position)
+            return f.read()
+
+    async def lines():
+        position = 0
+        while True:
+            # Status before the read: output is complete once a batch stops, so a final read after that misses nothing
+            meta = batch_runner.live.get(batch_id) or await asyncio.to_thread(batch_runner.read_meta, batch_id) or {}
+            last = not follow or meta.get("status") not in ACTIVE
+            chunk = await asyncio.to_thread(read_from, position)
+            # Only whole lines; a half-written one is picked up next round
+            end = chunk.rfind(b"\n") + 1
+            if end:
+                position += end
+                yield chunk[:end]
+            if last:
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.post("/chat/batch/{batch_id}/cancel")
+def cancel_batch(batch_id: str):
+    if batch_runner.read_meta(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return {"cancelling": batch_runner.cancel(batch_id)}
+
+
+@router.post("/chat/batch/{batch_id}/resume")
+async def resume_batch(batch_id: str, retry_failed: bool = False):
+    """Run the items not yet in the output (and, with retry_failed, the ones that errored)"""
+    if batch_runner.read_meta(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return {"resumed": batch_runner.start(batch_id, retry_failed)}
+
+
+def _collect_metrics():
+    observe_queue("chat_batches", batch_runner.active_counts())
+
+
+# Global instance
+batch_runner = BatchRunner()
+registry.register_collector(_collect_metrics)
@@ -0,0 +1,204 @@
+"""Microbenchmarks for the pure-Python code that runs on every request.
+
+Times each case with timeit (best and median of --repeat runs) and stores the
+results per commit so runs can be compared:
+
+    python benchmarks/bench_hot_paths.py --save                  # -> benchmarks/results/<commit>.json
+    python benchmarks/bench_hot_paths.py --compare benchmarks/results/abc1234.json
+    python benchmarks/bench_hot_paths.py --compare old.json new.json --filter email
+
+With one --compare file the current tree is measured and compared against it.
+Importing agent/server connects to MONGO_URI, as the app does at startup.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND, "benchmarks", "results")
+
+# Keys for the managers built below; set before anything imports api_key_manager
+for _i in range(1, 11):
+    os.environ.setdefault(f"OPENAI_API_KEY_{_i}", f"bench-openai-{_i}")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage  # noqa: E402
+
+from api_key_manager import APIKeyManager, KeyUsage, ProviderType  # noqa: E402
+
+
+def usage_with_history(key_id: str, requests: int, tokens_per_request: int = 100) -> KeyUsage:
+    """A key with ``requests`` calls spread evenly over the last 24 hours"""
+    now = time.time()
+    step = 86400 / requests
+    usage = KeyUsage(key_id=key_id)
+    usage.requests_count = [now - 86400 + (i + 1) * step for i in range(requests)]
+    usage.tokens_used = [(t, tokens_per_request) for t in usage.requests_count]
+    return usage
+
+
+def manager_with_history(requests: int, exhausted: int) -> APIKeyManager:
+    """Ten OpenAI keys with large histories; the first ``exhausted`` are over their hourly limit"""
+    manager = APIKeyManager()
+    limits = manager.rate_limits[ProviderType.OPENAI]
+    for i in range(10):
+        key_id = f"openai_{i + 1}"
+        usage = usage_with_history(key_id, requests)
+        if i < exhausted:
+            now = time.time()
+            usage.requests_count += [now - 1800 + j * 0.01 for j in range(limits.requests_per_hour)]
+        manager.key_usage[key_id] = usage
+    manager.current_key_index[ProviderType.OPENAI] = 0
+    return manager
+
+
+def first_pick(manager: APIKeyManager):
+    """get_available_key from the first key, so the exhausted ones are scanned every time"""
+    manager.current_key_index[ProviderType.OPENAI] = 0
+    return manager.get_available_key(ProviderType.OPENAI)
+
+
+def conversation(turns: int, chars: int = 400):
+    messages = [SystemMessage(content="You are a helpful assistant.")]
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"question {i} " + "q" * chars))
+        messages.append(AIMessage(content=f"answer {i} " + "a" * chars * 2))
+    return messages
+
+
+def perplexity_input(turns: int):
+    """History as the graph holds it: alternation broken by repeated user turns and doc context"""
+    messages = conversation(turns)
+    messages.insert(1, AIMessage(content="stray assistant greeting"))
+    for i in range(3, len(messages), 7):
+        messages.insert(i, HumanMessage(content="follow-up " + "f" * 200))
+    return messages
+
+
+def state_history(turns: int, channels=("openai_messages", "google_messages", "anthropic_messages")):
+    """What workflow.get_state_history() yields for a session: one snapshot per step, newest first"""
+    steps = []
+    for turn in range(turns):
+        for _ in range(2):  # the input step and the step after the model nodes
+            steps.append(SimpleNamespace(values={
+                channel: conversation(turn + 1)[1:] for channel in channels
+            } | {"selected_models": {"OpenAI": "gpt-4o"}}))
+    return list(reversed(steps))
+
+
+def cases():
+    """name -> zero-argument callable; inputs are built once, outside the timed region"""
+    import agent
+    import server
+    from llm_wrapper import LLMWrapper
+
+    limits = APIKeyManager().rate_limits[ProviderType.OPENAI]
+    usage_1k = usage_with_history("k1", 1_000)
+    usage_50k = usage_with_history("k50", 50_000)
+    manager_free = manager_with_history(5_000, exhausted=0)
+    manager_busy = manager_with_history(5_000, exhausted=9)
+    wrapper = LLMWrapper()
+    models = ["gpt-4o", "gemini-2.0-flash", "llama-3.3-70b-versatile", "claude-3-5-sonnet-latest",
+              "deepseek-chat", "sonar-pro", "qwen/qwen3-32b", "openai/gpt-oss-20b"]
+    chat = conversation(20)
+    pplx = perplexity_input(20)
+    history = state_history(15)
+
+    return {
+        "key_usage.is_rate_limited[1k]": lambda: usage_1k.is_rate_limited(limits),
+        "key_usage.is_rate_limited[50k]": lambda: usage_50k.is_rate_limited(limits),
+        "key_manager.get_available_key[10x5k,free]": lambda: manager_free.get_available_key(ProviderType.OPENAI),
+        "key_manager.get_available_key[10x5k,9 exhausted]": lambda: first_pick(manager_busy),
+        "llm_wrapper.get_provider_from_model[8]": lambda: [wrapper._get_provider_from_model(m) for m in models],
+        "llm_wrapper.estimate_tokens[41 msgs]": lambda: wrapper._estimate_tokens(chat),
+        "agent.normalize_perplexity_messages[~50 msgs]": lambda: agent.normalize_perplexity_messages(pplx),
+        "server.serialize_history[15 turns x 3 models]": lambda: server.serialize_history(history),
+        "server.is_valid_email": lambda: server.is_valid_email("Some.User+tag@example.co.uk"),
+    }
+
+
+def measure(fn, repeat: int) -> dict:
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    runs = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"best_us": round(min(runs) * 1e6, 3), "median_us": round(statistics.median(runs) * 1e6, 3), "loops": number}
+
+
+def git_commit() -> tuple:
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BACKEND, text=True).strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def run(repeat: int, pattern: str) -> dict:
+    sha, dirty = git_commit()
+    results = {}
+    for name, fn in cases().items():
+        if pattern and not re.search(pattern, name):
+            continue
+        results[name] = measure(fn, repeat)
+        print(f"{name:<52}{results[name]['best_us']:>12.2f} us  (median {results[name]['median_us']:.2f})")
+    return {
+        "commit": sha,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict):
+    old_label = old["commit"] + ("+" if old.get("dirty") else "")
+    new_label = new["commit"] + ("+" if new.get("dirty") else "")
+    print(f"\n{'case':<52}{old_label:>12}{new_label:>12}{'change':>10}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print(f"{name:<52}{'-':>12}{result['best_us']:>12.2f}{'new':>10}")
+            continue
+        change = (result["best_us"] - before["best_us"]) / before["best_us"] * 100
+        print(f"{name:<52}{before['best_us']:>12.2f}{result['best_us']:>12.2f}{change:>+9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="regex on case names")
+    parser.add_argument("--save", nargs="?", const="", default=None, help="write results (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT_JSON", help="baseline file, optionally followed by a second result file")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    result = run(args.repeat, args.filter)
+    if args.save is not None:
+        path = args.save or os.path.join(RESULTS_DIR, f"{result['commit']}{'-dirty' if result['dirty'] else ''}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {path}")
+    if args.compare:
+        with open(args.compare[0]) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Vision payload size and encode time: raw upload vs. prepare_image().
+
+Walks a directory of local sample images (default: the frontend assets) and,
+optionally, synthetic phone-sized photos, and reports the data-URL bytes sent
+to the vision model and the time spent producing them.
+
+    python benchmarks/bench_image_prepare.py [--dir PATH] [--synthetic 3]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import preprocess  # noqa: E402
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DIR = os.path.join(BACKEND, "..", "frontend", "src", "assets")
+EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+
+def synthetic_photo(width: int, height: int, seed: int) -> bytes:
+    """Noisy gradient JPEG, roughly as incompressible as a real camera photo"""
+    from PIL import Image
+    noise = Image.effect_noise((width, height), 40 + seed).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    out = io.BytesIO()
+    Image.blend(noise, gradient, 0.5).save(out, "JPEG", quality=92)
+    return out.getvalue()
+
+
+def corpus(args):
+    for root, _, files in os.walk(args.dir):
+        for name in sorted(files):
+            if name.lower().endswith(EXTENSIONS):
+                with open(os.path.join(root, name), "rb") as f:
+                    yield name, f.read()
+    for i in range(args.synthetic):
+        yield f"synthetic-{i}-4032x3024.jpg", synthetic_photo(4032, 3024, i)
+
+
+def timed(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main(args):
+    if preprocess.Image is None:
+        print("Pillow is not installed: prepare_image() passes images through unchanged")
+    print(f"{'image':<34} {'raw url KB':>10} {'raw ms':>7} {'prep url KB':>11} {'prep ms':>8} {'mime':>11}  saved")
+    totals = [0, 0, 0.0, 0.0]
+    for name, data in corpus(args):
+        raw_url, raw_t = timed(lambda: preprocess.image_data_url(data, "image/jpeg"), args.repeat)
+
+        def prepared():
+            out, mime = preprocess.prepare_image(data)
+            return preprocess.image_data_url(out, mime), mime
+        (prep_url, mime), prep_t = timed(prepared, args.repeat)
+
+        totals[0] += len(raw_url)
+        totals[1] += len(prep_url)
+        totals[2] += raw_t
+        totals[3] += prep_t
+        saved = 1 - len(prep_url) / len(raw_url)
+        print(f"{name[:34]:<34} {len(raw_url) / 1024:>10.1f} {raw_t * 1000:>7.2f} "
+              f"{len(prep_url) / 1024:>11.1f} {prep_t * 1000:>8.2f} {mime:>11}  {saved:>5.0%}")
+    if totals[0]:
+        print(f"{'TOTAL':<34} {totals[0] / 1024:>10.1f} {totals[2] * 1000:>7.2f} "
+              f"{totals[1] / 1024:>11.1f} {totals[3] * 1000:>8.2f} {'':>11}  {1 - totals[1] / totals[0]:>5.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=DEFAULT_DIR)
+    parser.add_argument("--synthetic", type=int, default=2, help="number of 12MP synthetic photos to add")
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
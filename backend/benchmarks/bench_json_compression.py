@@ -0,0 +1,101 @@
+"""Response encoding cost for large payloads: serialization time and bytes on the wire.
+
+Builds a synthetic /history payload (steps x models x reply size) and a
+/session/{account_id} document, then times FastAPI's default path
+(jsonable_encoder + json.dumps) against FastJSONResponse, and each available
+compression codec on the result.
+
+    python benchmarks/bench_json_compression.py [--steps 30] [--models 4] [--chars 2000] [--sessions 500]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import http_encoding  # noqa: E402
+
+WORDS = ("the model answered with a detailed explanation of market prices recent events statistics code "
+         "examples function returns value error handling latency tokens session history document").split()
+
+
+def text(rng: random.Random, chars: int) -> str:
+    words = []
+    size = 0
+    while size < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def synthetic_history(steps: int, models: int, chars: int, seed: int = 0):
+    """What serialize_history returns for a session of ``steps`` checkpoint steps"""
+    rng = random.Random(seed)
+    names = ["openai_messages", "google_messages", "groq_messages", "anthropic_messages",
+             "deepseek_messages", "perplexity_messages", "meta_messages", "alibaba_messages"][:models]
+    replies = {name: [] for name in names}
+    history = []
+    for _ in range(steps):
+        for name in names:
+            replies[name] = replies[name] + [{"role": "User", "content": text(rng, 120)},
+                                             {"role": "AI", "content": text(rng, chars)}]
+        history.append({name: list(msgs) for name, msgs in replies.items()})
+    return {"history": history}
+
+
+def synthetic_account(sessions: int):
+    start = datetime(2025, 1, 1, 12, 0, 0, 123000)
+    return {"account_id": "bench@example.com", "sessions": [
+        {"session_id": f"{i:08x}-0000-4000-8000-000000000000", "session_name": f"Chat about topic {i}",
+         "time_stamp": start + timedelta(minutes=i), "last_activity": start + timedelta(minutes=i, seconds=30),
+         "status": "active"}
+        for i in range(sessions)
+    ]}
+
+
+def timed(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def report(name: str, payload, repeat: int):
+    default_body, default_t = timed(lambda: JSONResponse(http_encoding.jsonable_encoder(payload)).body, repeat)
+    fast_body, fast_t = timed(lambda: http_encoding.FastJSONResponse(payload).body, repeat)
+    print(f"\n{name}: {len(default_body) / 1024:.1f} KB of JSON")
+    print(f"  {'encoder':<28} {'ms':>8} {'speedup':>8}")
+    print(f"  {'jsonable_encoder + json':<28} {default_t * 1000:>8.2f} {1:>7.1f}x")
+    fast_name = "orjson" if http_encoding.orjson is not None else "json (orjson not installed)"
+    print(f"  {fast_name:<28} {fast_t * 1000:>8.2f} {default_t / fast_t:>7.1f}x")
+    print(f"  {'encoding':<28} {'ms':>8} {'KB':>8} {'ratio':>7}")
+    for encoding, codec in http_encoding.CODECS.items():
+        compressed, t = timed(lambda: codec(fast_body), repeat)
+        print(f"  {encoding:<28} {t * 1000:>8.2f} {len(compressed) / 1024:>8.1f} {len(fast_body) / len(compressed):>6.1f}x")
+    missing = [e for e in ("br", "zstd") if e not in http_encoding.CODECS]
+    if missing:
+        print(f"  (not installed: {', '.join(missing)})")
+
+
+def main(args):
+    report(f"/history, {args.steps} steps x {args.models} models x {args.chars} chars",
+           synthetic_history(args.steps, args.models, args.chars), args.repeat)
+    report(f"/session, {args.sessions} sessions", synthetic_account(args.sessions), args.repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=30, help="checkpoint steps in the history")
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--chars", type=int, default=2000, help="characters per model reply")
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""Per-request logging overhead on the request thread: old print()/basicConfig vs. log_config.
+
+Replays the log calls one /chat turn with three models made before and after
+the switch, writing to a line-buffered file the way a container log pipe
+behaves, and reports the time the request thread spends in them.
+
+    python benchmarks/bench_logging.py [--requests 2000] [--reply-chars 2000]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage  # noqa: E402
+
+import log_config  # noqa: E402
+
+MODELS = [("OpenAI", "gpt-4o-mini"), ("Google", "gemini-2.5-flash"), ("Anthropic", "claude-3-5-haiku-latest")]
+
+
+def old_request(logger, reply):
+    for node, model in MODELS:
+        logger.info(f"Using {node} key: {node.lower()}_key_1")
+        print(f"{node} called ...")
+        print(model)
+        if node in ("Google", "Anthropic"):
+            print(reply)
+
+
+def new_request(logger, reply):
+    for node, model in MODELS:
+        logger.info("Using %s key: %s", node, f"{node.lower()}_key_1", extra={"event": "key_selected", "provider": node, "key_id": f"{node.lower()}_key_1"})
+        logger.debug(f"{node} node using %s", model, extra={"event": "node_called"})
+        if node in ("Google", "Anthropic"):
+            logger.debug(f"{node} response", extra={"event": "node_response", "node": node, "content": reply.content})
+
+
+def run(fn, logger, reply, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn(logger, reply)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--reply-chars", type=int, default=2000)
+    args = parser.parse_args()
+    reply = AIMessage(content="x" * args.reply_chars, response_metadata={"model_name": "bench", "finish_reason": "stop"})
+    root = logging.getLogger()
+    logger = logging.getLogger("constants")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_path, after_path = os.path.join(tmp, "before.log"), os.path.join(tmp, "after.log")
+        with open(before_path, "w", buffering=1) as sink, contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+            handler = logging.StreamHandler(sink)
+            root.addHandler(handler)
+            root.setLevel(logging.INFO)
+            before = run(old_request, logger, reply, args.requests)
+            root.removeHandler(handler)
+
+        with open(after_path, "w", buffering=1) as sink, contextlib.redirect_stderr(sink):
+            log_config.configure_logging()
+            after = run(new_request, logger, reply, args.requests)
+            drain_start = time.perf_counter()
+            log_config.stop_logging()
+            drain = time.perf_counter() - drain_start
+
+        before_bytes, after_bytes = os.path.getsize(before_path), os.path.getsize(after_path)
+
+    print(f"{args.requests} requests, 3 models, {args.reply_chars}-char replies")
+    print(f"  print/basicConfig : {before * 1e6:8.1f} us/request on the request thread, {before_bytes / args.requests:8.0f} bytes/request")
+    print(f"  log_config (INFO) : {after * 1e6:8.1f} us/request on the request thread, {after_bytes / args.requests:8.0f} bytes/request")
+    print(f"  listener drain after the run: {drain * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""PDF extraction: serial in-handler loop vs. the pooled/streamed path in preprocess.py.
+
+Builds synthetic 10/100/1000-page PDFs and reports, for each size, total time,
+time to the first streamed page, and the worst event-loop stall seen while
+extracting (the serial loop blocks the loop for its whole duration).
+
+    python benchmarks/bench_pdf_extract.py [--pages 10 100 1000] [--lines 40]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # noqa: E402
+import preprocess  # noqa: E402
+
+
+def make_pdf(pages: int, lines: int) -> str:
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page()
+        text = "\n".join(f"Page {p} line {i}: the quick brown fox jumps over the lazy dog." for i in range(lines))
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=8)
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    doc.save(path)
+    return path
+
+
+def serial_extract(path: str) -> str:
+    """The original implementation"""
+    text = ""
+    doc = fitz.open(path)
+    for page in doc:
+        text += page.get_text()
+    return text.strip()
+
+
+async def watch_loop(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Largest gap between ticks, i.e. how long the event loop was blocked"""
+    worst = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        worst = max(worst, now - last - interval)
+        last = now
+    return worst
+
+
+async def measure(fn) -> tuple:
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    first, text = await fn(start)
+    total = time.perf_counter() - start
+    stop.set()
+    return total, first, await watcher, len(text)
+
+
+async def run_serial(path):
+    async def fn(start):
+        text = serial_extract(path)  # deliberately on the loop, like the old handler
+        return time.perf_counter() - start, text
+    return await measure(fn)
+
+
+async def run_streamed(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    async def fn(start):
+        first = None
+        parts = []
+        total = await asyncio.to_thread(preprocess.pdf_page_count, data)
+        async for _, text in preprocess.iter_pdf_pages(data, total):
+            if first is None:
+                first = time.perf_counter() - start
+            parts.append(text)
+        return first, "".join(parts).strip()
+    return await measure(fn)
+
+
+async def main(args):
+    preprocess.get_pdf_pool()  # exclude worker start-up from the numbers
+    await asyncio.get_running_loop().run_in_executor(preprocess.get_pdf_pool(), preprocess.pdf_page_count, args.warmup)
+
+    print(f"workers={preprocess.PDF_WORKERS} parallel_min_pages={preprocess.PDF_PARALLEL_MIN_PAGES}")
+    print(f"{'pages':>6} {'mode':<9} {'total s':>9} {'first page s':>13} {'max loop stall s':>17} {'chars':>9}")
+    for pages in args.pages:
+        path = make_pdf(pages, args.lines)
+        try:
+            for name, runner in (("serial", run_serial), ("pooled", run_streamed)):
+                total, first, stall, chars = await runner(path)
+                print(f"{pages:>6} {name:<9} {total:>9.3f} {first:>13.3f} {stall:>17.3f} {chars:>9}")
+        finally:
+            os.remove(path)
+    preprocess.shutdown_pdf_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--lines", type=int, default=40)
+    args = parser.parse_args()
+    warmup = make_pdf(1, 1)
+    with open(warmup, "rb") as f:
+        args.warmup = f.read()
+    os.remove(warmup)
+    asyncio.run(main(args))
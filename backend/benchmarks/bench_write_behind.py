@@ -0,0 +1,127 @@
+"""Throughput of write-behind checkpoint writes.
+
+Compares the current per-turn writes (one round trip per checkpoint upsert and
+one per put_writes batch) against the buffered mode. Each turn starts with the
+newest-checkpoint-id lookup /chat does, which in buffered mode first flushes
+that thread's queued writes, and only those. Crash consistency is
+covered by tests/test_write_behind.py.
+
+    python benchmarks/bench_write_behind.py                      # simulated Mongo RTT
+    python benchmarks/bench_write_behind.py --mongo-uri mongodb://127.0.0.1:27017
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import UpdateOne  # noqa: E402
+from write_behind import WriteBehindBuffer, BufferedCollection  # noqa: E402
+
+
+class FakeCollection:
+    """In-memory stand-in for a pymongo collection with a fixed round-trip latency"""
+
+    def __init__(self, rtt_ms: float):
+        self.rtt = rtt_ms / 1000
+        self.docs = {}
+        self.applied = []  # order in which ops were applied
+        self.round_trips = 0
+
+    def _apply(self, op):
+        key = tuple(sorted(op._filter.items()))
+        self.docs.setdefault(key, {}).update(op._doc.get("$set", {}))
+        self.applied.append(key)
+
+    def update_one(self, filter, update, upsert=False):
+        time.sleep(self.rtt)
+        self.round_trips += 1
+        self._apply(UpdateOne(filter, update, upsert=upsert))
+
+    def bulk_write(self, requests, ordered=True):
+        time.sleep(self.rtt)
+        self.round_trips += 1
+        for op in requests:
+            self._apply(op)
+
+    def find_one(self, filter, projection=None, sort=None):
+        time.sleep(self.rtt)
+        self.round_trips += 1
+        return None
+
+
+def simulate_turn(checkpoints, writes, thread_id: str, turn: int):
+    """Mirror the reads and writes MongoDBSaver issues for one /chat turn with one model"""
+    checkpoints.find_one({"thread_id": thread_id, "checkpoint_ns": ""}, {"checkpoint_id": 1, "_id": 0},
+                         sort=[("checkpoint_id", -1)])
+    for step in range(3):
+        checkpoint_id = f"{turn}-{step}"
+        checkpoints.update_one(
+            {"thread_id": thread_id, "checkpoint_ns": "", "checkpoint_id": checkpoint_id},
+            {"$set": {"checkpoint": b"x" * 2048, "metadata": b"{}"}},
+            upsert=True,
+        )
+        writes.bulk_write([
+            UpdateOne(
+                {"thread_id": thread_id, "checkpoint_id": checkpoint_id, "task_id": "t", "idx": i},
+                {"$set": {"channel": "openai_messages", "value": b"y" * 512}},
+                upsert=True,
+            )
+            for i in range(2)
+        ])
+
+
+def run(checkpoints, writes, buffer, turns: int, concurrency: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for f in [pool.submit(simulate_turn, checkpoints, writes, f"thread-{n % concurrency}", n) for n in range(turns)]:
+            f.result()
+    if buffer is not None:
+        buffer.close()
+    return time.perf_counter() - start
+
+
+def make_buffer(max_batch: int, interval_ms: float) -> WriteBehindBuffer:
+    buffer = WriteBehindBuffer()
+    buffer.enabled = True
+    buffer.max_batch = max_batch
+    buffer.flush_interval = interval_ms / 1000
+    return buffer
+
+
+def bench_throughput(args):
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        db = MongoClient(args.mongo_uri)["WriteBehindBench"]
+        db.drop_collection("checkpoints")
+        db.drop_collection("writes")
+        make = lambda: (db["checkpoints"], db["writes"])  # noqa: E731
+    else:
+        make = lambda: (FakeCollection(args.rtt_ms), FakeCollection(args.rtt_ms))  # noqa: E731
+
+    cp, wr = make()
+    direct = run(cp, wr, None, args.turns, args.concurrency)
+
+    cp, wr = make()
+    buffer = make_buffer(args.max_batch, args.interval_ms)
+    buffered = run(BufferedCollection(cp, buffer), BufferedCollection(wr, buffer), buffer, args.turns, args.concurrency)
+
+    print(f"{'mode':<14}{'seconds':>10}{'turns/s':>12}")
+    print(f"{'per-turn':<14}{direct:>10.3f}{args.turns / direct:>12.1f}")
+    print(f"{'write-behind':<14}{buffered:>10.3f}{args.turns / buffered:>12.1f}  (incl. final flush)")
+    print(f"buffer stats: {buffer.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="simulated Mongo round trip")
+    parser.add_argument("--max-batch", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=50)
+    parser.add_argument("--mongo-uri", default=None, help="benchmark against a real MongoDB instead")
+    args = parser.parse_args()
+
+    bench_throughput(args)
@@ -0,0 +1,302 @@
+import os
+import socket
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import httpx
+import httpcore
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.25"))
+# How long a cancelled run gets to unwind before its capacity is released anyway
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "5"))
+
+
+class RequestCancelled(BaseException):
+    """The client this work was for has gone away
+
+    A BaseException, like asyncio.CancelledError, so the SDKs' and our own
+    ``except Exception`` retry and fallback paths let it through.
+    """
+
+
+class CancelScope:
+    """Cancellation state for one client request, shared by every thread working on it
+
+    Work checks it at phase boundaries (enter_phase) and before each provider
+    request (the key clients' request hook). Provider calls already waiting on
+    a response are aborted by shutting down their sockets, which the key
+    clients' network backend registers here for the duration of each read or
+    write. Key reservations taken for calls that never got sent are handed
+    back on cancel.
+
+    A scope with a parent covers part of a request (one race-mode branch):
+    it is cancelled along with its parent, or on its own when that part of
+    the work is no longer wanted.
+    """
+
+    def __init__(self, route: str, parent: Optional["CancelScope"] = None):
+        self.route = route
+        self.phase = "start"
+        self.parent = parent
+        self.reason = "client disconnected"
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._sockets: Counter = Counter()
+        self._reservations: List[Tuple[str, Callable[[], None]]] = []
+        self._sent: Counter = Counter()
+        self._children: List["CancelScope"] = []
+        if parent is not None:
+            with parent._lock:
+                parent._children.append(self)
+            if parent.cancelled:
+                self.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise RequestCancelled(f"Cancelled during {self.phase}: {self.reason}")
+
+    def cancel(self, reason: Optional[str] = None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            if reason:
+                self.reason = reason
+            self._event.set()
+            sockets = list(self._sockets)
+            reservations, sent = self._reservations, self._sent.copy()
+            children = list(self._children)
+        if self.parent is None:
+            # Imported here: metrics imports this module (via api_key_manager and for is_cancelled)
+            from metrics import request_cancellations
+            request_cancellations.inc(route=self.route, phase=self.phase)
+        logger.info("Cancelling %s during %s: %s", self.route, self.phase, self.reason,
+                    extra={"event": "request_cancelled", "phase": self.phase, "open_sockets": len(sockets)})
+        for child in children:
+            child.cancel(self.reason)
+        for sock in sockets:
+            try:
+                # shutdown (unlike close) wakes a thread blocked in recv on this socket
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for key_id, release in reservations:
+            if sent[key_id] > 0:
+                sent[key_id] -= 1
+            else:
+                release()
+
+    def reserved(self, key_id: str, release: Callable[[], None]):
+        """Note a key reservation; ``release`` undoes it if the request is cancelled before it's sent"""
+        with self._lock:
+            self._reservations.append((key_id, release))
+
+    def sent(self, key_id: str):
+        with self._lock:
+            self._sent[key_id] += 1
+        if self.parent is not None:
+            # Covers a reservation taken before the work was split into child scopes (the primary hedge call)
+            self.parent.sent(key_id)
+
+    def attach(self, sock):
+        with self._lock:
+            self._sockets[sock] += 1
+        if self._event.is_set():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def detach(self, sock):
+        with self._lock:
+            self._sockets[sock] -= 1
+            if self._sockets[sock] <= 0:
+                del self._sockets[sock]
+
+
+current_scope: contextvars.ContextVar[Optional[CancelScope]] = contextvars.ContextVar("cancel_scope", default=None)
+
+
+@contextmanager
+def cancel_scope(scope: CancelScope):
+    token = current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        current_scope.reset(token)
+
+
+def enter_phase(phase: str):
+    """Mark the current request's phase, raising RequestCancelled if its client has gone"""
+    scope = current_scope.get()
+    if scope is not None:
+        scope.phase = phase
+        scope.check()
+
+
+def is_cancelled() -> bool:
+    scope = current_scope.get()
+    return scope is not None and scope.cancelled
+
+
+async def run_in_scope(scope: CancelScope, fn, *args, disconnected=None):
+    """Run ``fn(*args)`` on a worker thread under ``scope``
+
+    Returns fn's result, or raises RequestCancelled once the scope is
+    cancelled (from another thread, or here when the ``disconnected``
+    coroutine function says the client has gone) and the work has unwound,
+    or CANCEL_GRACE_SECONDS have passed.
+    """
+    def run():
+        with cancel_scope(scope):
+            return fn(*args)
+
+    # The same thread pool sync endpoints use, so /chat keeps the concurrency it had as one
+    task = asyncio.ensure_future(run_in_threadpool(run))
+    while not task.done():
+        await asyncio.wait([task], timeout=DISCONNECT_POLL_SECONDS)
+        if task.done():
+            break
+        if scope.cancelled or (disconnected is not None and await disconnected()):
+            scope.cancel()
+            # Whatever it ends with is of no interest now
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            # Usually quick; a Gemini call (not on the key clients) runs on and is left to finish unobserved
+            await asyncio.wait([task], timeout=CANCEL_GRACE_SECONDS)
+            raise RequestCancelled(f"Cancelled during {scope.phase}: {scope.reason}")
+    return task.result()
+
+
+async def run_until_disconnected(request, route: str, fn, *args):
+    """Run ``fn(*args)`` on a worker thread, cancelling it if the HTTP client disconnects first"""
+    return await run_in_scope(CancelScope(route), fn, *args, disconnected=request.is_disconnected)
+
+
+class CancellableStream(httpcore.NetworkStream):
+    """Registers its socket with the calling thread's CancelScope while it reads or writes"""
+
+    def __init__(self, stream: httpcore.NetworkStream):
+        self._stream = stream
+        self._sock = stream.get_extra_info("socket")
+
+    def _io(self, op, *args):
+        scope = current_scope.get()
+        if scope is None or self._sock is None:
+            return op(*args)
+        scope.attach(self._sock)
+        try:
+            result = op(*args)
+            # After a shutdown, recv returns b"" rather than failing
+            scope.check()
+            return result
+        except OSError:
+            scope.check()
+            raise
+        finally:
+            scope.detach(self._sock)
+
+    def read(self, max_bytes: int, timeout: Optional[float] = None) -> bytes:
+        return self._io(self._stream.read, max_bytes, timeout)
+
+    def write(self, buffer: bytes, timeout: Optional[float] = None) -> None:
+        return self._io(self._stream.write, buffer, timeout)
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def start_tls(self, ssl_context, server_hostname: Optional[str] = None, timeout: Optional[float] = None):
+        return CancellableStream(self._stream.start_tls(ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info: str):
+        return self._stream.get_extra_info(info)
+
+
+class CancellableBackend(httpcore.NetworkBackend):
+    """httpcore's sync backend with streams that CancelScope.cancel() can interrupt"""
+
+    def __init__(self):
+        self._backend = httpcore.SyncBackend()
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        return CancellableStream(self._backend.connect_tcp(host, port, timeout, local_address, socket_options))
+
+    def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return CancellableStream(self._backend.connect_unix_socket(path, timeout, socket_options))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+
+@contextmanager
+def _httpx_errors():
+    """Re-raise httpcore's exceptions as httpx's same-named ones, which the SDKs' retry logic expects"""
+    try:
+        yield
+    except httpcore.TimeoutException as e:
+        raise getattr(httpx, type(e).__name__, httpx.TimeoutException)(str(e)) from e
+    except httpcore.NetworkError as e:
+        raise getattr(httpx, type(e).__name__, httpx.NetworkError)(str(e)) from e
+    except (httpcore.ProtocolError, httpcore.ProxyError, httpcore.UnsupportedProtocol) as e:
+        raise getattr(httpx, type(e).__name__, httpx.TransportError)(str(e)) from e
+
+
+class _ResponseStream(httpx.SyncByteStream):
+    def __init__(self, response: httpcore.Response):
+        self._response = response
+
+    def __iter__(self) -> Iterator[bytes]:
+        with _httpx_errors():
+            yield from self._response.iter_stream()
+
+    def close(self) -> None:
+        self._response.close()
+
+
+class CancellableTransport(httpx.BaseTransport):
+    """httpx transport over an httpcore pool whose connections use CancellableBackend
+
+    The key clients' transport. Built from public httpx and httpcore APIs
+    only, so provider calls keep working across library upgrades.
+    """
+
+    def __init__(self, limits: httpx.Limits = httpx.Limits(max_connections=1000, max_keepalive_connections=100)):
+        self.network_backend = CancellableBackend()
+        self._pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=self.network_backend,
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host,
+                             port=request.url.port, target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _httpx_errors():
+            response = self._pool.handle_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_ResponseStream(response),
+            extensions=response.extensions,
+        )
+
+    def close(self) -> None:
+        self._pool.close()
@@ -0,0 +1,148 @@
+import os
+import json
+import asyncio
+import logging
+from concurrent.futures import TimeoutError as FuturesTimeout
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from cancellation import CancelScope, RequestCancelled, current_scope
+from metrics import ws_connections, ws_turns
+
+logger = logging.getLogger(__name__)
+
+# Events buffered for a client before the graph producing them is made to wait
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "256"))
+# How long a full buffer may stay full before the client counts as stalled and its turn is cancelled
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "30"))
+# Connections with no message from the client for this long are closed
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "900"))
+
+
+def coalesce(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge runs of token events for the same reply into one event each"""
+    merged: List[Dict[str, Any]] = []
+    for event in events:
+        last = merged[-1] if merged else None
+        if (event.get("type") == "token" and last is not None and last.get("type") == "token"
+                and all(last.get(k) == event.get(k) for k in ("id", "model", "message_id"))):
+            merged[-1] = {**last, "text": last["text"] + event["text"]}
+        else:
+            merged.append(event)
+    return merged
+
+
+class ChatChannel:
+    """One client's WebSocket: ordered outbound events with backpressure, one turn at a time
+
+    Events go out through a bounded queue drained by a single sender task, so
+    a slow client fills the queue and then blocks the worker thread producing
+    tokens (emit) instead of buffering without limit. Tokens that pile up
+    while the socket is busy are sent as one event. Each turn runs under its
+    own CancelScope, cancelled by a ``cancel`` message or a disconnect.
+    """
+
+    def __init__(self, websocket: WebSocket, route: str = "/ws"):
+        self.websocket = websocket
+        self.route = route
+        self.loop = asyncio.get_running_loop()
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self.closed = False
+        self.turn: Optional[asyncio.Task] = None
+        self.turn_id: Any = None
+        self.scope: Optional[CancelScope] = None
+        self._background: set = set()
+
+    async def send(self, event: Dict[str, Any]):
+        if not self.closed:
+            await self.outbox.put(event)
+
+    def emit(self, event: Dict[str, Any]):
+        """send() for worker threads; blocks while the client is behind"""
+        future = asyncio.run_coroutine_threadsafe(self.send(event), self.loop)
+        try:
+            future.result(timeout=WS_SEND_TIMEOUT_SECONDS)
+        except FuturesTimeout:
+            future.cancel()
+            scope = current_scope.get()
+            if scope is not None:
+                scope.cancel("client stopped reading")
+            raise RequestCancelled("Client stopped reading")
+
+    @property
+    def busy(self) -> bool:
+        return self.turn is not None and not self.turn.done()
+
+    def start_turn(self, turn_id, run: Callable[[CancelScope], Awaitable[None]]) -> bool:
+        """Start ``run(scope)`` as the channel's turn; False if one is already running"""
+        if self.busy:
+            ws_turns.inc(outcome="busy")
+            return False
+        self.turn_id = turn_id
+        self.scope = CancelScope(self.route)
+        self.turn = asyncio.create_task(run(self.scope))
+        return True
+
+    def cancel_turn(self, reason: str) -> bool:
+        if not self.busy:
+            return False
+        self.scope.cancel(reason)
+        return True
+
+    def spawn(self, coro: Awaitable[None]):
+        """Background work for this connection (title generation); dropped when it closes"""
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _sender(self):
+        while True:
+            events = [await self.outbox.get()]
+            while not self.outbox.empty():
+                events.append(self.outbox.get_nowait())
+            for event in coalesce(events):
+                await self.websocket.send_text(json.dumps(event, default=str))
+
+    async def serve(self, on_message: Callable[[Dict[str, Any]], Awaitable[None]]):
+        """Receive loop: answers pings and cancels itself, hands every other message to ``on_message``"""
+        sender = asyncio.create_task(self._sender())
+        ws_connections.inc()
+        try:
+            while True:
+                try:
+                    raw = await asyncio.wait_for(self.websocket.receive_text(), timeout=WS_IDLE_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    await self.websocket.close(code=1000, reason="idle")
+                    break
+                except (WebSocketDisconnect, RuntimeError):
+                    break
+                if sender.done():
+                    # Sending failed, so the client is gone even if no disconnect was received yet
+                    break
+                try:
+                    message = json.loads(raw)
+                    if not isinstance(message, dict):
+                        raise ValueError("expected an object")
+                except ValueError as e:
+                    await self.send({"type": "error", "code": "bad_message", "detail": str(e)})
+                    continue
+                kind = message.get("type")
+                if kind == "ping":
+                    await self.send({"type": "pong", "id": message.get("id")})
+                elif kind == "cancel":
+                    if not self.cancel_turn("cancelled by client"):
+                        await self.send({"type": "error", "id": message.get("id"), "code": "no_turn", "detail": "No turn is running"})
+                else:
+                    await on_message(message)
+        finally:
+            self.closed = True
+            ws_connections.dec()
+            if self.busy:
+                self.scope.cancel()
+            sender.cancel()
+            for task in list(self._background):
+                task.cancel()
+            # Frees a worker blocked in emit on a full queue; later sends are dropped
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
@@ -0,0 +1,195 @@
+import os
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    WRITES_IDX_MAP,
+    copy_checkpoint,
+    get_checkpoint_id,
+)
+
+from lru_cache import LRUCache
+
+
+def _approx_size(entry: Dict[str, Any]) -> int:
+    """Rough in-memory footprint of a cached thread state, dominated by message text"""
+    size = 512
+    tup: Optional[CheckpointTuple] = entry.get("tuple")
+    if tup is not None:
+        for value in tup.checkpoint["channel_values"].values():
+            if isinstance(value, list):
+                for msg in value:
+                    content = getattr(msg, "content", msg)
+                    size += 256 + (len(content) if isinstance(content, str) else len(str(content)))
+            else:
+                size += 64 + len(str(value))
+    for writes in entry.get("writes", {}).values():
+        size += 256 * len(writes)
+    return size
+
+
+class CachedCheckpointSaver(BaseCheckpointSaver):
+    """Write-through LRU of each thread's latest checkpoint, layered over another saver
+
+    ``get_tuple`` for the latest checkpoint of a recently active thread is served
+    from memory, skipping the Mongo read and deserialization. Every ``put`` and
+    ``put_writes`` goes to the wrapped saver first and then refreshes the cached
+    entry, so the cache never holds anything the database doesn't.
+
+    Entries are per process, so another worker's turn on the same thread
+    leaves this one's entry stale. Given ``latest_id(thread_id, checkpoint_ns)``,
+    a cheap lookup of the thread's newest checkpoint id in the database, a
+    cached entry is only served while it is still the newest; otherwise it is
+    dropped and the full state is read again.
+    """
+
+    def __init__(self, saver: BaseCheckpointSaver, max_entries: int = None, max_bytes: int = None, ttl: float = None,
+                 latest_id: Optional[Callable[[str, str], Optional[str]]] = None):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.latest_id = latest_id
+        self.stale = 0
+        self.cache = LRUCache(
+            max_entries=max_entries or int(os.getenv("CHECKPOINT_CACHE_MAX_ENTRIES", "1000")),
+            max_bytes=max_bytes or int(os.getenv("CHECKPOINT_CACHE_MAX_MB", "256")) * 1024 * 1024,
+            ttl=ttl or float(os.getenv("CHECKPOINT_CACHE_TTL_SECONDS", "120")),
+            sizeof=_approx_size,
+        )
+        self._lock = threading.Lock()  # serializes read-modify-write of entries
+
+    @property
+    def config_specs(self) -> list:
+        return self.saver.config_specs
+
+    @staticmethod
+    def _key(config: RunnableConfig) -> Tuple[str, str]:
+        configurable = config["configurable"]
+        return configurable["thread_id"], configurable.get("checkpoint_ns", "")
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        key = self._key(config)
+        entry = self.cache.get(key)
+        tup = entry.get("tuple") if entry else None
+        checkpoint_id = get_checkpoint_id(config)
+        if tup is not None and not checkpoint_id and self.latest_id is not None \
+                and self.latest_id(*key) != tup.config["configurable"]["checkpoint_id"]:
+            # Another process has moved the thread on since this entry was cached
+            self.stale += 1
+            self.cache.invalidate(key)
+            tup = None
+        if tup is not None and (not checkpoint_id or checkpoint_id == tup.config["configurable"]["checkpoint_id"]):
+            # Hand out copies: the pregel loop mutates the checkpoint it loads
+            return CheckpointTuple(
+                tup.config,
+                copy_checkpoint(tup.checkpoint),
+                tup.metadata,
+                tup.parent_config,
+                list(tup.pending_writes or []),
+            )
+
+        tup = self.saver.get_tuple(config)
+        # Interrupted runs leave pending writes behind; those threads are rare, just don't cache them
+        if tup is not None and not checkpoint_id and not tup.pending_writes:
+            loaded_id = tup.config["configurable"]["checkpoint_id"]
+            with self._lock:
+                current = self.cache.peek(key)
+                current_tup = current.get("tuple") if current else None
+                # A concurrent put may already have cached something newer
+                if current_tup is None or current_tup.config["configurable"]["checkpoint_id"] < loaded_id:
+                    self.cache.set(key, {
+                        "tuple": CheckpointTuple(tup.config, copy_checkpoint(tup.checkpoint), tup.metadata,
+                                                 tup.parent_config, []),
+                        "writes": current["writes"] if current else {},
+                    })
+        return tup
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        next_config = self.saver.put(config, checkpoint, metadata, new_versions)
+        key = self._key(next_config)
+        checkpoint_id = next_config["configurable"]["checkpoint_id"]
+        parent_id = config["configurable"].get("checkpoint_id")
+        with self._lock:
+            entry = self.cache.peek(key) or {"writes": {}}
+            # Writes can race ahead of the put for their checkpoint; keep anything not older
+            writes = {cid: w for cid, w in entry["writes"].items() if cid >= checkpoint_id}
+            self.cache.set(key, {
+                "tuple": CheckpointTuple(
+                    next_config,
+                    copy_checkpoint(checkpoint),
+                    {**metadata, **config.get("metadata", {})},
+                    {"configurable": {"thread_id": key[0], "checkpoint_ns": key[1], "checkpoint_id": parent_id}}
+                    if parent_id else None,
+                    list(writes.get(checkpoint_id, {}).values()),
+                ),
+                "writes": writes,
+            })
+        return next_config
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        self.saver.put_writes(config, writes, task_id, task_path)
+        key = self._key(config)
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        with self._lock:
+            entry = self.cache.peek(key) or {"writes": {}}
+            staged = entry["writes"].setdefault(checkpoint_id, {})
+            # Same rule as the Mongo saver: special channels replace, others insert once
+            replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+            for idx, (channel, value) in enumerate(writes):
+                write_key = (task_id, WRITES_IDX_MAP.get(channel, idx))
+                if replace or write_key not in staged:
+                    staged[write_key] = (task_id, channel, value)
+            tup = entry.get("tuple")
+            if tup is not None and tup.config["configurable"]["checkpoint_id"] == checkpoint_id:
+                entry["tuple"] = tup._replace(pending_writes=list(staged.values()))
+            self.cache.set(key, entry)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.saver.delete_thread(thread_id)
+        self.invalidate(thread_id)
+
+    def invalidate(self, thread_id: str, checkpoint_ns: str = ""):
+        """Forget a thread's cached state, e.g. after it was modified outside this process"""
+        self.cache.invalidate((thread_id, checkpoint_ns))
+
+    def get_next_version(self, current: Optional[Any], channel: None) -> Any:
+        return self.saver.get_next_version(current, channel)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.cache.stats(), "stale": self.stale}
+
+
+def mongo_latest_id(collection) -> Callable[[str, str], Optional[str]]:
+    """latest_id for a MongoDBSaver's checkpoint collection: an index-only lookup, no checkpoint blob"""
+    def latest_id(thread_id: str, checkpoint_ns: str) -> Optional[str]:
+        doc = collection.find_one({"thread_id": thread_id, "checkpoint_ns": checkpoint_ns},
+                                  {"checkpoint_id": 1, "_id": 0}, sort=[("checkpoint_id", -1)])
+        return doc["checkpoint_id"] if doc else None
+    return latest_id
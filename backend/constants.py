@@ -6,94 +6,193 @@ from dotenv import load_dotenv
 from langchain_anthropic import ChatAnthropic
 from langchain_deepseek import ChatDeepSeek
 from api_key_manager import api_key_manager, ProviderType
+from metrics import ProviderMetricsCallback
+from tracing import ProviderTracingCallback
+from hedging import hedged
+from generation import provider_kwargs
+from cancellation import current_scope, CancellableTransport
 
+import os
 import logging
+import threading
+
+import httpx
+import openai
+import anthropic
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-def llm_ChatOpenAI(openai_model_name):
-    key_info = api_key_manager.get_available_key(ProviderType.OPENAI)
+
+def endpoint_override(provider, param="base_url"):
+    """API endpoint from <PROVIDER>_BASE_URL, e.g. loadtest/fake_provider.py; empty when unset"""
+    url = os.getenv(f"{provider.name}_BASE_URL")
+    if not url:
+        return {}
+    if provider is ProviderType.GOOGLE:
+        # The default gRPC transport can't be pointed at a plain HTTP server
+        return {"transport": "rest", "client_options": {"api_endpoint": url}}
+    return {param: url}
+
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+def key_http_client(provider, key_id):
+    """Pooled HTTP client for one key; every response's rate-limit headers go to the key manager
+
+    Its calls can also be cancelled when the client of the request they serve
+    disconnects (see cancellation.py). Google isn't wired up: Gemini sends no
+    rate-limit headers and its REST transport doesn't use httpx, so its keys
+    stay on the static table and its calls run to completion.
+    """
+    with _http_clients_lock:
+        client = _http_clients.get(key_id)
+        if client is None:
+            def check_cancelled(request):
+                # Nothing new goes out (first try, SDK retry or hedge) for a client that has left
+                scope = current_scope.get()
+                if scope is not None:
+                    scope.check()
+                    scope.sent(key_id)
+
+            def learn_limits(response):
+                api_key_manager.record_headers(provider, key_id, response.headers, response.status_code)
+
+            # Same timeouts and pool sizes as the SDKs' default clients, on sockets a disconnect can shut down mid-call
+            client = _http_clients[key_id] = httpx.Client(
+                timeout=httpx.Timeout(600.0, connect=5.0),
+                transport=CancellableTransport(httpx.Limits(max_connections=1000, max_keepalive_connections=100)),
+                follow_redirects=True,
+                event_hooks={"request": [check_cancelled], "response": [learn_limits]},
+            )
+        return client
+
+def provider_callbacks(provider, key_id, model_name):
+    # Metrics and a tracing span for every call made through this key
+    return [ProviderMetricsCallback(provider, key_id, model_name), ProviderTracingCallback(provider, key_id, model_name)]
+
+def llm_ChatOpenAI(openai_model_name, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.OPENAI, exclude)
     if not key_info:
         raise Exception("No available OpenAI API keys")
     
     api_key, key_id = key_info
-    logger.info(f"Using OpenAI key: {key_id}")
+    logger.info("Using %s key: %s", "OpenAI", key_id, extra={"event": "key_selected", "provider": "OpenAI", "key_id": key_id})
     
-    return ChatOpenAI(
+    llm = ChatOpenAI(
         model=openai_model_name,  
-        temperature=0.7,
-        api_key=api_key
+        **provider_kwargs(ProviderType.OPENAI, openai_model_name, params),
+        http_client=key_http_client(ProviderType.OPENAI, key_id),
+        callbacks=provider_callbacks(ProviderType.OPENAI, key_id, openai_model_name),
+        api_key=api_key,
+        **endpoint_override(ProviderType.OPENAI),
     )
+    if not hedge:
+        return llm
+    return hedged(ProviderType.OPENAI, openai_model_name, llm, lambda: llm_ChatOpenAI(openai_model_name, exclude=(key_id,), hedge=False, params=params))
 
-def llm_ChatGoogleGenerativeAI(google_model_name):
-    key_info = api_key_manager.get_available_key(ProviderType.GOOGLE)
+def llm_ChatGoogleGenerativeAI(google_model_name, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.GOOGLE, exclude)
     if not key_info:
         raise Exception("No available Google API keys")
     
     api_key, key_id = key_info
-    logger.info(f"Using Google key: {key_id}")
+    logger.info("Using %s key: %s", "Google", key_id, extra={"event": "key_selected", "provider": "Google", "key_id": key_id})
     
-    return ChatGoogleGenerativeAI(
+    llm = ChatGoogleGenerativeAI(
         model=google_model_name,   
-        temperature=0.7,
-        google_api_key=api_key
+        **provider_kwargs(ProviderType.GOOGLE, google_model_name, params),
+        callbacks=provider_callbacks(ProviderType.GOOGLE, key_id, google_model_name),
+        google_api_key=api_key,
+        **endpoint_override(ProviderType.GOOGLE),
     )
+    if not hedge:
+        return llm
+    return hedged(ProviderType.GOOGLE, google_model_name, llm, lambda: llm_ChatGoogleGenerativeAI(google_model_name, exclude=(key_id,), hedge=False, params=params))
 
-def llm_ChatGroq(groq_model_name):
-    key_info = api_key_manager.get_available_key(ProviderType.GROQ)
+def llm_ChatGroq(groq_model_name, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.GROQ, exclude)
     if not key_info:
         raise Exception("No available Groq API keys")
     
     api_key, key_id = key_info
-    logger.info(f"Using Groq key: {key_id}")
+    logger.info("Using %s key: %s", "Groq", key_id, extra={"event": "key_selected", "provider": "Groq", "key_id": key_id})
     
-    return ChatGroq(
+    llm = ChatGroq(
         model=groq_model_name,  
-        temperature=0.7,
-        groq_api_key=api_key
+        **provider_kwargs(ProviderType.GROQ, groq_model_name, params),
+        http_client=key_http_client(ProviderType.GROQ, key_id),
+        callbacks=provider_callbacks(ProviderType.GROQ, key_id, groq_model_name),
+        groq_api_key=api_key,
+        **endpoint_override(ProviderType.GROQ),
     )
+    if not hedge:
+        return llm
+    return hedged(ProviderType.GROQ, groq_model_name, llm, lambda: llm_ChatGroq(groq_model_name, exclude=(key_id,), hedge=False, params=params))
 
-def llm_ChatAnthropic(anthropic_model_name):
-    key_info = api_key_manager.get_available_key(ProviderType.ANTHROPIC)
+def llm_ChatAnthropic(anthropic_model_name, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.ANTHROPIC, exclude)
     if not key_info:
         raise Exception("No available Anthropic API keys")
     
     api_key, key_id = key_info
-    logger.info(f"Using Anthropic key: {key_id}")
+    logger.info("Using %s key: %s", "Anthropic", key_id, extra={"event": "key_selected", "provider": "Anthropic", "key_id": key_id})
     
-    return ChatAnthropic(
+    llm = ChatAnthropic(
         model=anthropic_model_name,
-        temperature=0.7,
-        anthropic_api_key=api_key
+        **provider_kwargs(ProviderType.ANTHROPIC, anthropic_model_name, params),
+        callbacks=provider_callbacks(ProviderType.ANTHROPIC, key_id, anthropic_model_name),
+        anthropic_api_key=api_key,
+        **endpoint_override(ProviderType.ANTHROPIC),
     )
+    # ChatAnthropic builds its SDK client internally with no http_client option, so provide it ready-made,
+    # from the same parameters it would have used (headers, timeout, retries) plus the key's client
+    llm.__dict__["_client"] = anthropic.Client(
+        **{**llm._client_params, "http_client": key_http_client(ProviderType.ANTHROPIC, key_id)})
+    if not hedge:
+        return llm
+    return hedged(ProviderType.ANTHROPIC, anthropic_model_name, llm, lambda: llm_ChatAnthropic(anthropic_model_name, exclude=(key_id,), hedge=False, params=params))
 
-def llm_ChatDeepseek(deepseek_model_name):
-    key_info = api_key_manager.get_available_key(ProviderType.DEEPSEEK)
+def llm_ChatDeepseek(deepseek_model_name, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.DEEPSEEK, exclude)
     if not key_info:
         raise Exception("No available DeepSeek API keys")
     
     api_key, key_id = key_info
-    logger.info(f"Using DeepSeek key: {key_id}")
+    logger.info("Using %s key: %s", "DeepSeek", key_id, extra={"event": "key_selected", "provider": "DeepSeek", "key_id": key_id})
     
-    return ChatDeepSeek(
+    llm = ChatDeepSeek(
         model=deepseek_model_name,  
-        temperature=0.7,
-        api_key=api_key
+        **provider_kwargs(ProviderType.DEEPSEEK, deepseek_model_name, params),
+        http_client=key_http_client(ProviderType.DEEPSEEK, key_id),
+        callbacks=provider_callbacks(ProviderType.DEEPSEEK, key_id, deepseek_model_name),
+        api_key=api_key,
+        **endpoint_override(ProviderType.DEEPSEEK, "api_base"),
     )
+    if not hedge:
+        return llm
+    return hedged(ProviderType.DEEPSEEK, deepseek_model_name, llm, lambda: llm_ChatDeepseek(deepseek_model_name, exclude=(key_id,), hedge=False, params=params))
 
-def llm_ChatPerplexity(perplexity_model_name: str):
-    key_info = api_key_manager.get_available_key(ProviderType.PERPLEXITY)
+def llm_ChatPerplexity(perplexity_model_name: str, exclude=(), hedge=True, params=None):
+    key_info = api_key_manager.get_available_key(ProviderType.PERPLEXITY, exclude)
     if not key_info:
         raise Exception("No available Perplexity API keys")
 
     api_key, key_id = key_info
-    logger.info(f"Using Perplexity key: {key_id}")
+    logger.info("Using %s key: %s", "Perplexity", key_id, extra={"event": "key_selected", "provider": "Perplexity", "key_id": key_id})
 
     # ChatPerplexity reads PPLX_API_KEY from environment if not passed explicitly,
     # but we pass api_key so it works with our rotation system.
-    return ChatPerplexity(
+    llm = ChatPerplexity(
         model=perplexity_model_name,
-        temperature=0.7,
+        **provider_kwargs(ProviderType.PERPLEXITY, perplexity_model_name, params),
+        callbacks=provider_callbacks(ProviderType.PERPLEXITY, key_id, perplexity_model_name),
         api_key=api_key,
-    )
\ No newline at end of file
+    )
+    # ChatPerplexity hard-codes its endpoint and client, so swap in one for the override and the key's headers
+    base_url = endpoint_override(ProviderType.PERPLEXITY).get("base_url") or "https://api.perplexity.ai"
+    llm.client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=key_http_client(ProviderType.PERPLEXITY, key_id))
+    if not hedge:
+        return llm
+    return hedged(ProviderType.PERPLEXITY, perplexity_model_name, llm,
+                  lambda: llm_ChatPerplexity(perplexity_model_name, exclude=(key_id,), hedge=False, params=params))
\ No newline at end of file
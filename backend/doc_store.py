@@ -0,0 +1,209 @@
+import os
+import re
+import math
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+DOC_CHUNK_WORDS = int(os.getenv("DOC_CHUNK_WORDS", "200"))
+DOC_CHUNK_OVERLAP = int(os.getenv("DOC_CHUNK_OVERLAP", "40"))
+DOC_TOP_K = int(os.getenv("DOC_TOP_K", "6"))
+DOC_CONTEXT_MAX_CHARS = int(os.getenv("DOC_CONTEXT_MAX_CHARS", "12000"))
+
+_CHUNK_KEY = [("session_id", ASCENDING), ("content_hash", ASCENDING), ("seq", ASCENDING)]
+_DUPLICATE_KEY = 11000
+# Index with the same keys but other options already exists
+_INDEX_CONFLICTS = (85, 86)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i if in into is it its me my of on or our she "
+    "so that the their them there these they this to was we were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def chunk_pages(pages: List[str], words: int = DOC_CHUNK_WORDS, overlap: int = DOC_CHUNK_OVERLAP) -> List[Dict[str, Any]]:
+    """Split page texts into overlapping word windows, remembering the page each window starts on"""
+    stream: List[Tuple[str, int]] = [(w, page + 1) for page, text in enumerate(pages) for w in text.split()]
+    step = max(1, words - overlap)
+    chunks = []
+    for start in range(0, len(stream), step):
+        window = stream[start:start + words]
+        chunks.append({"page": window[0][1], "text": " ".join(w for w, _ in window)})
+        if start + words >= len(stream):
+            break
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over a session's chunks"""
+
+    def __init__(self, chunks: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.avg_len = (sum(c["length"] for c in chunks) / len(chunks)) if chunks else 0.0
+        df = Counter(term for c in chunks for term in c["tf"])
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+    def search(self, query: str, k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        if not terms:
+            return []
+        scored = []
+        for chunk in self.chunks:
+            tf = chunk["tf"]
+            norm = self.k1 * (1 - self.b + self.b * chunk["length"] / (self.avg_len or 1))
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scored.append((score, chunk))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored[:k]
+
+
+class DocumentStore:
+    """Per-session store of extracted documents, chunked and searchable with BM25
+
+    Chunks and their term frequencies are persisted in Mongo next to the session,
+    so the index is rebuilt without re-tokenizing. Built indexes are cached per
+    process and keyed by the session's current set of documents, which is
+    re-read (a few small metadata rows) on every search so workers never serve
+    a stale document set.
+    """
+
+    def __init__(self):
+        mongo_uri = os.getenv("MONGO_URI") or "mongodb://127.0.0.1:27017"
+        db = MongoClient(mongo_uri)["LangGraphDB"]
+        self.documents = db["sessionDocuments"]
+        self.chunks = db["sessionDocumentChunks"]
+        self.indexes = LRUCache(max_entries=int(os.getenv("DOC_INDEX_CACHE_ENTRIES", "256")))
+        self._ensured = False
+
+    def _ensure_indexes(self):
+        if self._ensured:
+            return
+        try:
+            self.documents.create_index([("session_id", ASCENDING), ("content_hash", ASCENDING)], unique=True)
+            try:
+                # Unique, so concurrent adds of one upload (or a retry after a crash) can't double its chunks
+                self.chunks.create_index(_CHUNK_KEY, unique=True)
+            except OperationFailure as e:
+                if e.code not in _INDEX_CONFLICTS:
+                    raise
+                # Built non-unique by an earlier version
+                self.chunks.drop_index(_CHUNK_KEY)
+                self.chunks.create_index(_CHUNK_KEY, unique=True)
+            self._ensured = True
+        except Exception as e:
+            logger.warning(f"Could not create document store indexes: {e}")
+
+    def add(self, session_id: str, content_hash: str, name: str, pages: List[str]) -> int:
+        """Chunk and index a document for a session; re-adding the same content is a no-op"""
+        self._ensure_indexes()
+        existing = self.documents.find_one({"session_id": session_id, "content_hash": content_hash}, {"chunks": 1})
+        if existing:
+            return existing["chunks"]
+        chunks = chunk_pages(pages)
+        rows = []
+        for seq, chunk in enumerate(chunks):
+            tokens = tokenize(chunk["text"])
+            rows.append({
+                "session_id": session_id,
+                "content_hash": content_hash,
+                "seq": seq,
+                "page": chunk["page"],
+                "text": chunk["text"],
+                "tf": dict(Counter(tokens)),
+                "length": len(tokens),
+            })
+        if rows:
+            try:
+                self.chunks.insert_many(rows, ordered=False)
+            except BulkWriteError as e:
+                # Chunks another add of the same content (or one that crashed before its metadata) already wrote
+                if any(error["code"] != _DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                    raise
+        # The metadata row goes last: a document is only visible once all its chunks are
+        self.documents.update_one(
+            {"session_id": session_id, "content_hash": content_hash},
+            {"$setOnInsert": {"name": name, "chunks": len(rows), "pages": len(pages), "created_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        self.indexes.invalidate(session_id)
+        return len(rows)
+
+    def list(self, session_id: str) -> List[Dict[str, Any]]:
+        return list(self.documents.find({"session_id": session_id}, {"_id": 0}).sort("created_at", ASCENDING))
+
+    def remove(self, session_id: str, content_hash: str) -> bool:
+        result = self.documents.delete_one({"session_id": session_id, "content_hash": content_hash})
+        self.chunks.delete_many({"session_id": session_id, "content_hash": content_hash})
+        self.indexes.invalidate(session_id)
+        return result.deleted_count > 0
+
+    def delete_session(self, session_id: str):
+        self.documents.delete_many({"session_id": session_id})
+        self.chunks.delete_many({"session_id": session_id})
+        self.indexes.invalidate(session_id)
+
+    def _index(self, session_id: str, docs: List[Dict[str, Any]]) -> BM25Index:
+        signature = tuple(d["content_hash"] for d in docs)
+        cached = self.indexes.get(session_id)
+        if cached and cached[0] == signature:
+            return cached[1]
+        names = {d["content_hash"]: d.get("name") or "document" for d in docs}
+        rows = list(self.chunks.find(
+            {"session_id": session_id, "content_hash": {"$in": list(signature)}},
+            {"_id": 0, "session_id": 0},
+        ).sort([("content_hash", ASCENDING), ("seq", ASCENDING)]))
+        for row in rows:
+            row["name"] = names[row["content_hash"]]
+        index = BM25Index(rows)
+        self.indexes.set(session_id, (signature, index))
+        return index
+
+    def search(self, session_id: str, query: str, k: int = DOC_TOP_K) -> List[Dict[str, Any]]:
+        """Top-k chunks for the query; the opening of the newest document when nothing matches"""
+        docs = self.list(session_id)
+        if not docs:
+            return []
+        index = self._index(session_id, docs)
+        hits = [chunk for _, chunk in index.search(query, k)]
+        if not hits:
+            # "Summarize this" and similar carry no useful terms
+            newest = docs[-1]["content_hash"]
+            hits = [c for c in index.chunks if c["content_hash"] == newest][:k]
+        return hits
+
+    def context_for(self, session_id: str, query: str, k: int = DOC_TOP_K, max_chars: int = DOC_CONTEXT_MAX_CHARS) -> str:
+        """Retrieved excerpts formatted for the prompt, or "" when the session has no documents"""
+        parts = []
+        used = 0
+        for chunk in self.search(session_id, query, k):
+            part = f"[{chunk['name']}, p. {chunk['page']}]\n{chunk['text']}"
+            if parts and used + len(part) > max_chars:
+                break
+            parts.append(part[:max_chars])
+            used += len(part)
+        return "\n\n".join(parts)
+
+
+# Global instance
+doc_store = DocumentStore()
@@ -1,7 +1,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes_preprocess import router as preprocess_router
+from preprocess import shutdown_pdf_pool
+from preprocess_service import start_workers, stop_workers, PREPROCESS_JOB_CONCURRENCY
+from metrics import instrument_app
+from log_config import configure_logging
 
+configure_logging()
+
+# Standalone preprocess service. Run it next to server.py with PREPROCESS_MODE=queue
+# (and the same PREPROCESS_JOB_DIR) to keep PDF parsing off the chat workers.
 app = FastAPI(title="ALL-AI FastAPI Service")
 
 # CORS: allow all origins during development. Tighten for production.
@@ -15,6 +23,16 @@ app.add_middleware(
 
 # Mount routers
 app.include_router(preprocess_router)
+instrument_app(app)
+
+@app.on_event("startup")
+async def on_startup():
+    start_workers(PREPROCESS_JOB_CONCURRENCY)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await stop_workers()
+    shutdown_pdf_pool()
 
 @app.get("/")
 async def root():
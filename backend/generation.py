@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, List, Literal, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from api_key_manager import ProviderType
+
+logger = logging.getLogger(__name__)
+
+# Profiles as JSON, inline or a path to a file: {role: {node name or model: params}}, "*" matching any
+GENERATION_PROFILES = os.getenv("GENERATION_PROFILES", "")
+
+# The factories' long-standing defaults, under whatever GENERATION_PROFILES sets
+DEFAULT_PROFILES = {"*": {"*": {"temperature": 0.7}}}
+
+# Models that take a reasoning effort; it's left off for the rest, which reject it
+REASONING_MODELS = {
+    ProviderType.OPENAI: re.compile(r"^(o\d|gpt-5)"),
+    ProviderType.GROQ: re.compile(r"gpt-oss|qwen3"),
+    ProviderType.DEEPSEEK: re.compile(r"reasoner"),
+    ProviderType.GOOGLE: re.compile(r"gemini-2\.5"),
+}
+# Gemini takes a thinking budget in tokens rather than an effort
+GEMINI_THINKING_BUDGETS = {"low": 1024, "medium": 8192, "high": 24576}
+
+
+class GenerationParams(BaseModel):
+    """How much a model may generate, and how; unset fields fall through to the next profile"""
+    max_tokens: Optional[int] = Field(default=None, ge=1, description="Cap on output tokens")
+    stop: Optional[List[str]] = Field(default=None, max_length=4, description="Stop sequences")
+    temperature: Optional[float] = Field(default=None, ge=0, le=2)
+    reasoning_effort: Optional[Literal["low", "medium", "high"]] = Field(
+        default=None, description="For reasoning models (o-series, gpt-5, gpt-oss, Gemini 2.5); ignored by others")
+
+    def over(self, base: "GenerationParams") -> "GenerationParams":
+        """These params, with ``base`` filling in whatever they leave unset"""
+        return base.model_copy(update=self.model_dump(exclude_none=True))
+
+
+def provider_kwargs(provider: ProviderType, model: str, params: Optional[GenerationParams]) -> Dict[str, Any]:
+    """Constructor arguments for the provider's LangChain chat model"""
+    if params is None:
+        params = generation_profiles.resolve(None, None, model)
+    kwargs: Dict[str, Any] = {}
+    if params.temperature is not None:
+        kwargs["temperature"] = params.temperature
+    if params.max_tokens is not None:
+        kwargs["max_output_tokens" if provider is ProviderType.GOOGLE else "max_tokens"] = params.max_tokens
+    # ChatPerplexity has no stop option
+    if params.stop and provider is not ProviderType.PERPLEXITY:
+        kwargs["stop_sequences" if provider is ProviderType.ANTHROPIC else "stop"] = params.stop
+    pattern = REASONING_MODELS.get(provider)
+    if params.reasoning_effort and pattern is not None and pattern.search(model):
+        if provider is ProviderType.GOOGLE:
+            kwargs["thinking_budget"] = GEMINI_THINKING_BUDGETS[params.reasoning_effort]
+        else:
+            kwargs["reasoning_effort"] = params.reasoning_effort
+    return kwargs
+
+
+class GenerationProfiles:
+    """Generation params by role and model
+
+    For a call, the matching entries are layered from least to most
+    specific: any role and any model, any role with the node name (e.g.
+    "Google") then the model string, then the same three for the turn's
+    role, and finally what the request itself asked for.
+    """
+
+    def __init__(self, source: str = GENERATION_PROFILES):
+        self.profiles = self._parse(DEFAULT_PROFILES)
+        if source:
+            for role, models in self._parse(self._load(source)).items():
+                self.profiles.setdefault(role, {}).update(models)
+
+    @staticmethod
+    def _load(source: str) -> Dict[str, Any]:
+        if source.lstrip().startswith("{"):
+            return json.loads(source)
+        with open(source) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _parse(raw: Dict[str, Any]) -> Dict[str, Dict[str, GenerationParams]]:
+        profiles: Dict[str, Dict[str, GenerationParams]] = {}
+        for role, models in raw.items():
+            for model, params in models.items():
+                try:
+                    profiles.setdefault(role.lower(), {})[model] = GenerationParams(**params)
+                except ValidationError as e:
+                    logger.warning("Ignoring generation profile %s/%s: %s", role, model, e)
+        return profiles
+
+    def resolve(self, role: Optional[str], node: Optional[str], model: Optional[str],
+                requested: Optional[GenerationParams] = None) -> GenerationParams:
+        params = GenerationParams()
+        roles = ["*"] + ([role.strip().lower()] if role and role.strip() else [])
+        for role_key in roles:
+            entries = self.profiles.get(role_key, {})
+            for model_key in ("*", node, model):
+                if model_key and model_key in entries:
+                    params = entries[model_key].over(params)
+        if requested is not None:
+            params = requested.over(params)
+        return params
+
+    def for_turn(self, role: Optional[str], selected_models: Dict[str, str],
+                 requested: Dict[str, GenerationParams]) -> Dict[str, Dict[str, Any]]:
+        """Resolved params per selected model, as stored in the graph state; ``requested`` may use "*" for all models"""
+        resolved = {}
+        for node, model in selected_models.items():
+            asked = requested.get("*")
+            if node in requested:
+                asked = requested[node] if asked is None else requested[node].over(asked)
+            resolved[node] = self.resolve(role, node, model, asked).model_dump(exclude_none=True)
+        return resolved
+
+
+def node_params(state, node: str) -> GenerationParams:
+    """A model node's params for this turn; plain profile defaults when the turn has none (batch runs)"""
+    params = (state.get("generation") or {}).get(node)
+    if params is None:
+        return generation_profiles.resolve(None, node, state["selected_models"][node])
+    return GenerationParams(**params)
+
+
+# Global instance
+generation_profiles = GenerationProfiles()
@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from langchain_core.runnables import Runnable
+
+from cancellation import CancelScope, cancel_scope, current_scope
+from metrics import provider_hedges
+
+logger = logging.getLogger(__name__)
+
+# Opt-in per provider, e.g. "google,perplexity"; empty disables hedging
+HEDGE_PROVIDERS = {p.strip().lower() for p in os.getenv("HEDGE_PROVIDERS", "").split(",") if p.strip()}
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "250"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "3"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+
+
+class HedgePolicy:
+    """When to fire a backup call, and how many of them we can afford
+
+    The delay is HEDGE_PERCENTILE of the last HEDGE_WINDOW successful call
+    latencies for the (provider, model); until HEDGE_MIN_SAMPLES are in there
+    is no hedging. Each call earns HEDGE_MAX_RATIO of a hedge (banked up to
+    HEDGE_BURST), so hedges stay within that share of traffic per provider.
+    """
+
+    def __init__(self):
+        self.providers = HEDGE_PROVIDERS
+        self._lock = threading.Lock()
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+        self._budget: Dict[str, float] = defaultdict(float)
+
+    def applies(self, provider) -> bool:
+        return provider.value in self.providers
+
+    def record(self, provider, model: str, seconds: float):
+        with self._lock:
+            self._latencies[(provider.value, model)].append(seconds)
+
+    def delay(self, provider, model: str) -> Optional[float]:
+        """Seconds to wait on the first call before hedging; None when there isn't enough history"""
+        with self._lock:
+            samples = sorted(self._latencies.get((provider.value, model), ()))
+            self._budget[provider.value] = min(HEDGE_BURST, self._budget[provider.value] + HEDGE_MAX_RATIO)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+        return max(HEDGE_MIN_DELAY_MS / 1000, samples[index])
+
+    def take(self, provider) -> bool:
+        """Spend one hedge from the provider's budget, if there is one"""
+        with self._lock:
+            if self._budget[provider.value] < 1:
+                return False
+            self._budget[provider.value] -= 1
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "providers": sorted(self.providers),
+                "budget": dict(self._budget),
+                "samples": {f"{p}/{m}": len(v) for (p, m), v in self._latencies.items()},
+            }
+
+
+class HedgedChatModel(Runnable):
+    """A chat model that races a second key when the first call runs long
+
+    Wraps the model a factory in constants.py built; ``backup`` builds the
+    same model on another key. Whichever call succeeds first is returned. Each
+    call runs under its own child of the request's CancelScope, and the other
+    one's is cancelled: a call still waiting on its key never goes out, and an
+    in-flight one is aborted through the key client's transport. Providers
+    whose clients can't be interrupted (Gemini) finish on their worker thread
+    with the result dropped, and their usage is still recorded against the key.
+    """
+
+    def __init__(self, provider, model: str, llm: Runnable, backup: Callable[[], Runnable]):
+        self.provider = provider
+        self.model = model
+        self.llm = llm
+        self.backup = backup
+
+    def _call(self, llm: Runnable, input, config, **kwargs):
+        started = time.perf_counter()
+        result = llm.invoke(input, config, **kwargs)
+        hedge_policy.record(self.provider, self.model, time.perf_counter() - started)
+        return result
+
+    def _run_attempt(self, scope: CancelScope, llm: Runnable, input, config, **kwargs):
+        with cancel_scope(scope):
+            return self._call(llm, input, config, **kwargs)
+
+    def _submit(self, scope: CancelScope, llm: Runnable, input, config, **kwargs):
+        # Copy the context so the call's spans and logs stay under the node that made it
+        return hedge_pool.submit(contextvars.copy_context().run, self._run_attempt, scope, llm, input, config, **kwargs)
+
+    def invoke(self, input, config=None, **kwargs):
+        delay = hedge_policy.delay(self.provider, self.model)
+        if delay is None:
+            return self._call(self.llm, input, config, **kwargs)
+
+        # Outside a request there is nothing to hang the attempts off, so they share a scope of their own
+        parent = current_scope.get() or CancelScope("hedge")
+        scopes = {"primary": CancelScope(parent.route, parent=parent)}
+        primary = self._submit(scopes["primary"], self.llm, input, config, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        if not hedge_policy.take(self.provider):
+            provider_hedges.inc(provider=self.provider.value, outcome="over_budget")
+            return primary.result()
+        scopes["backup"] = CancelScope(parent.route, parent=parent)
+        try:
+            # Under its own scope, so its key reservation is handed back if it's cancelled unsent
+            with cancel_scope(scopes["backup"]):
+                backup_llm = self.backup()
+        except Exception as e:
+            # Usually no other key is free; the first call is still running
+            logger.debug("No hedge for %s: %s", self.provider.value, e, extra={"event": "hedge_skipped"})
+            provider_hedges.inc(provider=self.provider.value, outcome="no_key")
+            return primary.result()
+
+        logger.info("Hedging %s %s after %.0f ms", self.provider.value, self.model, delay * 1000,
+                    extra={"event": "hedge_fired", "provider": self.provider.value, "model": self.model})
+        backup = self._submit(scopes["backup"], backup_llm, input, config, **kwargs)
+        attempts = {primary: "primary", backup: "backup"}
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = attempts[future]
+                    for other in pending:
+                        other.cancel()
+                        scopes[attempts[other]].cancel(f"hedge won by the {winner} call")
+                        # The cancelled call raises RequestCancelled, which nobody is waiting for
+                        other.add_done_callback(lambda f: f.cancelled() or f.exception())
+                    provider_hedges.inc(provider=self.provider.value, outcome="won" if future is backup else "lost")
+                    return future.result()
+                if future is primary or error is None:
+                    error = future.exception()
+        provider_hedges.inc(provider=self.provider.value, outcome="failed")
+        raise error
+
+    def stream(self, input, config=None, **kwargs):
+        # Tokens are already flowing by the time a hedge would fire, so streams aren't hedged
+        return self.llm.stream(input, config, **kwargs)
+
+    def astream(self, input, config=None, **kwargs):
+        return self.llm.astream(input, config, **kwargs)
+
+
+def hedged(provider, model: str, llm: Runnable, backup: Callable[[], Runnable]) -> Runnable:
+    """``llm`` wrapped for hedging when its provider is in HEDGE_PROVIDERS, else ``llm`` itself"""
+    if not hedge_policy.applies(provider):
+        return llm
+    return HedgedChatModel(provider, model, llm, backup)
+
+
+# Global instance
+hedge_policy = HedgePolicy()
+hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "64")), thread_name_prefix="hedge")
@@ -0,0 +1,141 @@
+import os
+import gzip
+import logging
+from typing import Callable, Dict, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import http_compressed_bytes
+
+try:
+    import orjson
+except ImportError:  # optional; FastJSONResponse falls back to the standard encoder
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional; without it "br" isn't offered
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # optional; without it "zstd" isn't offered
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Bodies smaller than this go out as they are; compressing them saves little and costs a round of CPU
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Server preference, used between encodings the client accepts equally
+COMPRESSION_ENCODINGS = [e.strip().lower() for e in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if e.strip()]
+# Bodies at least this large are compressed on a worker thread rather than the event loop
+COMPRESSION_THREAD_BYTES = int(os.getenv("COMPRESSION_THREAD_BYTES", str(256 * 1024)))
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed
+
+    Return one from an endpoint, rather than a dict, to also skip FastAPI's
+    jsonable_encoder pass over the whole payload. Values orjson doesn't know
+    still go through jsonable_encoder, one at a time.
+    """
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(jsonable_encoder(content))
+        return orjson.dumps(content, default=jsonable_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+
+def available_codecs() -> Dict[str, Callable[[bytes], bytes]]:
+    codecs = {"gzip": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        codecs["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    if zstandard is not None:
+        # A compressor per call: they can't be shared between threads
+        codecs["zstd"] = lambda body: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return codecs
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """The encoding to use for a request's Accept-Encoding: highest q, then COMPRESSION_ENCODINGS order"""
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    best, best_q = None, 0.0
+    for encoding in COMPRESSION_ENCODINGS:
+        if encoding not in CODECS:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """Compresses response bodies with gzip, brotli or zstd, whichever the client prefers
+
+    Only bodies sent in one piece of at least COMPRESSION_MIN_BYTES are
+    compressed. Streamed responses (batch results, token streams) pass
+    through untouched so each chunk still goes out as soon as it's written.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held back until the body shows whether it's worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+            held, start = start, None
+            headers = MutableHeaders(scope=held)
+            body = message.get("body", b"")
+            if (message.get("more_body") or len(body) < COMPRESSION_MIN_BYTES or "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                await send(held)
+                return await send(message)
+
+            codec = CODECS[encoding]
+            compressed = await run_in_threadpool(codec, body) if len(body) >= COMPRESSION_THREAD_BYTES else codec(body)
+            http_compressed_bytes.inc(len(body), encoding=encoding, stage="raw")
+            http_compressed_bytes.inc(len(compressed), encoding=encoding, stage="sent")
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(held)
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+
+# Global instance
+CODECS = available_codecs()
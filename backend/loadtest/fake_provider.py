@@ -0,0 +1,357 @@
+"""Local stand-in for the LLM providers, for load tests that don't spend real tokens.
+
+Speaks the wire formats the SDKs behind constants.py use, streaming included:
+
+    /{name}/.../chat/completions          OpenAI-compatible (OpenAI, Groq, DeepSeek, Perplexity)
+    /{name}/v1/messages                   Anthropic Messages
+    /{name}/v1beta/models/{m}:generateContent, :streamGenerateContent   Gemini REST (array or alt=sse)
+
+``{name}`` is free-form and only labels stats and per-provider latency. Point
+the backend at it with the <PROVIDER>_BASE_URL variables (see ``base_urls``):
+
+    python loadtest/fake_provider.py --port 9100 --latency lognormal:800:0.5 --rate-limit-ratio 0.02
+
+Latency specs: ``fixed:MS``, ``uniform:LO:HI``, ``normal:MEAN:SD``,
+``lognormal:MEDIAN:SIGMA``. ``--key-latency`` gives keys ending in a given
+suffix their own profile, to check that latency-aware routing finds the fast
+keys (their calls are counted as ``key SUFFIX`` in /_stats). Non-streaming calls sleep one sample; streams
+sleep one sample before the first token, then emit at ``--tokens-per-sec``; a request's
+max_tokens (or maxOutputTokens) cuts the reply to that many words.
+429s come from ``--rate-limit-ratio`` (random) or ``--rpm`` (per key, per
+minute) and carry Retry-After and the provider's rate-limit headers.
+GET /_stats reports counts per provider; POST /_reset clears them.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = "the quick brown fox jumps over the lazy dog while a load test measures every hop".split()
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Sampler in seconds for a ``kind:args`` spec (milliseconds)"""
+    kind, *args = spec.split(":")
+    nums = [float(a) for a in args]
+    if kind == "fixed":
+        return lambda: nums[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(nums[0], nums[1]) / 1000
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(nums[0], nums[1])) / 1000
+    if kind == "lognormal":
+        mu = math.log(nums[0])
+        return lambda: random.lognormvariate(mu, nums[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+@dataclass
+class FakeConfig:
+    latency: str = "lognormal:600:0.5"
+    provider_latency: Dict[str, str] = field(default_factory=dict)
+    key_latency: Dict[str, str] = field(default_factory=dict)
+    tokens_per_sec: float = 80.0
+    reply_tokens: int = 60
+    rate_limit_ratio: float = 0.0
+    error_ratio: float = 0.0
+    rpm: int = 0
+    retry_after: float = 1.0
+
+
+class FakeProvider:
+    """Latency, rate limits and counters shared by all wire formats"""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.default_latency = parse_latency(config.latency)
+        self.latency = {name: parse_latency(spec) for name, spec in config.provider_latency.items()}
+        self.key_latency = {suffix: parse_latency(spec) for suffix, spec in config.key_latency.items()}
+        self.windows: Dict[str, deque] = defaultdict(deque)
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def key_profile(self, key: str) -> Optional[str]:
+        """The --key-latency suffix this key ends with, if any"""
+        for suffix in self.key_latency:
+            if key.endswith(suffix):
+                return suffix
+        return None
+
+    def sample_latency(self, provider: str, key: str = "") -> float:
+        suffix = self.key_profile(key)
+        if suffix is not None:
+            return self.key_latency[suffix]()
+        return self.latency.get(provider, self.default_latency)()
+
+    def admit(self, provider: str, key: str):
+        """(status, rate-limit headers); status is 200, 429 or 500"""
+        now = time.monotonic()
+        window = self.windows[f"{provider}:{key}"]
+        while window and now - window[0] > 60:
+            window.popleft()
+        limit = self.config.rpm
+        if limit and len(window) >= limit:
+            return 429, self.limit_headers(provider, limit, 0, 60 - (now - window[0]))
+        if random.random() < self.config.rate_limit_ratio:
+            return 429, self.limit_headers(provider, limit or 1000, 0, self.config.retry_after)
+        if random.random() < self.config.error_ratio:
+            return 500, {}
+        window.append(now)
+        if not limit:
+            return 200, {}
+        return 200, self.limit_headers(provider, limit, limit - len(window), 60 - (now - window[0]))
+
+    def limit_headers(self, provider: str, limit: int, remaining: int, reset: float) -> Dict[str, str]:
+        reset = max(reset, 0.0)
+        headers = {
+            "x-ratelimit-limit-requests": str(limit),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+        if remaining == 0:
+            headers["retry-after"] = str(max(1, math.ceil(reset)))
+        if provider.startswith("anthropic"):
+            reset_at = datetime.now(timezone.utc) + timedelta(seconds=reset)
+            headers.update({
+                "anthropic-ratelimit-requests-limit": str(limit),
+                "anthropic-ratelimit-requests-remaining": str(remaining),
+                "anthropic-ratelimit-requests-reset": reset_at.isoformat(timespec="seconds").replace("+00:00", "Z"),
+            })
+        return headers
+
+    def reply(self, model: str) -> str:
+        words = [random.choice(WORDS) for _ in range(self.config.reply_tokens)]
+        return f"[{model}] " + " ".join(words)
+
+    async def tokens(self, text: str):
+        """Words of ``text`` paced at the configured token rate"""
+        delay = 1.0 / self.config.tokens_per_sec if self.config.tokens_per_sec > 0 else 0.0
+        for i, word in enumerate(text.split(" ")):
+            if i and delay:
+                await asyncio.sleep(delay)
+            yield word if i == 0 else " " + word
+
+
+def prompt_tokens(payload) -> int:
+    return max(1, len(json.dumps(payload)) // 4)
+
+
+def output_limit(payload) -> Optional[int]:
+    """The request's cap on output tokens, in any of the wire formats"""
+    limit = payload.get("max_completion_tokens") or payload.get("max_tokens") \
+        or (payload.get("generationConfig") or {}).get("maxOutputTokens")
+    return int(limit) if limit else None
+
+
+def sse(data, event: str = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data)}\n\n"
+
+
+def openai_error(status: int):
+    if status == 429:
+        return {"error": {"message": "Rate limit reached (fake provider)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+    return {"error": {"message": "Internal error (fake provider)", "type": "server_error", "code": None}}
+
+
+def anthropic_error(status: int):
+    kind = "rate_limit_error" if status == 429 else "api_error"
+    return {"type": "error", "error": {"type": kind, "message": f"{kind} (fake provider)"}}
+
+
+def gemini_error(status: int):
+    if status == 429:
+        return {"error": {"code": 429, "message": "Resource has been exhausted (fake provider)", "status": "RESOURCE_EXHAUSTED"}}
+    return {"error": {"code": 500, "message": "Internal error (fake provider)", "status": "INTERNAL"}}
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    fake = FakeProvider(config)
+    app = FastAPI(title="Fake LLM provider")
+    app.state.fake = fake
+
+    @app.get("/_stats")
+    def stats():
+        return {name: dict(counts) for name, counts in fake.stats.items()}
+
+    @app.post("/_reset")
+    def reset():
+        fake.stats.clear()
+        fake.windows.clear()
+        return {"reset": True}
+
+    @app.post("/{provider}/{path:path}")
+    async def call(provider: str, path: str, request: Request):
+        payload = await request.json()
+        key = request.headers.get("authorization") or request.headers.get("x-api-key") \
+            or request.headers.get("x-goog-api-key") or request.query_params.get("key", "")
+        if path.endswith("chat/completions"):
+            wire, model, stream = "openai", payload.get("model", "fake"), bool(payload.get("stream"))
+        elif path.endswith("messages"):
+            wire, model, stream = "anthropic", payload.get("model", "fake"), bool(payload.get("stream"))
+        elif ":generateContent" in path or ":streamGenerateContent" in path:
+            wire, model = "gemini", path.rsplit("/", 1)[-1].split(":")[0]
+            stream = ":streamGenerateContent" in path
+        else:
+            return JSONResponse({"error": {"message": f"Unknown path {path}"}}, status_code=404)
+
+        counts = fake.stats[provider]
+        counts["requests"] += 1
+        status, headers = fake.admit(provider, key)
+        if status != 200:
+            counts[str(status)] += 1
+            error = {"openai": openai_error, "anthropic": anthropic_error, "gemini": gemini_error}[wire](status)
+            if status == 429:
+                headers.setdefault("retry-after", str(max(1, math.ceil(config.retry_after))))
+            return JSONResponse(error, status_code=status, headers=headers)
+        counts["streams" if stream else "completions"] += 1
+        suffix = fake.key_profile(key)
+        if suffix is not None:
+            counts[f"key {suffix}"] += 1
+
+        await asyncio.sleep(fake.sample_latency(provider, key))
+        text = fake.reply(model)
+        limit = output_limit(payload)
+        if limit:
+            # One word per token, so generation budgets shorten replies (and streams) here too
+            text = " ".join(text.split(" ")[:limit])
+        n_in, n_out = prompt_tokens(payload), len(text.split(" "))
+        if stream:
+            body = {"openai": openai_stream, "anthropic": anthropic_stream, "gemini": gemini_stream}[wire]
+            if wire == "gemini" and request.query_params.get("alt") != "sse":
+                body = gemini_stream_array
+            return StreamingResponse(body(fake, payload, model, text, n_in, n_out), media_type="text/event-stream", headers=headers)
+        body = {"openai": openai_completion, "anthropic": anthropic_message, "gemini": gemini_response}[wire]
+        result = body(model, text, n_in, n_out)
+        if provider.startswith("perplexity"):
+            result["citations"] = []
+        return JSONResponse(result, headers=headers)
+
+    return app
+
+
+def openai_completion(model, text, n_in, n_out):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": n_in, "completion_tokens": n_out, "total_tokens": n_in + n_out},
+    }
+
+
+async def openai_stream(fake, payload, model, text, n_in, n_out):
+    base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+    yield sse({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+    async for token in fake.tokens(text):
+        yield sse({**base, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+    yield sse({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+    if (payload.get("stream_options") or {}).get("include_usage"):
+        yield sse({**base, "choices": [], "usage": {"prompt_tokens": n_in, "completion_tokens": n_out, "total_tokens": n_in + n_out}})
+    yield "data: [DONE]\n\n"
+
+
+def anthropic_message(model, text, n_in, n_out):
+    return {
+        "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": model,
+        "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": n_in, "output_tokens": n_out},
+    }
+
+
+async def anthropic_stream(fake, payload, model, text, n_in, n_out):
+    message = {**anthropic_message(model, "", n_in, 1), "content": [], "stop_reason": None}
+    yield sse({"type": "message_start", "message": message}, "message_start")
+    yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+    async for token in fake.tokens(text):
+        yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}}, "content_block_delta")
+    yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+    yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": n_out}}, "message_delta")
+    yield sse({"type": "message_stop"}, "message_stop")
+
+
+def gemini_response(model, text, n_in, n_out, finished=True):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finished:
+        candidate["finishReason"] = "STOP"
+    return {
+        "candidates": [candidate],
+        "usageMetadata": {"promptTokenCount": n_in, "candidatesTokenCount": n_out, "totalTokenCount": n_in + n_out},
+        "modelVersion": model,
+    }
+
+
+async def gemini_stream(fake, payload, model, text, n_in, n_out):
+    """``alt=sse`` framing (the google-genai SDK)"""
+    count = len(text.split(" "))
+    i = 0
+    async for token in fake.tokens(text):
+        i += 1
+        yield sse(gemini_response(model, token, n_in, i, finished=i == count))
+
+
+async def gemini_stream_array(fake, payload, model, text, n_in, n_out):
+    """A streamed JSON array (google-api-core's REST transport, used by langchain-google-genai)"""
+    count = len(text.split(" "))
+    i = 0
+    async for token in fake.tokens(text):
+        i += 1
+        yield ("[" if i == 1 else ",\n") + json.dumps(gemini_response(model, token, n_in, i, finished=i == count))
+    yield "]"
+
+
+def base_urls(host: str) -> Dict[str, str]:
+    """<PROVIDER>_BASE_URL values that route every factory in constants.py here"""
+    return {
+        "OPENAI_BASE_URL": f"{host}/openai/v1",
+        "GROQ_BASE_URL": f"{host}/groq",
+        "DEEPSEEK_BASE_URL": f"{host}/deepseek/v1",
+        "PERPLEXITY_BASE_URL": f"{host}/perplexity",
+        "ANTHROPIC_BASE_URL": f"{host}/anthropic",
+        "GOOGLE_BASE_URL": f"{host}/google",
+    }
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default=FakeConfig.latency)
+    parser.add_argument("--provider-latency", action="append", default=[], metavar="NAME=SPEC",
+                        help="per-provider override, e.g. anthropic=lognormal:1200:0.4 (repeatable)")
+    parser.add_argument("--key-latency", action="append", default=[], metavar="SUFFIX=SPEC",
+                        help="override for keys ending in SUFFIX, e.g. openai-3=fixed:2000 (repeatable)")
+    parser.add_argument("--tokens-per-sec", type=float, default=FakeConfig.tokens_per_sec)
+    parser.add_argument("--reply-tokens", type=int, default=FakeConfig.reply_tokens)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--error-ratio", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute per key before 429s (0 = unlimited)")
+    parser.add_argument("--retry-after", type=float, default=FakeConfig.retry_after)
+    args = parser.parse_args()
+    config = FakeConfig(
+        latency=args.latency,
+        provider_latency=dict(item.split("=", 1) for item in args.provider_latency),
+        key_latency=dict(item.split("=", 1) for item in args.key_latency),
+        tokens_per_sec=args.tokens_per_sec,
+        reply_tokens=args.reply_tokens,
+        rate_limit_ratio=args.rate_limit_ratio,
+        error_ratio=args.error_ratio,
+        rpm=args.rpm,
+        retry_after=args.retry_after,
+    )
+    for name, value in base_urls(f"http://{args.host}:{args.port}").items():
+        print(f"{name}={value}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
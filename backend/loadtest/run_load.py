@@ -0,0 +1,285 @@
+"""Drive /chat, /history, /preprocess and the session endpoints at a fixed concurrency.
+
+Against a running backend (already pointed at fake_provider.py):
+
+    python loadtest/run_load.py --target http://127.0.0.1:8000 --concurrency 32 --duration 60
+
+Or let it start both the fake provider and the backend (``uvicorn server:app``)
+with every provider routed to the fake; MONGO_URI should point at a scratch database:
+
+    python loadtest/run_load.py --spawn --fake-args="--latency lognormal:600:0.5 --rate-limit-ratio 0.02"
+
+Each worker loops over the weighted ``--mix`` until the deadline; results from
+the ``--warmup`` period are dropped. Reports throughput, error counts and
+p50/p95/p99 per endpoint. As a regression gate, save a baseline with ``--save``
+and later run with ``--baseline``: the exit status is 1 if throughput falls or
+any endpoint's p95 rises by more than ``--max-regression``, or if the error
+rate grows by more than one percentage point.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadtest.fake_provider import base_urls  # noqa: E402
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEY_VARS = ["OPENAI_API_KEY", "GOOGLE_API_KEY", "GROQ_API_KEY", "ANTHROPIC_API_KEY", "DEEPSEEK_API_KEY", "PPLX_API_KEY"]
+QUESTIONS = [
+    "Summarise the attached document in three bullet points.",
+    "What are the trade-offs between a B-tree and an LSM tree?",
+    "Draft a polite reply declining a meeting invitation.",
+    "Explain the difference between p95 and p99 latency.",
+    "Which sections of the document mention the budget?",
+]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def make_pdfs(count: int, pages: int) -> List[bytes]:
+    """Distinct small text PDFs so uploads exercise parsing rather than the content cache"""
+    import fitz
+    pdfs = []
+    for n in range(count):
+        doc = fitz.open()
+        for p in range(pages):
+            page = doc.new_page()
+            text = "\n".join(f"Doc {n} ({uuid.uuid4().hex[:8]}) page {p} line {i}: the budget review covers latency and cost."
+                             for i in range(40))
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=8)
+        pdfs.append(doc.tobytes())
+    return pdfs
+
+
+class LoadRun:
+    """Shared state for one run: session pool, payloads and per-endpoint samples"""
+
+    def __init__(self, args):
+        self.args = args
+        self.models = dict(item.split("=", 1) for item in args.models.split(","))
+        self.mix = [(name, float(weight)) for name, weight in (item.split("=") for item in args.mix.split(","))]
+        self.account = args.account
+        self.sessions: List[str] = []
+        self.pdfs: List[bytes] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.recording = False
+
+    async def setup(self, client: httpx.AsyncClient):
+        for i in range(self.args.sessions):
+            self.sessions.append(await self.create_session(client, f"loadtest {i}"))
+        if any(name == "preprocess" for name, _ in self.mix):
+            self.pdfs = await asyncio.to_thread(make_pdfs, self.args.pdf_pool, self.args.pdf_pages)
+
+    async def create_session(self, client: httpx.AsyncClient, name: str) -> str:
+        resp = await client.post("/session/create", json={"account_id": self.account, "session_name": name})
+        resp.raise_for_status()
+        return resp.json()["session_id"]
+
+    async def request(self, client: httpx.AsyncClient, name: str) -> httpx.Response:
+        session_id = random.choice(self.sessions)
+        if name == "chat":
+            return await client.post("/chat", json={
+                "user_query": random.choice(QUESTIONS), "selected_models": self.models, "session_id": session_id,
+            })
+        if name == "history":
+            return await client.get(f"/history/{session_id}")
+        if name == "preprocess":
+            files = {"file": (f"load-{uuid.uuid4().hex[:6]}.pdf", random.choice(self.pdfs), "application/pdf")}
+            return await client.post("/preprocess", params={"session_id": session_id}, files=files)
+        if name == "sessions":
+            return await client.get(f"/session/{self.account}")
+        if name == "session_create":
+            return await client.post("/session/create", json={"account_id": self.account, "session_name": "loadtest extra"})
+        raise ValueError(f"Unknown scenario {name}")
+
+    async def worker(self, client: httpx.AsyncClient, deadline: float):
+        names = [name for name, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = str((await self.request(client, name)).status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if self.recording:
+                self.latencies[name].append(elapsed)
+                self.statuses[name][status] += 1
+
+    async def run(self) -> Dict:
+        args = self.args
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=args.target, timeout=args.timeout, limits=limits) as client:
+            await self.setup(client)
+            start = time.monotonic()
+            deadline = start + args.warmup + args.duration
+            workers = [asyncio.create_task(self.worker(client, deadline)) for _ in range(args.concurrency)]
+            await asyncio.sleep(args.warmup)
+            self.recording = True
+            measured_from = time.monotonic()
+            await asyncio.gather(*workers)
+            elapsed = time.monotonic() - measured_from
+        return self.summary(elapsed)
+
+    def summary(self, elapsed: float) -> Dict:
+        endpoints = {}
+        total = errors = 0
+        for name, values in sorted(self.latencies.items()):
+            values.sort()
+            failed = sum(n for status, n in self.statuses[name].items() if not status.startswith("2"))
+            total += len(values)
+            errors += failed
+            endpoints[name] = {
+                "requests": len(values),
+                "errors": failed,
+                "rps": round(len(values) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+                "statuses": dict(self.statuses[name]),
+            }
+        return {
+            "concurrency": self.args.concurrency,
+            "duration_s": round(elapsed, 1),
+            "requests": total,
+            "rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "endpoints": endpoints,
+        }
+
+
+def print_report(result: Dict, fake_stats: Optional[Dict]):
+    print(f"\n{result['requests']} requests in {result['duration_s']}s at concurrency {result['concurrency']}: "
+          f"{result['rps']} req/s, error rate {result['error_rate'] * 100:.2f}%")
+    print(f"{'endpoint':<16}{'req':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, e in result["endpoints"].items():
+        print(f"{name:<16}{e['requests']:>7}{e['errors']:>6}{e['rps']:>9}{e['p50_ms']:>10}{e['p95_ms']:>10}{e['p99_ms']:>10}{e['max_ms']:>10}")
+    if fake_stats:
+        print("fake provider:", json.dumps(fake_stats))
+
+
+def compare(result: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """Regressions beyond the allowed fraction, as messages"""
+    problems = []
+    if result["rps"] < baseline["rps"] * (1 - max_regression):
+        problems.append(f"throughput {result['rps']} req/s vs baseline {baseline['rps']}")
+    if result["error_rate"] > baseline["error_rate"] + 0.01:
+        problems.append(f"error rate {result['error_rate']:.2%} vs baseline {baseline['error_rate']:.2%}")
+    for name, e in result["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if base and e["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+            problems.append(f"{name} p95 {e['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+    return problems
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def spawn(args) -> List[subprocess.Popen]:
+    """Start the fake provider and a backend routed to it; sets args.target"""
+    fake_port, api_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake = subprocess.Popen([sys.executable, os.path.join(BACKEND, "loadtest", "fake_provider.py"), "--port", str(fake_port),
+                             *shlex.split(args.fake_args)], cwd=BACKEND, stdout=subprocess.DEVNULL)
+    env = dict(os.environ, **base_urls(fake_url))
+    for var in KEY_VARS:
+        for i in range(1, args.keys_per_provider + 1):
+            env[f"{var}_{i}"] = f"loadtest-{var.lower()}-{i}"
+    env.setdefault("LOG_LEVEL", "WARNING")
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--port", str(api_port), "--log-level", "warning",
+                            "--no-access-log"], cwd=BACKEND, env=env)
+    procs = [fake, api]
+    try:
+        wait_for(f"{fake_url}/_stats")
+        wait_for(f"http://127.0.0.1:{api_port}/health")
+    except Exception:
+        for proc in procs:
+            proc.terminate()
+        raise
+    args.target = f"http://127.0.0.1:{api_port}"
+    args.fake_url = fake_url
+    return procs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake-url", default=None, help="fake provider to read /_stats from after the run")
+    parser.add_argument("--spawn", action="store_true", help="start fake_provider.py and the backend locally")
+    parser.add_argument("--fake-args", default="", help="extra fake_provider.py arguments when spawning")
+    parser.add_argument("--keys-per-provider", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--mix", default="chat=6,history=2,preprocess=1,sessions=1,session_create=1")
+    parser.add_argument("--models", default="OpenAI=gpt-4o-mini,Google=gemini-2.0-flash,Anthropic=claude-3-5-haiku-latest")
+    parser.add_argument("--sessions", type=int, default=20, help="sessions created up front and shared by the workers")
+    parser.add_argument("--account", default="loadtest@example.com")
+    parser.add_argument("--pdf-pages", type=int, default=5)
+    parser.add_argument("--pdf-pool", type=int, default=20)
+    parser.add_argument("--save", help="write the result JSON here")
+    parser.add_argument("--baseline", help="compare against a result saved with --save")
+    parser.add_argument("--max-regression", type=float, default=0.15)
+    args = parser.parse_args()
+
+    procs = spawn(args) if args.spawn else []
+    try:
+        result = asyncio.run(LoadRun(args).run())
+        fake_stats = httpx.get(f"{args.fake_url}/_stats").json() if args.fake_url else None
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=30)
+    print_report(result, fake_stats)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.max_regression)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+# Attributes every LogRecord has; anything else came in through `extra=` and is emitted as a field
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+# Provider key shapes (OpenAI/DeepSeek, Anthropic, Groq, Perplexity, Google) and bearer tokens
+_SECRET_RE = re.compile(r"(sk-ant-[\w-]{8,}|sk-[\w-]{16,}|gsk_\w{16,}|pplx-\w{16,}|AIza[\w-]{30,}|Bearer\s+[\w.\-]{16,})")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _parse_pairs(spec: str) -> Dict[str, str]:
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    pairs = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of high-volume events: records with extra={"event": name} use LOG_SAMPLE_RATES[name]"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class TraceContextFilter(logging.Filter):
+    """Stamps the active trace/span ids so log lines join up with /traces/recent"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Looked up lazily: tracing may still be importing (it logs from Tracer.__init__)
+        tracer = getattr(sys.modules.get("tracing"), "tracer", None)
+        span = tracer.current() if tracer is not None else None
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        return True
+
+
+class RedactionFilter(logging.Filter):
+    """Masks message content fields and anything shaped like a provider key (runs on the listener thread)"""
+
+    def __init__(self, fields, keep_content: bool = False):
+        super().__init__()
+        self.fields = frozenset(fields)
+        self.keep_content = keep_content
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.msg, str):
+            record.msg = _SECRET_RE.sub("[REDACTED]", record.msg)
+        if not self.keep_content:
+            for field in self.fields:
+                value = record.__dict__.get(field)
+                if value is not None:
+                    record.__dict__[field] = f"[redacted {len(str(value))} chars]"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the record's `extra` fields inlined"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and key not in entry:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    """Route all logging through a queue to a background writer thread; safe to call more than once
+
+    LOG_LEVEL sets the root level and LOG_LEVELS overrides per module
+    (``constants=WARNING,httpx=WARNING``). LOG_FORMAT is ``json`` or ``text``.
+    Records are filtered and queued on the calling thread; redaction,
+    formatting and the write happen on the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    load_dotenv()
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for name, level in _parse_pairs(os.getenv("LOG_LEVELS", "httpx=WARNING")).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    output = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "json").lower() == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    redact_fields = os.getenv("LOG_REDACT_FIELDS", "content,messages,prompt,response,query,user_query,api_key,authorization,account_id")
+    output.addFilter(RedactionFilter(
+        [f.strip() for f in redact_fields.split(",") if f.strip()],
+        keep_content=os.getenv("LOG_CONTENT", "false").lower() in ("1", "true", "yes"),
+    ))
+
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter({k: float(v) for k, v in _parse_pairs(os.getenv("LOG_SAMPLE_RATES", "key_selected=0.01")).items()}))
+    handler.addFilter(TraceContextFilter())
+
+    # Replace whatever basicConfig() installed so nothing writes synchronously
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Drain queued records; called at exit"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,399 @@
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from pymongo import monitoring
+
+from api_key_manager import api_key_manager
+from cancellation import is_cancelled
+
+# Prometheus text exposition, without the client library. Values are per process:
+# scrape every uvicorn worker (or run one worker per container) to see them all.
+
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 120.0)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LLM_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self.header()
+        for key, row in items:
+            for bound, count in zip(self.buckets, row):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {row[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {row[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds metrics and scrape-time collectors, and renders the text exposition format"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LLM_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, fn: Callable[[], None]):
+        """`fn` runs before each scrape, typically to refresh gauges from another component's stats"""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception:
+                pass  # a broken collector must not take the whole endpoint down
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+llm_latency = registry.histogram(
+    "llm_request_duration_seconds", "Provider call latency", ("provider", "model"))
+llm_ttft = registry.histogram(
+    "llm_time_to_first_token_seconds", "Time to first streamed token", ("provider", "model"))
+llm_tokens = registry.counter(
+    "llm_tokens_total", "Tokens reported by providers: input, output, and the part of input read from or written to a prompt cache", ("provider", "model", "direction"))
+llm_requests = registry.counter(
+    "llm_requests_total", "Provider calls by outcome", ("provider", "model", "key_id", "outcome"))
+llm_in_flight = registry.gauge(
+    "llm_requests_in_flight", "Provider calls currently running", ("provider",))
+http_latency = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"), HTTP_BUCKETS)
+http_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("route",))
+http_compressed_bytes = registry.counter(
+    "http_compressed_bytes_total", "Response bytes before (raw) and after (sent) compression", ("encoding", "stage"))
+mongo_latency = registry.histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("command",), MONGO_BUCKETS)
+mongo_failures = registry.counter(
+    "mongo_command_failures_total", "MongoDB commands that failed", ("command",))
+cache_hit_ratio = registry.gauge(
+    "cache_hit_ratio", "Hit ratio of in-process caches", ("cache",))
+cache_entries = registry.gauge(
+    "cache_entries", "Entries held by in-process caches", ("cache",))
+queue_depth = registry.gauge(
+    "queue_depth", "Items waiting in background queues", ("queue", "state"))
+scheduler_requests = registry.counter(
+    "scheduler_requests_total", "Scheduler decisions: admitted, delayed (admitted after waiting) or rejected", ("priority", "outcome"))
+scheduler_rejections = registry.counter(
+    "scheduler_rejections_total", "Requests the scheduler turned away", ("priority", "reason"))
+scheduler_wait = registry.histogram(
+    "scheduler_wait_seconds", "Time spent queued before admission", ("priority",), HTTP_BUCKETS)
+scheduler_in_flight = registry.gauge(
+    "scheduler_in_flight", "Admitted provider-call slots in use", ("priority",))
+scheduler_waiting = registry.gauge(
+    "scheduler_waiting", "Requests queued for admission", ("priority",))
+request_cancellations = registry.counter(
+    "request_cancellations_total", "Requests whose client disconnected before the answer, by the phase they were in", ("route", "phase"))
+race_branches = registry.counter(
+    "race_branches_total", "Race-mode /chat branches: won, also_completed, rejected (error or empty) or cancelled", ("model", "outcome"))
+provider_hedges = registry.counter(
+    "llm_hedges_total", "Backup provider calls: won, lost (first call finished first), failed, or not fired (over_budget, no_key)", ("provider", "outcome"))
+ws_connections = registry.gauge(
+    "ws_connections", "Open /ws chat channels")
+ws_turns = registry.counter(
+    "ws_turns_total", "Turns over /ws chat channels: completed, failed, cancelled, rejected (scheduler) or busy (one was already running)", ("outcome",))
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """True for provider 429s, whichever SDK raised them"""
+    if getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429:
+        return True
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    return name in ("RateLimitError", "ResourceExhausted") or "429" in str(error)[:200]
+
+
+class ProviderMetricsCallback(BaseCallbackHandler):
+    """Times every chat model call and reports tokens, errors and 429s per provider, model and key
+
+    Attached by the factories in constants.py. Outcomes are also fed to the
+    APIKeyManager: successes with their token counts, 429s as errors so the
+    key rotation backs off a throttled key, and every call's latency for
+    latency-aware key selection.
+    """
+
+    def __init__(self, provider, key_id: str, model: str):
+        self.provider = provider
+        self.key_id = key_id
+        self.model = model
+        self._runs: Dict[UUID, list] = {}  # run_id -> [start, first_token_seen]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        self._runs[run_id] = [time.perf_counter(), False]
+        llm_in_flight.inc(provider=self.provider.value)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self.on_chat_model_start(serialized, prompts, run_id=run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        run = self._runs.get(run_id)
+        if run and not run[1]:
+            run[1] = True
+            llm_ttft.observe(time.perf_counter() - run[0], provider=self.provider.value, model=self.model)
+
+    def _finish(self, run_id: UUID) -> Optional[float]:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        llm_in_flight.dec(provider=self.provider.value)
+        elapsed = time.perf_counter() - run[0]
+        llm_latency.observe(elapsed, provider=self.provider.value, model=self.model)
+        return elapsed
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        elapsed = self._finish(run_id)
+        if elapsed is not None:
+            api_key_manager.record_latency(self.provider, self.key_id, self.model, elapsed, success=True)
+        input_tokens, output_tokens = token_usage(response)
+        labels = {"provider": self.provider.value, "model": self.model}
+        if input_tokens:
+            llm_tokens.inc(input_tokens, direction="input", **labels)
+        if output_tokens:
+            llm_tokens.inc(output_tokens, direction="output", **labels)
+        # Prompt-cache hits and writes; these are also counted in input
+        for direction, tokens in cache_usage(response).items():
+            llm_tokens.inc(tokens, direction=direction, **labels)
+        llm_requests.inc(key_id=self.key_id, outcome="success", **labels)
+        api_key_manager.record_request(self.provider, self.key_id, tokens=input_tokens + output_tokens, success=True)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        elapsed = self._finish(run_id)
+        if is_cancelled():
+            # Aborted by us because the client left; says nothing about the key's health
+            llm_requests.inc(provider=self.provider.value, model=self.model, key_id=self.key_id, outcome="cancelled")
+            return
+        if elapsed is not None:
+            api_key_manager.record_latency(self.provider, self.key_id, self.model, elapsed, success=False)
+        rate_limited = is_rate_limit_error(error)
+        llm_requests.inc(
+            provider=self.provider.value, model=self.model, key_id=self.key_id,
+            outcome="rate_limited" if rate_limited else "error",
+        )
+        if rate_limited:
+            api_key_manager.record_request(self.provider, self.key_id, success=False)
+
+
+def token_usage(response: LLMResult) -> Tuple[int, int]:
+    """(input, output) tokens from a chat result, whichever way the provider reported them"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("token_usage") or (response.llm_output or {}).get("usage") or {}
+    return (
+        usage.get("prompt_tokens", usage.get("input_tokens", 0)) or 0,
+        usage.get("completion_tokens", usage.get("output_tokens", 0)) or 0,
+    )
+
+
+def cache_usage(response: LLMResult) -> Dict[str, int]:
+    """Input tokens read from / written to the provider's prompt cache, when it reports them"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            details = (usage or {}).get("input_token_details") or {}
+            counts = {"cache_read": details.get("cache_read") or 0, "cache_write": details.get("cache_creation") or 0}
+            return {direction: tokens for direction, tokens in counts.items() if tokens}
+    return {}
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records the latency of every MongoDB command issued by any client in this process"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_latency.observe(event.duration_micros / 1e6, command=event.command_name)
+        mongo_failures.inc(command=event.command_name)
+
+
+# Applies to MongoClients created after this import, so import metrics before building any client
+monitoring.register(MongoCommandMetrics())
+
+
+def observe_cache(name: str, stats: Dict[str, Any]):
+    """Publish an LRUCache.stats()-shaped dict"""
+    cache_hit_ratio.set(stats.get("hit_ratio") or 0.0, cache=name)
+    cache_entries.set(stats.get("entries", 0), cache=name)
+
+
+def observe_queue(name: str, depths: Iterable[Tuple[str, int]]):
+    for state, depth in depths:
+        queue_depth.set(depth, queue=name, state=state)
+
+
+def _route_template(app, scope) -> str:
+    """Path template of the matching route, so ids in URLs don't explode label cardinality"""
+    from starlette.routing import Match
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """HTTP latency and in-flight tracking as plain ASGI middleware
+
+    Not @app.middleware("http"): BaseHTTPMiddleware hides the client's
+    http.disconnect from the endpoint, which /chat needs to see to cancel work.
+    """
+
+    def __init__(self, app, fastapi_app):
+        self.app = app
+        self.fastapi_app = fastapi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = _route_template(self.fastapi_app, scope)
+        if route == "/metrics":
+            return await self.app(scope, receive, send)
+        status = "500"
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        http_in_flight.inc(route=route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec(route=route)
+            http_latency.observe(time.perf_counter() - start, method=scope["method"], route=route, status=status)
+
+
+def instrument_app(app):
+    """Add HTTP latency/in-flight tracking and a /metrics endpoint to a FastAPI app"""
+    from fastapi.responses import PlainTextResponse
+
+    app.add_middleware(RequestMetricsMiddleware, fastapi_app=app)
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,362 @@
+import io
+import os
+import json
+import math
+import base64
+import logging
+import asyncio
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, UploadFile
+
+import fitz  # PyMuPDF
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as uploaded
+    Image = None
+
+from preprocess_cache import preprocess_cache
+
+logger = logging.getLogger(__name__)
+
+# Server-side ceilings; a request may ask for less but never more
+PREPROCESS_MAX_BYTES = int(os.getenv("PREPROCESS_MAX_BYTES", str(50 * 1024 * 1024)))
+PREPROCESS_MAX_PAGES = int(os.getenv("PREPROCESS_MAX_PAGES", "2000"))
+
+# Documents shorter than this are parsed in a thread; longer ones are split across processes
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(os.cpu_count() or 1, 8))))
+# Upper bound on pages per work unit, so streamed output arrives in steady increments
+PDF_MAX_PAGES_PER_CHUNK = int(os.getenv("PDF_MAX_PAGES_PER_CHUNK", "32"))
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Vision input: OpenAI fits images into 2048x2048 and then scales the short side to 768,
+# so anything larger is upload bytes the model never looks at.
+VISION_MODEL = os.getenv("VISION_MODEL", "gpt-4o-mini")
+VISION_MAX_LONG_SIDE = int(os.getenv("VISION_MAX_LONG_SIDE", "2048"))
+VISION_MAX_SHORT_SIDE = int(os.getenv("VISION_MAX_SHORT_SIDE", "768"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "6"))
+VISION_PROMPT = "Describe this image clearly under 120 words."
+
+Buffer = Union[bytes, bytearray]
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Lazily start the shared PDF worker pool"""
+    global _pdf_pool
+    if _pdf_pool is None:
+        # spawn: forking a process that already runs Mongo/uvicorn threads is not safe
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+def resolve_budget(max_pages: Optional[int], max_bytes: Optional[int]) -> Tuple[int, int]:
+    """Clamp a per-request budget to the server ceilings"""
+    pages = min(max_pages, PREPROCESS_MAX_PAGES) if max_pages and max_pages > 0 else PREPROCESS_MAX_PAGES
+    size = min(max_bytes, PREPROCESS_MAX_BYTES) if max_bytes and max_bytes > 0 else PREPROCESS_MAX_BYTES
+    return pages, size
+
+
+async def read_upload(file: UploadFile, max_bytes: int) -> bytearray:
+    """Read an upload into memory in chunks, rejecting it as soon as it exceeds max_bytes"""
+    data = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        if len(data) + len(chunk) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes} byte limit")
+        data += chunk
+    return data
+
+
+def image_data_url(data: Buffer, mime_type: str) -> str:
+    """Base64 data URL built straight from the in-memory upload"""
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def sniff_image_mime(data: Buffer, fallback: str = "image/jpeg") -> str:
+    """MIME type from the file's magic bytes rather than its name"""
+    head = bytes(data[:12])
+    for signature, mime in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return fallback
+
+
+def _vision_scale(width: int, height: int) -> float:
+    scale = min(1.0, VISION_MAX_LONG_SIDE / max(width, height))
+    if min(width, height) * scale > VISION_MAX_SHORT_SIDE:
+        scale = VISION_MAX_SHORT_SIDE / min(width, height)
+    return scale
+
+
+def prepare_image(data: Buffer, fallback_mime: str = "image/jpeg") -> Tuple[Buffer, str]:
+    """Downscale to the vision model's working resolution and re-encode with the right MIME type
+
+    Images already within bounds in a format the API accepts are passed through
+    untouched. Returns (bytes, mime_type).
+    """
+    mime = sniff_image_mime(data, fallback_mime)
+    if Image is None:
+        return data, mime
+    try:
+        img = Image.open(io.BytesIO(data))
+        width, height = img.size
+        scale = _vision_scale(width, height)
+        if scale >= 1.0 and mime in ("image/jpeg", "image/png", "image/webp"):
+            return data, mime
+        # Lets libjpeg decode at 1/2, 1/4 or 1/8 size directly, the bulk of the saving on photos
+        img.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        scale = _vision_scale(width, height)
+        if scale < 1.0:
+            img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img.save(out, "PNG", optimize=True)
+            return out.getvalue(), "image/png"
+        img.convert("RGB").save(out, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+        return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed, sending original: {e}")
+        return data, mime
+
+
+def describe_images(client, images: List[Tuple[Buffer, str]]) -> List[str]:
+    """Vision descriptions for prepared (bytes, mime) images, several per request
+
+    Returns one string per image; "" for any image the model couldn't describe,
+    matching the single-image graceful-degrade behaviour.
+    """
+    if not client or not images:
+        return [""] * len(images)
+    results: List[str] = []
+    for i in range(0, len(images), max(VISION_BATCH_SIZE, 1)):
+        batch = images[i:i + max(VISION_BATCH_SIZE, 1)]
+        content = [{"type": "image_url", "image_url": {"url": image_data_url(data, mime)}} for data, mime in batch]
+        try:
+            if len(batch) == 1:
+                resp = client.chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=[{"role": "user", "content": [{"type": "text", "text": VISION_PROMPT}] + content}],
+                )
+                results.append((resp.choices[0].message.content or "").strip())
+                continue
+            prompt = (
+                f"You are given {len(batch)} images. {VISION_PROMPT.replace('this image', 'each image')} "
+                f'Respond with JSON: {{"descriptions": [...]}} containing exactly {len(batch)} strings, in image order.'
+            )
+            resp = client.chat.completions.create(
+                model=VISION_MODEL,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}] + content}],
+                response_format={"type": "json_object"},
+            )
+            descriptions = json.loads(resp.choices[0].message.content or "{}").get("descriptions", [])
+            descriptions = [str(d).strip() for d in descriptions][:len(batch)]
+            results.extend(descriptions + [""] * (len(batch) - len(descriptions)))
+        except Exception as e:
+            logger.warning(f"Vision request for {len(batch)} image(s) failed: {e}")
+            results.extend([""] * len(batch))
+    return results
+
+
+def open_pdf(data: Buffer) -> "fitz.Document":
+    return fitz.open(stream=data, filetype="pdf")
+
+
+def pdf_page_count(data: Buffer) -> int:
+    with open_pdf(data) as doc:
+        return doc.page_count
+
+
+def extract_page_range(data: Buffer, start: int, stop: int) -> List[str]:
+    """Text of pages [start, stop)"""
+    with open_pdf(data) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+# Per worker process: the document currently being split, keyed by shared memory name
+_worker_docs: Dict[str, "fitz.Document"] = {}
+
+
+def extract_shared_range(shm_name: str, size: int, start: int, stop: int) -> List[str]:
+    """Pool worker entry point: parse a page range of a document held in shared memory
+
+    Each worker copies the document out of shared memory once and keeps it open
+    for the remaining ranges, instead of the parent pickling it for every range.
+    """
+    doc = _worker_docs.get(shm_name)
+    if doc is None:
+        for stale in _worker_docs.values():
+            stale.close()
+        _worker_docs.clear()
+        shm = SharedMemory(name=shm_name)
+        try:
+            doc = open_pdf(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+        _worker_docs[shm_name] = doc
+    return [doc[i].get_text() for i in range(start, stop)]
+
+
+def plan_page_ranges(page_count: int, workers: int = PDF_WORKERS) -> List[Tuple[int, int]]:
+    """Split pages into contiguous ranges: roughly one per worker, capped for streaming"""
+    if page_count <= 0:
+        return []
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        return [(0, page_count)]
+    size = min(math.ceil(page_count / max(workers, 1)), PDF_MAX_PAGES_PER_CHUNK)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+async def iter_pdf_pages(data: Buffer, pages: int) -> AsyncIterator[Tuple[int, str]]:
+    """Yield (page_index, text) for the first `pages` pages, in order, off the event loop"""
+    loop = asyncio.get_running_loop()
+    ranges = plan_page_ranges(pages)
+    if len(ranges) <= 1:
+        for start, stop in ranges:
+            texts = await asyncio.to_thread(extract_page_range, data, start, stop)
+            for offset, text in enumerate(texts):
+                yield start + offset, text
+        return
+
+    pool = get_pdf_pool()
+    shm = SharedMemory(create=True, size=len(data))
+    futures = []
+    try:
+        shm.buf[:len(data)] = data
+        futures = [
+            loop.run_in_executor(pool, extract_shared_range, shm.name, len(data), start, stop)
+            for start, stop in ranges
+        ]
+        for (start, _), future in zip(ranges, futures):
+            for offset, text in enumerate(await future):
+                yield start + offset, text
+    finally:
+        # Client went away or a range failed: don't keep workers busy on the rest
+        for future in futures:
+            future.cancel()
+        shm.close()
+        shm.unlink()
+
+
+async def _cached_pdf_pages(key: Optional[str], pages: int) -> Optional[List[str]]:
+    """First `pages` page texts from the cache, if a cached extraction covers them"""
+    cached = await preprocess_cache.aget(key) if key else None
+    if cached and cached.get("kind") == "pdf" and len(cached["pages"]) >= pages:
+        return cached["pages"][:pages]
+    return None
+
+
+async def _store_pdf_pages(key: Optional[str], pages: List[str], total: int):
+    if not key:
+        return
+    cached = await preprocess_cache.aget(key)
+    if cached and cached.get("kind") == "pdf" and len(cached["pages"]) >= len(pages):
+        return
+    await preprocess_cache.aset(key, {"kind": "pdf", "pages": pages, "total_pages": total})
+
+
+async def extract_pdf_pages(data: Buffer, max_pages: int = PREPROCESS_MAX_PAGES, key: Optional[str] = None) -> Tuple[List[str], int]:
+    """Return (page_texts, total_pages), reusing a cached extraction of the same bytes"""
+    total = await asyncio.to_thread(pdf_page_count, data)
+    pages = min(total, max_pages)
+    parts = await _cached_pdf_pages(key, pages)
+    if parts is None:
+        parts = [text async for _, text in iter_pdf_pages(data, pages)]
+        await _store_pdf_pages(key, parts, total)
+    return parts, total
+
+
+async def extract_text_from_pdf(data: Buffer, max_pages: int = PREPROCESS_MAX_PAGES, key: Optional[str] = None) -> Tuple[str, int, int]:
+    """Return (text, pages_extracted, total_pages)"""
+    parts, total = await extract_pdf_pages(data, max_pages, key)
+    return "".join(parts).strip(), len(parts), total
+
+
+async def stream_pdf_ndjson(
+    data: Buffer,
+    max_pages: int = PREPROCESS_MAX_PAGES,
+    key: Optional[str] = None,
+    on_complete: Optional[Callable[[List[str]], dict]] = None,
+) -> AsyncIterator[bytes]:
+    """NDJSON stream: one {"page", "text"} line per page, then a {"done"} summary line
+
+    ``on_complete`` runs in a thread with all page texts once extraction finishes;
+    whatever it returns is merged into the summary line.
+    """
+    try:
+        total = await asyncio.to_thread(pdf_page_count, data)
+        pages = min(total, max_pages)
+        cached = await _cached_pdf_pages(key, pages)
+        if cached is not None:
+            parts = cached
+            for index, text in enumerate(cached):
+                yield (json.dumps({"page": index + 1, "text": text}) + "\n").encode("utf-8")
+        else:
+            parts = []
+            async for index, text in iter_pdf_pages(data, pages):
+                parts.append(text)
+                yield (json.dumps({"page": index + 1, "text": text}) + "\n").encode("utf-8")
+            await _store_pdf_pages(key, parts, total)
+        summary = {"done": True, "pages": pages, "total_pages": total}
+        if key:
+            summary["content_hash"] = key
+        if pages < total:
+            summary["note"] = "truncated_to_max_pages"
+        if on_complete:
+            summary.update(await asyncio.to_thread(on_complete, parts) or {})
+        yield (json.dumps(summary) + "\n").encode("utf-8")
+    except Exception as e:
+        yield (json.dumps({"error": str(e)}) + "\n").encode("utf-8")
+
+
+def cached_payload(key: str, max_pages: int = PREPROCESS_MAX_PAGES) -> Optional[dict]:
+    """/preprocess response for content that was already processed, or None"""
+    cached = preprocess_cache.get(key)
+    if not cached:
+        return None
+    payload = {"content_hash": key}
+    if cached.get("kind") == "pdf":
+        pages = cached["pages"][:max_pages]
+        payload["extracted_text"] = "".join(pages).strip()
+        if len(pages) < cached["total_pages"]:
+            payload["note"] = "truncated_to_max_pages"
+    else:
+        payload["extracted_text"] = cached.get("text", "")
+    return payload
+
+
+def cached_pages(key: str, max_pages: int = PREPROCESS_MAX_PAGES) -> Optional[List[str]]:
+    """Page texts of an already-processed upload (an image is one page), or None"""
+    cached = preprocess_cache.get(key)
+    if not cached:
+        return None
+    if cached.get("kind") == "pdf":
+        return cached["pages"][:max_pages]
+    return [cached.get("text", "")]
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def hash_content(data) -> str:
+    """Content address of an upload"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _result_size(result: Dict[str, Any]) -> int:
+    return 256 + sum(len(p) for p in result.get("pages", [])) + len(result.get("text", ""))
+
+
+class PreprocessCache:
+    """Content-addressed cache of /preprocess results: a memory LRU over a bounded disk tier
+
+    Results are keyed by the SHA-256 of the uploaded bytes. PDFs are stored per
+    page (``{"kind": "pdf", "pages": [...], "total_pages": n}``) so a cached
+    extraction can serve any page budget up to the number of pages it holds;
+    images are stored as ``{"kind": "image", "text": ...}``.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("PREPROCESS_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.memory = LRUCache(
+            max_entries=int(os.getenv("PREPROCESS_CACHE_MAX_ENTRIES", "512")),
+            max_bytes=int(os.getenv("PREPROCESS_CACHE_MEMORY_MB", "128")) * 1024 * 1024,
+            sizeof=_result_size,
+        )
+        self.disk_dir = os.getenv("PREPROCESS_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "allai-preprocess-cache")
+        self.disk_max_bytes = int(os.getenv("PREPROCESS_CACHE_DISK_MB", "1024")) * 1024 * 1024
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict()  # hash -> file size, oldest first
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._disk_ready = False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self):
+        """Rebuild the size index from what is already on disk, oldest first"""
+        if self._disk_ready:
+            return
+        entries = []
+        if os.path.isdir(self.disk_dir):
+            for root, _, files in os.walk(self.disk_dir):
+                for name in files:
+                    if name.endswith(".json"):
+                        st = os.stat(os.path.join(root, name))
+                        entries.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_bytes += size
+        self._disk_ready = True
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        # Keys come from clients and end up in file paths
+        if not self.enabled or not _HASH_RE.match(key or ""):
+            return None
+        result = self.memory.get(key)
+        if result is not None:
+            return result
+        return self._get_disk(key)
+
+    def _get_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._disk_lock:
+            self._load_disk_index()
+            # Another process sharing the directory may have written it since we indexed
+            if key not in self._disk_index and not os.path.exists(self._path(key)):
+                self.disk_misses += 1
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    result = json.load(f)
+                os.utime(self._path(key))
+                if key in self._disk_index:
+                    self._disk_index.move_to_end(key)
+                else:
+                    size = os.path.getsize(self._path(key))
+                    self._disk_index[key] = size
+                    self._disk_bytes += size
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping unreadable preprocess cache entry {key}: {e}")
+                self._drop_disk(key)
+                self.disk_misses += 1
+                return None
+            self.disk_hits += 1
+        self.memory.set(key, result)
+        return result
+
+    def set(self, key: str, result: Dict[str, Any]):
+        if not self.enabled:
+            return
+        self.memory.set(key, result)
+        payload = json.dumps(result).encode("utf-8")
+        if len(payload) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        with self._disk_lock:
+            self._load_disk_index()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp, path)  # readers never see a half-written entry
+            except OSError as e:
+                logger.warning(f"Could not persist preprocess cache entry {key}: {e}")
+                return
+            self._drop_index(key)
+            self._disk_index[key] = len(payload)
+            self._disk_bytes += len(payload)
+            while self._disk_bytes > self.disk_max_bytes and self._disk_index:
+                self._drop_disk(next(iter(self._disk_index)))
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        """get() for coroutines: memory hits answer inline, disk reads run on a worker thread"""
+        if not self.enabled or not _HASH_RE.match(key or ""):
+            return None
+        result = self.memory.get(key)
+        if result is not None:
+            return result
+        return await asyncio.to_thread(self._get_disk, key)
+
+    async def aset(self, key: str, result: Dict[str, Any]):
+        """set() for coroutines; encoding and the disk write run on a worker thread"""
+        if self.enabled:
+            await asyncio.to_thread(self.set, key, result)
+
+    def _drop_index(self, key: str):
+        size = self._disk_index.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _drop_disk(self, key: str):
+        self._drop_index(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        # Not under _disk_lock: /metrics shouldn't wait behind a disk read or the first index scan
+        disk = {
+            "entries": len(self._disk_index),
+            "bytes": self._disk_bytes,
+            "max_bytes": self.disk_max_bytes,
+            "hits": self.disk_hits,
+            "misses": self.disk_misses,
+        }
+        return {"enabled": self.enabled, "memory": self.memory.stats(), "disk": disk}
+
+
+# Global instance
+preprocess_cache = PreprocessCache()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import tempfile
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+STATES = ("queued", "running", "done", "failed")
+
+
+class JobQueue:
+    """Local preprocess job queue kept in a spool directory
+
+    Every job is a JSON file under ``<dir>/<state>/`` plus its upload in
+    ``<dir>/data/``. State changes are atomic renames, so any number of worker
+    processes on the host (the API process itself, ``preprocess_worker.py``, or
+    the ``fastapi_app`` service) can consume the same queue without a broker.
+    Jobs left running by a dead worker are re-queued after a timeout.
+    """
+
+    def __init__(self):
+        self.dir = os.getenv("PREPROCESS_JOB_DIR") or os.path.join(tempfile.gettempdir(), "allai-preprocess-jobs")
+        self.ttl = float(os.getenv("PREPROCESS_JOB_TTL_SECONDS", "3600"))
+        self.timeout = float(os.getenv("PREPROCESS_JOB_TIMEOUT_SECONDS", "600"))
+        self.max_attempts = int(os.getenv("PREPROCESS_JOB_MAX_ATTEMPTS", "3"))
+        for name in STATES + ("data",):
+            os.makedirs(os.path.join(self.dir, name), exist_ok=True)
+        self._last_maintenance = 0.0
+
+    def _path(self, state: str, job_id: str) -> str:
+        return os.path.join(self.dir, state, f"{job_id}.json")
+
+    def data_path(self, job_id: str) -> str:
+        return os.path.join(self.dir, "data", f"{job_id}.bin")
+
+    @staticmethod
+    def _write(path: str, job: Dict[str, Any]):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def submit(self, data, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Time-ordered ids make a directory listing FIFO
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:12]}"
+        with open(self.data_path(job_id), "wb") as f:
+            f.write(data)
+        job = {"job_id": job_id, "status": "queued", "params": params, "attempts": 0, "created_at": time.time()}
+        self._write(self._path("queued", job_id), job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        # Ids end up in file paths
+        if not job_id or "/" in job_id or "\\" in job_id or job_id.startswith("."):
+            return None
+        # Check later states first, and look twice: a job may move while we look
+        for _ in range(2):
+            for state in reversed(STATES):
+                job = self._read(self._path(state, job_id))
+                if job is not None:
+                    job["status"] = state
+                    return job
+        return None
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Move the oldest queued job to running and return it, or None when the queue is empty"""
+        self.maintain()
+        for name in sorted(os.listdir(os.path.join(self.dir, "queued"))):
+            if not name.endswith(".json"):
+                continue
+            job_id = name[:-5]
+            try:
+                os.rename(self._path("queued", job_id), self._path("running", job_id))
+            except FileNotFoundError:
+                continue  # another worker won it
+            job = self._read(self._path("running", job_id))
+            if job is None:
+                continue
+            job.update(status="running", started_at=time.time(), worker=os.getpid(), attempts=job["attempts"] + 1)
+            self._write(self._path("running", job_id), job)
+            return job
+        return None
+
+    def _finish(self, job: Dict[str, Any], state: str, **fields):
+        job.update(status=state, finished_at=time.time(), **fields)
+        self._write(self._path(state, job["job_id"]), job)
+        try:
+            os.remove(self._path("running", job["job_id"]))
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(self.data_path(job["job_id"]))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, job: Dict[str, Any], result: Dict[str, Any]):
+        self._finish(job, "done", result=result)
+
+    def fail(self, job: Dict[str, Any], error: str):
+        self._finish(job, "failed", error=error)
+
+    def maintain(self, interval: float = 30.0):
+        """Re-queue stuck jobs and drop finished ones past their TTL, at most every `interval` seconds"""
+        now = time.time()
+        if now - self._last_maintenance < interval:
+            return
+        self._last_maintenance = now
+        for name in os.listdir(os.path.join(self.dir, "running")):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.dir, "running", name)
+            job = self._read(path)
+            if job is None or now - job.get("started_at", now) < self.timeout:
+                continue
+            if job["attempts"] >= self.max_attempts:
+                logger.warning(f"Preprocess job {job['job_id']} timed out {job['attempts']} times, giving up")
+                self._finish(job, "failed", error="timed out")
+                continue
+            logger.warning(f"Re-queueing preprocess job {job['job_id']} left running by worker {job.get('worker')}")
+            job["status"] = "queued"
+            self._write(path, job)
+            try:
+                os.rename(path, self._path("queued", job["job_id"]))
+            except FileNotFoundError:
+                pass
+        for state in ("done", "failed"):
+            folder = os.path.join(self.dir, state)
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    if now - os.path.getmtime(path) > self.ttl:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def depth(self) -> Dict[str, int]:
+        return {
+            state: sum(1 for n in os.listdir(os.path.join(self.dir, state)) if n.endswith(".json"))
+            for state in STATES
+        }
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Poll until the job is done or failed; returns the job, or None on timeout"""
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            job = await asyncio.to_thread(self.get, job_id)
+            if job is None or job["status"] in ("done", "failed"):
+                return job
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+
+# Global instance
+job_queue = JobQueue()
@@ -0,0 +1,307 @@
+import os
+import json
+import asyncio
+import logging
+import mimetypes
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from openai import OpenAI
+
+from metrics import registry, observe_cache, observe_queue
+from preprocess import (
+    resolve_budget, read_upload, prepare_image, describe_images, extract_pdf_pages, stream_pdf_ndjson, cached_payload,
+)
+from preprocess_cache import preprocess_cache, hash_content
+from preprocess_jobs import job_queue
+from doc_store import doc_store
+
+logger = logging.getLogger(__name__)
+
+# "inprocess": /preprocess does the work in the API process (jobs are consumed there too).
+# "queue": /preprocess only enqueues and waits; preprocess_worker.py or the fastapi_app service does the work.
+PREPROCESS_MODE = os.getenv("PREPROCESS_MODE", "inprocess").lower()
+PREPROCESS_INPROCESS_WORKERS = int(os.getenv("PREPROCESS_INPROCESS_WORKERS", "1" if PREPROCESS_MODE == "inprocess" else "0"))
+PREPROCESS_JOB_CONCURRENCY = int(os.getenv("PREPROCESS_JOB_CONCURRENCY", "2"))
+PREPROCESS_JOB_WAIT_SECONDS = float(os.getenv("PREPROCESS_JOB_WAIT_SECONDS", "300"))
+PREPROCESS_JOB_POLL_SECONDS = float(os.getenv("PREPROCESS_JOB_POLL_SECONDS", "0.25"))
+
+OPENAI_KEY = os.getenv("OPENAI_API_KEY", "")
+openai_client = OpenAI(api_key=OPENAI_KEY) if OPENAI_KEY else None
+
+router = APIRouter()
+
+
+def _collect_metrics():
+    stats = preprocess_cache.stats()
+    observe_cache("preprocess_memory", stats["memory"])
+    disk = stats["disk"]
+    lookups = disk["hits"] + disk["misses"]
+    observe_cache("preprocess_disk", {"hit_ratio": disk["hits"] / lookups if lookups else 0.0, "entries": disk["entries"]})
+    observe_queue("preprocess_jobs", job_queue.depth().items())
+
+
+registry.register_collector(_collect_metrics)
+
+
+def gpt_vision_extract(data: bytes, mime_type: str = "image/jpeg") -> str:
+    # Return "" if no OPENAI key or on any OpenAI failure (graceful degrade)
+    if not OPENAI_KEY or not openai_client:
+        return ""
+    return describe_images(openai_client, [prepare_image(data, mime_type)])[0]
+
+
+def index_document(session_id: str, content_hash: str, name: str, pages: List[str]) -> dict:
+    # Retrieval is an optimization: if indexing fails the client can still paste the text
+    try:
+        return {"indexed": True, "chunks": doc_store.add(session_id, content_hash, name, pages)}
+    except Exception as e:
+        logger.warning(f"Indexing {content_hash} for {session_id} failed: {e}")
+        return {"indexed": False}
+
+
+def upload_mime(file: UploadFile) -> str:
+    mime_type, _ = mimetypes.guess_type(file.filename or "")
+    return mime_type or file.content_type or "application/octet-stream"
+
+
+async def process_upload(
+    data, filename: str, mime_type: str, page_budget: int, session_id: Optional[str] = None, keep_pages: bool = False,
+) -> Dict[str, Any]:
+    """The /preprocess payload for one upload; PDFs are indexed for the session when one is given"""
+    key = hash_content(data)
+    payload = {"content_hash": key}
+    if "pdf" in mime_type:
+        pages, total_pages = await extract_pdf_pages(data, page_budget, key)
+        payload["extracted_text"] = "".join(pages).strip()
+        if len(pages) < total_pages:
+            payload["note"] = "truncated_to_max_pages"
+        if session_id:
+            payload.update(await asyncio.to_thread(index_document, session_id, key, filename, pages))
+        if keep_pages:
+            payload["pages"] = pages
+            payload["total_pages"] = total_pages
+    elif mime_type.startswith("image/"):
+        cached = await preprocess_cache.aget(key)
+        if cached and cached.get("kind") == "image":
+            payload["extracted_text"] = cached["text"]
+        else:
+            payload["extracted_text"] = await asyncio.to_thread(gpt_vision_extract, data, mime_type)
+            if payload["extracted_text"]:
+                await preprocess_cache.aset(key, {"kind": "image", "text": payload["extracted_text"]})
+        if not payload["extracted_text"]:
+            payload["note"] = "vision_unavailable_or_failed"
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime_type}")
+    return payload
+
+
+def _job_params(file: UploadFile, mime_type: str, page_budget: int, session_id: Optional[str]) -> Dict[str, Any]:
+    if "pdf" not in mime_type and not mime_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime_type}")
+    return {"filename": file.filename, "mime_type": mime_type, "max_pages": page_budget, "session_id": session_id}
+
+
+async def _ndjson_from_result(result: Dict[str, Any]):
+    """Replay a finished job as the same NDJSON stream the in-process path produces"""
+    pages = result.pop("pages", None) or [result.get("extracted_text", "")]
+    for index, text in enumerate(pages):
+        yield (json.dumps({"page": index + 1, "text": text}) + "\n").encode("utf-8")
+    summary = {"done": True, "pages": len(pages), "total_pages": result.pop("total_pages", len(pages))}
+    summary.update({k: v for k, v in result.items() if k != "extracted_text"})
+    yield (json.dumps(summary) + "\n").encode("utf-8")
+
+
+@router.post("/preprocess")
+async def preprocess(
+    file: UploadFile = File(...),
+    stream: bool = False,
+    max_pages: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    session_id: Optional[str] = None,
+):
+    """Extract text from a PDF or describe an image; with session_id, PDFs are also indexed for retrieval"""
+    try:
+        page_budget, byte_budget = resolve_budget(max_pages, max_bytes)
+        data = await read_upload(file, byte_budget)
+        mime_type = upload_mime(file)
+
+        if PREPROCESS_MODE == "queue":
+            # Parsing happens in a worker process; this process only waits
+            job = await asyncio.to_thread(job_queue.submit, data, _job_params(file, mime_type, page_budget, session_id))
+            job = await job_queue.wait(job["job_id"], PREPROCESS_JOB_WAIT_SECONDS)
+            if job is None:
+                raise HTTPException(status_code=504, detail="Preprocessing timed out")
+            if job["status"] == "failed":
+                return JSONResponse({"error": job.get("error", "failed")}, status_code=500)
+            result = job["result"]
+            if stream:
+                return StreamingResponse(_ndjson_from_result(result), media_type="application/x-ndjson")
+            result.pop("pages", None)
+            result.pop("total_pages", None)
+            return JSONResponse(result)
+
+        if stream and "pdf" in mime_type:
+            key = hash_content(data)
+            on_complete = None
+            if session_id:
+                on_complete = lambda pages: index_document(session_id, key, file.filename, pages)
+            # Page text is sent as NDJSON as soon as each range is parsed
+            return StreamingResponse(
+                stream_pdf_ndjson(data, page_budget, key, on_complete), media_type="application/x-ndjson"
+            )
+        return JSONResponse(await process_upload(data, file.filename, mime_type, page_budget, session_id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@router.post("/preprocess/jobs", status_code=202)
+async def submit_preprocess_job(
+    file: UploadFile = File(...),
+    max_pages: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    session_id: Optional[str] = None,
+):
+    """Queue an upload for background processing; poll /preprocess/jobs/{job_id} for the outcome"""
+    page_budget, byte_budget = resolve_budget(max_pages, max_bytes)
+    data = await read_upload(file, byte_budget)
+    params = _job_params(file, upload_mime(file), page_budget, session_id)
+    job = await asyncio.to_thread(job_queue.submit, data, params)
+    return {"job_id": job["job_id"], "status": job["status"], "content_hash": hash_content(data)}
+
+
+@router.get("/preprocess/jobs/{job_id}")
+def get_preprocess_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    status = {k: job.get(k) for k in ("job_id", "status", "attempts", "created_at", "started_at", "finished_at")}
+    if job["status"] == "failed":
+        status["error"] = job.get("error")
+    return status
+
+
+@router.get("/preprocess/jobs/{job_id}/result")
+def get_preprocess_job_result(job_id: str, include_pages: bool = False):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "failed":
+        return JSONResponse({"job_id": job_id, "status": "failed", "error": job.get("error")}, status_code=500)
+    if job["status"] != "done":
+        return JSONResponse({"job_id": job_id, "status": job["status"]}, status_code=202)
+    result = job["result"]
+    if not include_pages:
+        result.pop("pages", None)
+    return result
+
+
+@router.get("/preprocess/status")
+def get_preprocess_status():
+    """Queue depth per state and cache hit rates for this preprocess process"""
+    return {"mode": PREPROCESS_MODE, "consumers": len(_consumers), "queue": job_queue.depth(), "cache": preprocess_cache.stats()}
+
+
+@router.get("/preprocess/{content_hash}")
+def get_preprocessed(content_hash: str, max_pages: Optional[int] = None):
+    """Result for an already-processed upload, so clients can skip re-uploading it"""
+    payload = cached_payload(content_hash, resolve_budget(max_pages, None)[0])
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Unknown content hash")
+    return payload
+
+
+@router.post("/preprocess/images")
+async def preprocess_images(files: List[UploadFile] = File(...), max_bytes: Optional[int] = None):
+    """Describe several images with as few vision requests as possible"""
+    _, byte_budget = resolve_budget(None, max_bytes)
+    results = []
+    pending = []  # (index in results, bytes, mime)
+    for file in files:
+        data = await read_upload(file, byte_budget)
+        mime_type, _ = mimetypes.guess_type(file.filename or "")
+        if not (mime_type or file.content_type or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"Unsupported file type for {file.filename}")
+        key = hash_content(data)
+        result = {"filename": file.filename, "content_hash": key, "extracted_text": ""}
+        cached = await preprocess_cache.aget(key)
+        if cached and cached.get("kind") == "image":
+            result["extracted_text"] = cached["text"]
+        else:
+            pending.append((len(results), data, mime_type or file.content_type))
+        results.append(result)
+
+    if pending:
+        def run():
+            if not OPENAI_KEY or not openai_client:
+                return [""] * len(pending)
+            return describe_images(openai_client, [prepare_image(data, mime) for _, data, mime in pending])
+        for (index, _, _), text in zip(pending, await asyncio.to_thread(run)):
+            results[index]["extracted_text"] = text
+            if text:
+                await preprocess_cache.aset(results[index]["content_hash"], {"kind": "image", "text": text})
+
+    for result in results:
+        if not result["extracted_text"]:
+            result["note"] = "vision_unavailable_or_failed"
+    return {"results": results}
+
+
+async def run_job(job: Dict[str, Any]):
+    params = job["params"]
+    try:
+        with open(job_queue.data_path(job["job_id"]), "rb") as f:
+            data = f.read()
+        result = await process_upload(
+            data, params["filename"], params["mime_type"], params["max_pages"], params.get("session_id"), keep_pages=True,
+        )
+    except HTTPException as e:
+        await asyncio.to_thread(job_queue.fail, job, str(e.detail))
+    except Exception as e:
+        logger.exception(f"Preprocess job {job['job_id']} failed")
+        await asyncio.to_thread(job_queue.fail, job, str(e))
+    else:
+        await asyncio.to_thread(job_queue.complete, job, result)
+
+
+async def consume(stop: asyncio.Event):
+    """Claim and run jobs until `stop` is set"""
+    while not stop.is_set():
+        try:
+            job = await asyncio.to_thread(job_queue.claim)
+        except Exception as e:
+            logger.warning(f"Could not claim a preprocess job: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), PREPROCESS_JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await run_job(job)
+
+
+_consumers: List[asyncio.Task] = []
+_stop: Optional[asyncio.Event] = None
+
+
+def start_workers(count: int):
+    """Start `count` job consumers on the running event loop (call from a startup hook)"""
+    global _stop
+    if count <= 0 or _consumers:
+        return
+    _stop = asyncio.Event()
+    _consumers.extend(asyncio.create_task(consume(_stop)) for _ in range(count))
+    logger.info(f"Started {count} preprocess job consumer(s) in process {os.getpid()}")
+
+
+async def stop_workers():
+    """Let running jobs finish, then stop the consumers"""
+    if _stop is not None:
+        _stop.set()
+    if _consumers:
+        await asyncio.gather(*_consumers, return_exceptions=True)
+        _consumers.clear()
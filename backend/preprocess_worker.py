@@ -0,0 +1,33 @@
+"""Headless preprocess worker: consumes the local job queue without serving HTTP.
+
+    PREPROCESS_JOB_DIR=/var/spool/allai python preprocess_worker.py [--concurrency 2]
+
+Start as many as the host allows; they coordinate through the spool directory.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+from log_config import configure_logging
+from preprocess import shutdown_pdf_pool
+from preprocess_service import consume, PREPROCESS_JOB_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+async def main(concurrency: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    logger.info(f"Preprocess worker consuming with concurrency {concurrency}")
+    await asyncio.gather(*(consume(stop) for _ in range(concurrency)))
+    shutdown_pdf_pool()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=PREPROCESS_JOB_CONCURRENCY)
+    asyncio.run(main(parser.parse_args().concurrency))
@@ -0,0 +1,93 @@
+import os
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict
+
+from fastapi import HTTPException
+
+from agent import workflow, MODEL_NODES
+from cancellation import CancelScope, cancel_scope, current_scope
+from metrics import race_branches
+from tracing import traced_node
+
+logger = logging.getLogger(__name__)
+
+RACE_MIN_CHARS = int(os.getenv("RACE_MIN_CHARS", "1"))
+
+
+def acceptable(message) -> bool:
+    """A branch wins only with a real answer: text of at least RACE_MIN_CHARS"""
+    content = getattr(message, "content", None)
+    return isinstance(content, str) and len(content.strip()) >= RACE_MIN_CHARS
+
+
+def race_turn(state: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    """One /chat turn in race mode: the first acceptable answer wins and the other branches are cancelled
+
+    ``state`` is what run_chat would pass to workflow.invoke. Branches run the
+    graph's model nodes directly, each on its session history plus this
+    turn's message. Only branches that completed with an acceptable answer by
+    the time the winner is known are written to the checkpoint, so losers
+    leave no trace in the session. Returns the written channels, like the
+    graph's result, plus ``winner``.
+    """
+    names = list(state["selected_models"])
+    history = workflow.get_state(config).values
+    parent = current_scope.get()
+    scopes, futures = {}, {}
+    for name in names:
+        key = f"{name.lower()}_messages"
+        branch_state = {
+            "selected_models": state["selected_models"],
+            "document_context": state.get("document_context"),
+            "generation": state.get("generation"),
+            key: list(history.get(key, [])) + state[key],
+        }
+        scopes[name] = CancelScope("/chat", parent=parent)
+        node = traced_node(name, MODEL_NODES[name])
+        futures[race_pool.submit(contextvars.copy_context().run, run_branch, scopes[name], node, branch_state)] = name
+
+    winner, replies, errors = None, {}, {}
+    pending = set(futures)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = futures[future]
+            error = future.exception()
+            reply = None if error else future.result()[f"{name.lower()}_messages"]
+            if reply is not None and acceptable(reply):
+                replies[name] = reply
+                winner = winner or name
+            else:
+                errors[name] = str(error)[:300] if error else "empty answer"
+                race_branches.inc(model=name, outcome="rejected")
+
+    for future in pending:
+        name = futures[future]
+        scopes[name].cancel(f"race won by {winner}")
+        # Gemini calls can't be interrupted; they finish in the background and are dropped
+        future.add_done_callback(lambda f: f.exception())
+        race_branches.inc(model=name, outcome="cancelled")
+    if winner is None:
+        logger.warning("Race had no acceptable answer", extra={"event": "race_failed", "errors": errors})
+        raise HTTPException(status_code=502, detail={"message": "No model returned an acceptable answer", "errors": errors})
+
+    for name in replies:
+        race_branches.inc(model=name, outcome="won" if name == winner else "also_completed")
+    update = {"selected_models": state["selected_models"], "document_context": state.get("document_context"),
+              "generation": state.get("generation")}
+    for name, reply in replies.items():
+        key = f"{name.lower()}_messages"
+        update[key] = state[key] + [reply]
+    workflow.update_state(config, update, as_node=winner)
+    return {**{f"{name.lower()}_messages": [reply] for name, reply in replies.items()}, "winner": winner}
+
+
+def run_branch(scope: CancelScope, node, branch_state):
+    with cancel_scope(scope):
+        return node(branch_state)
+
+
+# Global instance
+race_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RACE_WORKERS", "64")), thread_name_prefix="race")
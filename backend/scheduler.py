@@ -0,0 +1,306 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Deque, Dict, List, Optional
+
+from metrics import scheduler_requests, scheduler_rejections, scheduler_wait, scheduler_in_flight, scheduler_waiting
+
+logger = logging.getLogger(__name__)
+
+# Lower sorts first: interactive chat, then batch jobs, then background work like title generation
+PRIORITIES = {"interactive": 0, "batch": 1, "background": 2}
+
+SCHED_ENABLED = os.getenv("SCHED_ENABLED", "true").lower() in ("1", "true", "yes")
+SCHED_EST_OUTPUT_TOKENS = int(os.getenv("SCHED_EST_OUTPUT_TOKENS", "800"))
+
+
+class SchedulerRejected(Exception):
+    """Raised when a request can't be admitted; ``retry_after`` is a hint in seconds"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Request rejected by scheduler: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One admission: who asked, at what priority, for how many provider calls and tokens"""
+
+    def __init__(self, account: str, priority: str, weight: int, tokens: int, seq: int):
+        self.account = account
+        self.priority = priority
+        self.weight = weight
+        self.tokens = tokens
+        self.seq = seq
+        self.rank = (PRIORITIES[priority], seq)
+        self.enqueued = time.monotonic()
+        self.charge: Optional[list] = None  # [timestamp, tokens] entry in the account's budget window
+        self.admitted = False
+
+    def settle(self, tokens: int):
+        """Replace the up-front estimate with the tokens actually used"""
+        if self.charge is not None and tokens:
+            self.charge[1] = tokens
+
+
+def estimate_tokens(prompt_chars: int, calls: int) -> int:
+    """Rough cost of a request before it runs: the prompt plus a typical reply, per provider call"""
+    return max(1, calls) * (prompt_chars // 4 + SCHED_EST_OUTPUT_TOKENS)
+
+
+class RequestScheduler:
+    """Admission control in front of provider calls
+
+    Capacity is counted in provider calls, so a /chat with eight models weighs
+    eight. A request is admitted when there is global capacity (batch and
+    background work may only use SCHED_LOW_PRIORITY_SHARE of it), its account
+    is under SCHED_ACCOUNT_MAX_PROVIDER_CALLS and its token budget for the last
+    minute has room. Otherwise it waits, in priority then arrival order, for
+    up to SCHED_MAX_WAIT_SECONDS before being rejected.
+    """
+
+    def __init__(self):
+        self.enabled = SCHED_ENABLED
+        self.capacity = int(os.getenv("SCHED_MAX_PROVIDER_CALLS", "64"))
+        self.low_priority_capacity = max(1, int(self.capacity * float(os.getenv("SCHED_LOW_PRIORITY_SHARE", "0.5"))))
+        self.account_capacity = int(os.getenv("SCHED_ACCOUNT_MAX_PROVIDER_CALLS", "16"))
+        self.account_tokens_per_minute = int(os.getenv("SCHED_ACCOUNT_TOKENS_PER_MINUTE", "200000"))
+        self.max_wait = float(os.getenv("SCHED_MAX_WAIT_SECONDS", "10"))
+        self.max_waiting = int(os.getenv("SCHED_MAX_WAITING", "256"))
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting: List[Ticket] = []
+        # Wake callbacks for tickets waiting in acquire_async, by ticket seq
+        self._wakers: Dict[int, Callable[[], None]] = {}
+        self._in_flight = 0
+        self._low_in_flight = 0
+        self._account_in_flight: Dict[str, int] = defaultdict(int)
+        self._account_tokens: Dict[str, Deque[list]] = defaultdict(deque)
+
+    def _tokens_used(self, account: str, now: float) -> int:
+        window = self._account_tokens.get(account)
+        if not window:
+            return 0
+        while window and now - window[0][0] >= 60:
+            window.popleft()
+        if not window:
+            del self._account_tokens[account]
+            return 0
+        return sum(tokens for _, tokens in window)
+
+    def _budget_wait(self, ticket: Ticket, now: float) -> float:
+        """Seconds until the account's window has room for this ticket (0 if it fits now)"""
+        used = self._tokens_used(ticket.account, now)
+        if used + ticket.tokens <= self.account_tokens_per_minute or used == 0:
+            return 0.0
+        for stamp, tokens in self._account_tokens[ticket.account]:
+            used -= tokens
+            if used + ticket.tokens <= self.account_tokens_per_minute or used <= 0:
+                return stamp + 60 - now
+        return 60.0
+
+    def _blocker(self, ticket: Ticket, now: float) -> Optional[str]:
+        """Why the ticket can't run right now, or None; a lone oversized request is never blocked by its own size"""
+        if self._in_flight and self._in_flight + ticket.weight > self.capacity:
+            return "capacity"
+        if ticket.priority != "interactive" and self._low_in_flight and \
+                self._low_in_flight + ticket.weight > self.low_priority_capacity:
+            return "capacity"
+        in_flight = self._account_in_flight.get(ticket.account, 0)
+        if in_flight and in_flight + ticket.weight > self.account_capacity:
+            return "account_concurrency"
+        if self._budget_wait(ticket, now) > 0:
+            return "token_budget"
+        return None
+
+    def _next_admissible(self, now: float) -> Optional[Ticket]:
+        # Best-ranked waiter that can run; one blocked by its own account doesn't hold up others
+        for ticket in sorted(self._waiting, key=lambda t: t.rank):
+            if self._blocker(ticket, now) is None:
+                return ticket
+        return None
+
+    def _publish_waiting(self):
+        counts = defaultdict(int)
+        for ticket in self._waiting:
+            counts[ticket.priority] += 1
+        for priority in PRIORITIES:
+            scheduler_waiting.set(counts[priority], priority=priority)
+
+    def _reject(self, ticket: Ticket, reason: str, retry_after: float):
+        scheduler_requests.inc(priority=ticket.priority, outcome="rejected")
+        scheduler_rejections.inc(priority=ticket.priority, reason=reason)
+        logger.info("Scheduler rejected %s request: %s", ticket.priority, reason,
+                    extra={"event": "scheduler_reject", "account_id": ticket.account, "weight": ticket.weight})
+        raise SchedulerRejected(reason, max(1.0, retry_after))
+
+    def _enqueue(self, ticket: Ticket, deadline: float):
+        """Reject the ticket outright or add it to the waiters; call holding the lock"""
+        now = time.monotonic()
+        if len(self._waiting) >= self.max_waiting:
+            self._reject(ticket, "queue_full", 1.0)
+        budget_wait = self._budget_wait(ticket, now)
+        if budget_wait > deadline - now:
+            self._reject(ticket, "token_budget", budget_wait)
+        self._waiting.append(ticket)
+        self._publish_waiting()
+
+    def _poll(self, ticket: Ticket, deadline: float) -> Optional[float]:
+        """Admit the waiting ticket if it's its turn (None), else how long to wait before checking again"""
+        now = time.monotonic()
+        if self._next_admissible(now) is ticket:
+            self._dequeue(ticket)
+            self._admit(ticket, now)
+            # Others may have been waiting behind this ticket's rank
+            self._notify()
+            return None
+        remaining = deadline - now
+        if remaining <= 0:
+            self._reject(ticket, self._blocker(ticket, now) or "capacity", self._budget_wait(ticket, now) or 1.0)
+        # Budget windows free up with time rather than on release, so never sleep past the next expiry
+        return min(remaining, self._budget_wait(ticket, now) or remaining)
+
+    def _dequeue(self, ticket: Ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            self._publish_waiting()
+
+    def _notify(self):
+        """Wake every waiter, on threads and event loops alike; call holding the lock"""
+        self._cond.notify_all()
+        for wake in list(self._wakers.values()):
+            wake()
+
+    def _admitted(self, ticket: Ticket, waited: bool) -> Ticket:
+        scheduler_wait.observe(time.monotonic() - ticket.enqueued, priority=ticket.priority)
+        scheduler_requests.inc(priority=ticket.priority, outcome="delayed" if waited else "admitted")
+        return ticket
+
+    def acquire(self, account: str, priority: str = "interactive", weight: int = 1, tokens: int = 0,
+                max_wait: Optional[float] = None) -> Ticket:
+        """Block until the request may run or raise SchedulerRejected; pair with release()
+
+        For worker threads and scripts. Coroutines use acquire_async, which
+        waits without holding a threadpool thread.
+        """
+        ticket = Ticket(account or "anonymous", priority, max(1, weight), max(0, tokens), next(self._seq))
+        if not self.enabled:
+            return ticket
+        deadline = ticket.enqueued + (self.max_wait if max_wait is None else max_wait)
+        waited = False
+        with self._cond:
+            self._enqueue(ticket, deadline)
+            try:
+                while (timeout := self._poll(ticket, deadline)) is not None:
+                    waited = True
+                    self._cond.wait(timeout)
+            finally:
+                self._dequeue(ticket)
+        return self._admitted(ticket, waited)
+
+    async def acquire_async(self, account: str, priority: str = "interactive", weight: int = 1, tokens: int = 0,
+                            max_wait: Optional[float] = None) -> Ticket:
+        """acquire() for coroutines: waits on the event loop, and a cancelled wait leaves nothing admitted"""
+        ticket = Ticket(account or "anonymous", priority, max(1, weight), max(0, tokens), next(self._seq))
+        if not self.enabled:
+            return ticket
+        deadline = ticket.enqueued + (self.max_wait if max_wait is None else max_wait)
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        waited = False
+        with self._cond:
+            self._enqueue(ticket, deadline)
+            # release() may run on any thread
+            self._wakers[ticket.seq] = lambda: loop.call_soon_threadsafe(woken.set)
+        try:
+            while True:
+                with self._cond:
+                    timeout = self._poll(ticket, deadline)
+                    if timeout is None:
+                        break
+                    woken.clear()
+                waited = True
+                try:
+                    await asyncio.wait_for(woken.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                del self._wakers[ticket.seq]
+                if ticket in self._waiting:
+                    # Abandoned wait: a waiter ranked behind it may be admissible now
+                    self._dequeue(ticket)
+                    self._notify()
+        return self._admitted(ticket, waited)
+
+    def _admit(self, ticket: Ticket, now: float):
+        ticket.admitted = True
+        self._in_flight += ticket.weight
+        if ticket.priority != "interactive":
+            self._low_in_flight += ticket.weight
+        self._account_in_flight[ticket.account] += ticket.weight
+        if ticket.tokens:
+            ticket.charge = [now, ticket.tokens]
+            self._account_tokens[ticket.account].append(ticket.charge)
+        scheduler_in_flight.inc(ticket.weight, priority=ticket.priority)
+
+    def release(self, ticket: Ticket):
+        if not ticket.admitted:
+            return
+        ticket.admitted = False
+        with self._cond:
+            self._in_flight -= ticket.weight
+            if ticket.priority != "interactive":
+                self._low_in_flight -= ticket.weight
+            self._account_in_flight[ticket.account] -= ticket.weight
+            if self._account_in_flight[ticket.account] <= 0:
+                del self._account_in_flight[ticket.account]
+            self._notify()
+        scheduler_in_flight.dec(ticket.weight, priority=ticket.priority)
+
+    @contextmanager
+    def admit(self, account: str, priority: str = "interactive", weight: int = 1, tokens: int = 0):
+        ticket = self.acquire(account, priority, weight, tokens)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def admit_async(self, account: str, priority: str = "interactive", weight: int = 1, tokens: int = 0):
+        """admit() for coroutines"""
+        ticket = await self.acquire_async(account, priority, weight, tokens)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "enabled": self.enabled,
+                "capacity": self.capacity,
+                "low_priority_capacity": self.low_priority_capacity,
+                "in_flight": self._in_flight,
+                "low_priority_in_flight": self._low_in_flight,
+                "waiting": len(self._waiting),
+                "accounts": {
+                    account: {"in_flight": self._account_in_flight.get(account, 0), "tokens_last_minute": self._tokens_used(account, now)}
+                    for account in set(self._account_in_flight) | set(self._account_tokens)
+                },
+            }
+
+
+def retry_after_header(error: SchedulerRejected) -> Dict[str, str]:
+    return {"Retry-After": str(math.ceil(error.retry_after))}
+
+
+# Global instance
+scheduler = RequestScheduler()
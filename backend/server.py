@@ -1,19 +1,33 @@
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File
-from pydantic import BaseModel, Field
-from agent import workflow
+from log_config import configure_logging
+configure_logging()
+
+from fastapi import FastAPI, HTTPException, Body, Request, Response, WebSocket
+from pydantic import BaseModel, Field, ValidationError
+from agent import workflow, checkpointer, latest_checkpoint_id
 from langchain_core.messages import HumanMessage, SystemMessage
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Literal
 import os
+import re
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_groq import ChatGroq
 from constants import llm_ChatPerplexity
 from urllib.parse import unquote
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from write_behind import write_behind
+from metrics import registry, instrument_app, observe_cache, observe_queue, ws_turns
+from tracing import tracer, server_timing
+from http_encoding import CompressionMiddleware, FastJSONResponse
+from versions import VERSION_FIELD, account_etag, thread_etag, version_inc, not_modified, cache_headers
+from generation import GenerationParams, generation_profiles
+from cancellation import CancelScope, RequestCancelled, run_in_scope, run_until_disconnected, enter_phase
+import logging
 
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 origins = [
@@ -38,9 +52,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],         # ensures OPTIONS, POST, DELETE, etc. are allowed
     allow_headers=["*"],         # ensures Content-Type, Accept headers are allowed
+    expose_headers=["Server-Timing", "ETag"],  # lets the frontend read per-phase timings and versions
 )
 
 
+app.add_middleware(CompressionMiddleware)
+instrument_app(app)
+
 # Use a safe default for local development if MONGO_URI is not set
 MONGO_URI = os.getenv("MONGO_URI") or "mongodb://127.0.0.1:27017"
 # PORT = os.getenv("PY_PORT")
@@ -49,6 +67,15 @@ client = MongoClient(MONGO_URI)
 db = client["LangGraphDB"]
 session_collection = db["sessionManagement"]
 
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Guarantee buffered checkpoint/activity writes reach Mongo before exit
+    write_behind.close()
+    await stop_workers()
+    await batch_runner.stop()
+    shutdown_pdf_pool()
+
 class APIInput(BaseModel):
     user_query: str = Field(description="User query for the chat")
     selected_models: Dict[str, str] = Field(
@@ -57,84 +84,55 @@ class APIInput(BaseModel):
     )
     session_id: str = Field(description="session_id")
     role: Optional[str] = Field(default=None, description="Active role (e.g. Finance, Coding, General)")
+    use_documents: bool = Field(default=True, description="Add excerpts from the session's indexed documents to this turn")
+    account_id: Optional[str] = Field(default=None, description="Caller's account (email); must own the session")
+    mode: Literal["compare", "race"] = Field(default="compare", description="compare: every selected model answers; race: the first acceptable answer is returned and the rest cancelled")
+    generation: Dict[str, GenerationParams] = Field(
+        default_factory=dict,
+        description="Generation params (max_tokens, stop, temperature, reasoning_effort) by model name or \"*\", over the role's profile"
+    )
 
 # ----------------------
-# Preprocess: PDF text and Image vision description
+# Preprocess: PDF text and Image vision description (see preprocess_service.py)
 # ----------------------
-from fastapi.responses import JSONResponse
-import mimetypes
-import tempfile
-import base64
-
-import fitz  # PyMuPDF
-from openai import OpenAI
-
-OPENAI_KEY = os.getenv("OPENAI_API_KEY", "")
-openai_client = OpenAI(api_key=OPENAI_KEY) if OPENAI_KEY else None
-
-def extract_text_from_pdf(file_path: str) -> str:
-    text = ""
-    doc = fitz.open(file_path)
-    for page in doc:
-        text += page.get_text()
-    return text.strip()
-
-def gpt_vision_extract(file_path: str) -> str:
-    # Return "" if no OPENAI key or on any OpenAI failure (graceful degrade)
-    if not OPENAI_KEY or not openai_client:
-        return ""
-    with open(file_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    try:
-        resp = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Describe this image clearly under 120 words."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}
-                ]
-            }],
-        )
-        return (resp.choices[0].message.content or "").strip()
-    except Exception:
-        return ""
-
-@app.post("/preprocess")
-async def preprocess(file: UploadFile = File(...)):
-    try:
-        suffix = os.path.splitext(file.filename or "")[1]
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(await file.read())
-            file_path = tmp.name
-
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            mime_type = file.content_type or "application/octet-stream"
-
-        note = None
-        if "pdf" in (mime_type or ""):
-            extracted_text = extract_text_from_pdf(file_path)
-        elif mime_type.startswith("image/"):
-            extracted_text = gpt_vision_extract(file_path)
-            if not extracted_text:
-                note = "vision_unavailable_or_failed"
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime_type}")
+from preprocess import resolve_budget, cached_pages, shutdown_pdf_pool
+from preprocess_service import router as preprocess_router, start_workers, stop_workers, PREPROCESS_INPROCESS_WORKERS
+from doc_store import doc_store
+from scheduler import scheduler, SchedulerRejected, estimate_tokens, retry_after_header
+from race import race_turn
+from lru_cache import LRUCache
+from batch_chat import router as batch_router, batch_runner
+from chat_socket import ChatChannel
+
+app.include_router(preprocess_router)
+app.include_router(batch_router)
+batch_runner.resolve_account = lambda account_id: admission_account(account_id=account_id)
+
+@app.on_event("startup")
+async def start_preprocess_workers():
+    # Consumers for /preprocess/jobs; 0 when a separate worker service handles the queue
+    start_workers(PREPROCESS_INPROCESS_WORKERS)
+    # Chat batches a previous process was running pick up where their output stops
+    batch_runner.resume_interrupted()
+
+@app.post("/session/{session_id}/documents/{content_hash}")
+def attach_document(session_id: str, content_hash: str, name: Optional[str] = None, max_pages: Optional[int] = None):
+    """Index an already-processed upload for a session without uploading it again"""
+    pages = cached_pages(content_hash, resolve_budget(max_pages, None)[0])
+    if pages is None:
+        raise HTTPException(status_code=404, detail="Unknown content hash")
+    return {"indexed": True, "chunks": doc_store.add(session_id, content_hash, name or content_hash[:12], pages)}
+
+@app.get("/session/{session_id}/documents")
+def list_documents(session_id: str):
+    return {"documents": doc_store.list(session_id)}
+
+@app.delete("/session/{session_id}/documents/{content_hash}")
+def remove_document(session_id: str, content_hash: str):
+    if not doc_store.remove(session_id, content_hash):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"message": "Document removed"}
 
-        try:
-            os.remove(file_path)
-        except Exception:
-            pass
-
-        payload = {"extracted_text": extracted_text}
-        if note:
-            payload["note"] = note
-        return JSONResponse(payload)
-    except HTTPException:
-        raise
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
 
 @app.get("/")
 def read_root():
@@ -144,53 +142,171 @@ def read_root():
 def health():
     return {"status": "ok"}
 
+# session_id -> owning account, for requests that don't say who they are
+session_owners = LRUCache(max_entries=int(os.getenv("SESSION_OWNER_CACHE_ENTRIES", "10000")))
+
+
+def session_owner(session_id: str) -> str:
+    owner = session_owners.get(session_id)
+    if owner is None:
+        doc = session_collection.find_one({"sessions.session_id": session_id}, {"account_id": 1, "_id": 0})
+        if not doc:
+            return f"session:{session_id}"
+        owner = doc["account_id"]
+        session_owners.set(session_id, owner)
+    return owner
+
+
+# Scheduler account for requests not tied to a stored account, so minting fresh
+# session ids or leaving account_id out never buys a fresh set of limits
+ANONYMOUS_ACCOUNT = "anonymous"
+
+
+def admission_account(session_id: Optional[str] = None, account_id: Optional[str] = None) -> str:
+    """The account a request's scheduler limits are charged to, checked the way /ws checks it
+
+    A stored session's owner wins and a claimed account_id must match it (403).
+    Without a session, a claimed account_id must be a valid email (400) with a
+    session record (404). Anything else shares ANONYMOUS_ACCOUNT.
+    """
+    claimed = None
+    if account_id and account_id.strip():
+        if not is_valid_email(account_id):
+            raise HTTPException(status_code=400, detail="account_id must be a valid email address")
+        claimed = account_id.strip().lower()
+    if session_id:
+        owner = session_owner(session_id)
+        if owner.startswith("session:"):
+            if claimed is not None:
+                raise HTTPException(status_code=404, detail="Session not found")
+            return ANONYMOUS_ACCOUNT
+        if claimed is not None and claimed != owner:
+            raise HTTPException(status_code=403, detail="Session belongs to another account")
+        return owner
+    if claimed is not None:
+        if not session_collection.find_one({"account_id": claimed}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Account not found")
+        return claimed
+    return ANONYMOUS_ACCOUNT
+
+
+def uses_web_context(role: Optional[str]) -> bool:
+    role = (role or "").strip()
+    return bool(role) and role not in {"General", "Image Generation", "Video Generation"}
+
+
+def reply_tokens(message) -> int:
+    return ((getattr(message, "usage_metadata", None) or {}).get("total_tokens")) or 0
+
+
 @app.post("/chat")
-def chat(input: APIInput):
+async def chat(input: APIInput, request: Request, response: Response):
+    with tracer.span("chat", session_id=input.session_id, models=",".join(input.selected_models),
+                     role=input.role, query_chars=len(input.user_query)) as span:
+        try:
+            # Admission before any provider call: one slot per model, plus the Perplexity lookup
+            calls = len(input.selected_models) + (1 if uses_web_context(input.role) else 0)
+            account = await run_in_threadpool(admission_account, input.session_id, input.account_id)
+            try:
+                with tracer.span("admission", weight=calls):
+                    ticket = await scheduler.acquire_async(
+                        account, "interactive", calls, estimate_tokens(len(input.user_query), calls))
+            except SchedulerRejected as e:
+                raise HTTPException(status_code=429, detail=str(e), headers=retry_after_header(e))
+            try:
+                # Runs on a worker thread; a client disconnect aborts its provider calls.
+                # Rebinding response makes the headers set below land on the one returned.
+                response = FastJSONResponse(await run_until_disconnected(request, "/chat", run_chat, input, ticket))
+                return response
+            except RequestCancelled as e:
+                span.set_attribute("cancelled", True)
+                # Nobody is listening; 499 is nginx's "client closed request", so logs and metrics can tell
+                raise HTTPException(status_code=499, detail=str(e))
+            finally:
+                scheduler.release(ticket)
+        finally:
+            span.end()
+            # Phase breakdown for the browser's devtools / PerformanceServerTiming
+            response.headers["Server-Timing"] = server_timing(span)
+            response.headers["Timing-Allow-Origin"] = "*"
+
+
+def run_chat(input: APIInput, ticket=None, on_token=None, on_reply=None):
+    """One chat turn
+
+    For streaming callers, ``on_token(model, message_id, text)`` gets the
+    replies as they are generated and ``on_reply(model, message)`` each
+    model's finished reply.
+    """
     config = {"configurable": {"thread_id": input.session_id}}
+    used_tokens = 0
 
     # Optionally prepend fresh web context from Perplexity for non-general roles
     augmented_query = input.user_query
     role = (input.role or "").strip()
     try:
-        if role and role not in {"General", "Image Generation", "Video Generation"}:
-            # Best-effort Perplexity search: if it fails, we silently fall back to the original query
-            system_msg = SystemMessage(content=(
-                "You are a live web research agent using Perplexity. "
-                "Use web search tools to gather the most recent and relevant information for the user's question, "
-                "with a focus on factual, up-to-date data (prices, recent events, statistics, etc.). "
-                "Respond ONLY with a concise markdown summary of your findings; do not answer as the final assistant."
-            ))
-            perp_messages = [
-                system_msg,
-                HumanMessage(content=input.user_query),
-            ]
-            # Use a stable default Perplexity search model
-            perp_llm = llm_ChatPerplexity("sonar")
-            perp_resp = perp_llm.invoke(perp_messages)
-            perp_content = getattr(perp_resp, "content", None) or str(perp_resp)
-
-            augmented_query = (
-                f"You are answering in the '{role}' role. Here is fresh web context fetched via Perplexity search:\n\n"
-                f"{perp_content}\n\n"
-                f"Now answer the user's question using this context. "
-                f"If the context doesn't fully cover the question, state that clearly.\n\n"
-                f"User question: {input.user_query}"
-            )
+        if uses_web_context(role):
+            enter_phase("perplexity_context")
+            with tracer.span("perplexity_context"):
+                # Best-effort Perplexity search: if it fails, we silently fall back to the original query
+                system_msg = SystemMessage(content=(
+                    "You are a live web research agent using Perplexity. "
+                    "Use web search tools to gather the most recent and relevant information for the user's question, "
+                    "with a focus on factual, up-to-date data (prices, recent events, statistics, etc.). "
+                    "Respond ONLY with a concise markdown summary of your findings; do not answer as the final assistant."
+                ))
+                perp_messages = [
+                    system_msg,
+                    HumanMessage(content=input.user_query),
+                ]
+                # Use a stable default Perplexity search model
+                perp_llm = llm_ChatPerplexity("sonar")
+                perp_resp = perp_llm.invoke(perp_messages)
+                used_tokens += reply_tokens(perp_resp)
+                perp_content = getattr(perp_resp, "content", None) or str(perp_resp)
+
+                augmented_query = (
+                    f"You are answering in the '{role}' role. Here is fresh web context fetched via Perplexity search:\n\n"
+                    f"{perp_content}\n\n"
+                    f"Now answer the user's question using this context. "
+                    f"If the context doesn't fully cover the question, state that clearly.\n\n"
+                    f"User question: {input.user_query}"
+                )
     except Exception as e:
         # Log and continue with the original query if Perplexity fails
-        try:
-            print(f"[Perplexity-web-context] failed: {e}")
-        except Exception:
-            pass
+        logger.warning("Perplexity web context failed: %s", e)
+    enter_phase("document_retrieval")
+
+    # Retrieve only the excerpts relevant to this question instead of resending whole documents.
+    # Always set the key so last turn's excerpts don't carry over.
+    document_context = ""
+    if input.use_documents:
+        with tracer.span("document_retrieval") as span:
+            try:
+                document_context = doc_store.context_for(input.session_id, input.user_query)
+            except Exception as e:
+                logger.warning("Document retrieval failed: %s", e)
+            span.set_attribute("context_chars", len(document_context))
 
     # Prepare state only for selected models
-    state = {"selected_models": input.selected_models}
+    state = {
+        "selected_models": input.selected_models,
+        "document_context": document_context,
+        "generation": generation_profiles.for_turn(role, input.selected_models, input.generation),
+    }
     for model_name in input.selected_models.keys():
         key = f"{model_name.lower()}_messages"
         state[key] = [HumanMessage(content=augmented_query)]
 
     # Run workflow
-    result = workflow.invoke(state, config=config)
+    enter_phase("graph")
+    with tracer.span("graph", mode=input.mode):
+        if input.mode == "race":
+            result = race_turn(state, config)
+        elif on_token is not None or on_reply is not None:
+            result = stream_graph(state, config, on_token, on_reply)
+        else:
+            result = workflow.invoke(state, config=config)
 
     # Extract only the last message content for each selected model
     output = {}
@@ -198,15 +314,45 @@ def chat(input: APIInput):
         key = f"{model_name.lower()}_messages"
         if key in result:
             output[model_name] = result[key][-1].content
+            used_tokens += reply_tokens(result[key][-1])
 
+    if ticket is not None:
+        ticket.settle(used_tokens)
+    if input.mode == "race":
+        return {"responses": output, "winner": result["winner"]}
     return {"responses": output}
 
 
-@app.get("/history/{session_id}")
-def get_history(session_id: str):
-    config = {"configurable": {"thread_id": session_id}}
-    history = list(workflow.get_state_history(config=config))
-    
+def chunk_text(chunk) -> str:
+    content = getattr(chunk, "content", None)
+    if isinstance(content, list):
+        # Anthropic streams content blocks
+        return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return content if isinstance(content, str) else ""
+
+
+def stream_graph(state, config, on_token=None, on_reply=None):
+    """workflow.invoke that also reports each model node's reply chunks and finished reply"""
+    result = None
+    for mode, payload in workflow.stream(state, config=config, stream_mode=["messages", "updates", "values"]):
+        if mode == "values":
+            result = payload
+        elif mode == "updates":
+            for node, update in payload.items():
+                reply = (update or {}).get(f"{node.lower()}_messages")
+                if on_reply is not None and node in state["selected_models"] and reply is not None:
+                    on_reply(node, reply)
+        else:
+            chunk, metadata = payload
+            node = metadata.get("langgraph_node")
+            text = chunk_text(chunk)
+            if on_token is not None and node in state["selected_models"] and text:
+                on_token(node, getattr(chunk, "id", None), text)
+    return result
+
+
+def serialize_history(history) -> list:
+    """Role/content dicts for every *_messages channel of each checkpoint step"""
     output = []
     for step in history:
         state = step.values
@@ -219,8 +365,18 @@ def get_history(session_id: str):
                     for msg in msgs
                 ]
         output.append(step_messages)
-    
-    return {"history": output}
+    return output
+
+
+@app.get("/history/{session_id}")
+def get_history(session_id: str, request: Request):
+    etag = thread_etag(latest_checkpoint_id, session_id)
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    config = {"configurable": {"thread_id": session_id}}
+    history = list(workflow.get_state_history(config=config))
+    return FastJSONResponse({"history": serialize_history(history)}, headers=cache_headers(etag))
 
 
 # Image and Video generation stubs
@@ -259,23 +415,18 @@ class SessionCreate(BaseModel):
     time_stamp: Optional[datetime] = Field(default_factory=datetime.utcnow, description="Client-side timestamp")
     last_activity: Optional[datetime] = Field(default_factory=datetime.utcnow, description="Client-side last activity timestamp")
 
+# Simple RFC 5322-like email pattern (not exhaustive, but good enough for validation here)
+EMAIL_PATTERN = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$")
+
 def is_valid_email(email: str) -> bool:
-    import re
     if not isinstance(email, str):
         return False
-    email = email.strip()
-    # Simple RFC 5322-like email pattern (not exhaustive, but good enough for validation here)
-    pattern = r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$"
-    return re.match(pattern, email) is not None
+    return EMAIL_PATTERN.match(email.strip()) is not None
 
 
 @app.post("/session/create")
 def create_session(data: SessionCreate):
-    # Minimal logging to verify requests in server logs
-    try:
-        print(f"[session/create] account_id={data.account_id} name={data.session_name} time={data.time_stamp}")
-    except Exception:
-        pass
+    logger.info("Creating session %s", data.session_name, extra={"event": "session_create", "account_id": data.account_id})
     # Validate and normalize email
     if not is_valid_email(data.account_id):
         raise HTTPException(status_code=400, detail="account_id must be a valid email address")
@@ -295,12 +446,13 @@ def create_session(data: SessionCreate):
     if existing_account:
         session_collection.update_one(
             {"account_id": normalized_email},
-            {"$push": {"sessions": new_session}}
+            {"$push": {"sessions": new_session}, **version_inc()}
         )
     else:
         session_collection.insert_one({
             "account_id": normalized_email,
-            "sessions": [new_session]
+            "sessions": [new_session],
+            VERSION_FIELD: 1,
         })
 
     return {"message": "Session created", "session_id": session_id}
@@ -311,62 +463,81 @@ def options_session(account_id: str):
 
 
 @app.get("/session/{account_id}")
-def get_sessions(account_id: str):
+def get_sessions(account_id: str, request: Request):
     # Validate and normalize email
     account_id = unquote(account_id)
 
     if not is_valid_email(account_id):
         raise HTTPException(status_code=400, detail="account_id must be a valid email address")
     normalized_email = account_id.strip().lower()
-    account = session_collection.find_one({"account_id": normalized_email}, {"_id": 0})
+    # Make this account's queued last_activity writes visible before reading
+    write_behind.flush(("account_id", normalized_email))
+    # Unchanged since the client's copy: only the version counter is read
+    etag = account_etag(session_collection, normalized_email)
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    account = session_collection.find_one({"account_id": normalized_email}, {"_id": 0, VERSION_FIELD: 0})
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
-    return account
+    return FastJSONResponse(account, headers=cache_headers(etag))
 
 class TitleGenerationRequest(BaseModel):
     messages: List[Dict[str, str]]
     model: str = "gpt-3.5-turbo"
-
-@app.post("/generate-title")
-async def generate_title(request: TitleGenerationRequest = Body(...)):
-    try:
-        # Initialize the appropriate LLM based on the model
-        if request.model.startswith("gpt"):
-            llm = ChatOpenAI(model=request.model, temperature=0.3)
-        elif request.model.startswith("gemini"):
-            llm = ChatGoogleGenerativeAI(model=request.model, temperature=0.3)
-        elif "groq" in request.model.lower():
-            llm = ChatGroq(model=request.model, temperature=0.3)
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported model for title generation")
-
-        # Create a system message for title generation
-        system_message = SystemMessage(content="""
-        You are a helpful assistant that generates concise, descriptive titles for chat conversations.
-        Create a short, clear title (max 5-7 words) that summarizes the main topic of the conversation.
-        The title should be title-cased and should not include any special characters or emojis.
-        Focus on the main subject or question being discussed. This description is passed to the llm as image or pdf, so if user asks the llm what is in the pdf or image, do not say, i cannot see the image, as this description is an image ,so instead say something that makes user believe that the model can see the image. The model should pretend like it can actually see the image or pdf and the users should not know that models cannot see it.
-        """)
-
-        # Extract message content for context
-        conversation_context = "\n".join([f"{m.get('role', 'user').capitalize()}: {m.get('content', '')}" 
-                                    for m in request.messages[-3:]])  # Use last 3 messages for context
-
-        # Generate the title
+    account_id: Optional[str] = None
+    session_id: Optional[str] = None
+
+async def make_title(messages: List[Dict[str, str]], model: str, account: str) -> str:
+    """A short title for a conversation from its last few messages"""
+    # Initialize the appropriate LLM based on the model
+    if model.startswith("gpt"):
+        llm = ChatOpenAI(model=model, temperature=0.3)
+    elif model.startswith("gemini"):
+        llm = ChatGoogleGenerativeAI(model=model, temperature=0.3)
+    elif "groq" in model.lower():
+        llm = ChatGroq(model=model, temperature=0.3)
+    else:
+        raise HTTPException(status_code=400, detail="Unsupported model for title generation")
+
+    # Create a system message for title generation
+    system_message = SystemMessage(content="""
+    You are a helpful assistant that generates concise, descriptive titles for chat conversations.
+    Create a short, clear title (max 5-7 words) that summarizes the main topic of the conversation.
+    The title should be title-cased and should not include any special characters or emojis.
+    Focus on the main subject or question being discussed. This description is passed to the llm as image or pdf, so if user asks the llm what is in the pdf or image, do not say, i cannot see the image, as this description is an image ,so instead say something that makes user believe that the model can see the image. The model should pretend like it can actually see the image or pdf and the users should not know that models cannot see it.
+    """)
+
+    # Extract message content for context
+    conversation_context = "\n".join([f"{m.get('role', 'user').capitalize()}: {m.get('content', '')}" 
+                                for m in messages[-3:]])  # Use last 3 messages for context
+
+    # Generate the title; background priority so it never competes with chat for capacity
+    async with scheduler.admit_async(account, "background", 1, estimate_tokens(len(conversation_context), 1)) as ticket:
         response = await llm.ainvoke([
             system_message,
             HumanMessage(content=f"Generate a title for this conversation:\n\n{conversation_context}")
         ])
+        ticket.settle(reply_tokens(response))
 
-        # Clean up the response
-        title = response.content.strip().strip('"\'')
-        if len(title) > 60:  # Ensure title isn't too long
-            title = title[:57] + "..."
-            
-        return {"title": title}
+    # Clean up the response
+    title = response.content.strip().strip('"\'')
+    if len(title) > 60:  # Ensure title isn't too long
+        title = title[:57] + "..."
+    return title
+
+@app.post("/generate-title")
+async def generate_title(request: TitleGenerationRequest = Body(...)):
+    try:
+        account = await run_in_threadpool(admission_account, request.session_id, request.account_id)
+        return {"title": await make_title(request.messages, request.model, account)}
 
+    except HTTPException:
+        raise
+    except SchedulerRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=retry_after_header(e))
     except Exception as e:
-        print(f"Error generating title: {str(e)}")
+        logger.error("Error generating title: %s", e)
         raise HTTPException(status_code=500, detail=f"Error generating title: {str(e)}")
 
 # ----------------------
@@ -388,21 +559,66 @@ def get_provider_status(provider: str):
     except ValueError:
         raise HTTPException(status_code=400, detail=f"Invalid provider: {provider}")
 
-@app.put("/session/update/{account_id}/{session_id}")
-def update_session(account_id: str, session_id: str, session_name: Optional[str] = None):
-    if not is_valid_email(account_id):
-        raise HTTPException(status_code=400, detail="account_id must be a valid email address")
-    normalized_email = account_id.strip().lower()
+def collect_server_metrics():
+    if hasattr(checkpointer, "stats"):
+        observe_cache("checkpoint", checkpointer.stats())
+    observe_cache("document_index", doc_store.indexes.stats())
+    observe_cache("session_owner", session_owners.stats())
+    observe_queue("write_behind", [("pending", write_behind.pending())])
+
+registry.register_collector(collect_server_metrics)
+
+@app.get("/traces/recent")
+def get_recent_traces(limit: int = 20):
+    """Span trees of the latest traced requests kept by the in-memory exporter"""
+    return {"traces": tracer.memory.recent(limit)}
+
+@app.get("/scheduler/status")
+def get_scheduler_status():
+    """In-flight provider calls, queue length and per-account usage"""
+    return scheduler.stats()
+
+
+@app.get("/checkpoint-cache/status")
+def get_checkpoint_cache_status():
+    """Hit/miss metrics for the in-process checkpoint cache"""
+    if not hasattr(checkpointer, "stats"):
+        return {"enabled": False}
+    return {"enabled": True, **checkpointer.stats()}
+
+def touch_session(normalized_email: str, session_id: str, session_name: Optional[str] = None) -> bool:
+    """Bump a session's last_activity, renaming it too if given; False if it wasn't found"""
+    if write_behind.enabled and not session_name:
+        # Activity pings are queued and coalesced per session. $max keeps the newest
+        # timestamp even if a rename lands first. Unknown sessions are not reported as missing here.
+        write_behind.add(
+            session_collection,
+            UpdateOne(
+                {"account_id": normalized_email, "sessions.session_id": session_id},
+                {"$max": {"last_activity": datetime.utcnow()}, **version_inc()},
+            ),
+            coalesce_key=("last_activity", normalized_email, session_id),
+            scope=("account_id", normalized_email),
+        )
+        return True
+
     update_fields = {"last_activity": datetime.utcnow()}
     if session_name:
         update_fields["sessions.$.session_name"] = session_name
 
     result = session_collection.update_one(
         {"account_id": normalized_email, "sessions.session_id": session_id},
-        {"$set": update_fields}
+        {"$set": update_fields, **version_inc()}
     )
+    return result.modified_count > 0
 
-    if result.modified_count == 0:
+@app.put("/session/update/{account_id}/{session_id}")
+def update_session(account_id: str, session_id: str, session_name: Optional[str] = None):
+    if not is_valid_email(account_id):
+        raise HTTPException(status_code=400, detail="account_id must be a valid email address")
+    normalized_email = account_id.strip().lower()
+
+    if not touch_session(normalized_email, session_id, session_name):
         raise HTTPException(status_code=404, detail="Session not found")
 
     return {"message": "Session updated"}
@@ -414,14 +630,16 @@ def delete_session(account_id: str, session_id: str):
     if not is_valid_email(account_id):
         raise HTTPException(status_code=400, detail="account_id must be a valid email address")
     normalized_email = account_id.strip().lower()
+    # Matching on the session too, so the version only moves (and modified_count only counts) when it's there
     result = session_collection.update_one(
-        {"account_id": normalized_email},
-        {"$pull": {"sessions": {"session_id": session_id}}}
+        {"account_id": normalized_email, "sessions.session_id": session_id},
+        {"$pull": {"sessions": {"session_id": session_id}}, **version_inc()}
     )
 
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Session not found")
 
+    doc_store.delete_session(session_id)
     return {"message": "Session deleted"}
 
 
@@ -429,6 +647,137 @@ def delete_session(account_id: str, session_id: str):
 
 
 
+# ----------------------
+# Persistent chat channel: one WebSocket per session (see chat_socket.py)
+# ----------------------
+WS_TITLE_MODEL = os.getenv("WS_TITLE_MODEL", "gpt-3.5-turbo")
+
+
+@app.websocket("/ws/{session_id}")
+async def chat_socket(websocket: WebSocket, session_id: str, account_id: Optional[str] = None):
+    """Chat turns in; per-model token streams, title and activity updates out, all over one connection
+
+    The session is checked and its checkpoint loaded once, at connect, rather
+    than on every /chat, /session/update and /generate-title call.
+
+    Client messages: ``turn`` (id, user_query and the other /chat fields, plus
+    ``title`` to have the session titled after it), ``cancel``, ``rename``
+    (name) and ``ping``. Server events: ``ready``, ``token`` (id, model,
+    message_id, text), ``model_done`` (id, model, content), ``turn_done``
+    (id, responses[, winner]), ``turn_cancelled``, ``activity``, ``title``,
+    ``error`` (code, detail) and ``pong``.
+    """
+    await websocket.accept()
+    if account_id is not None:
+        if not is_valid_email(account_id):
+            await websocket.close(code=1008, reason="account_id must be a valid email address")
+            return
+        account = account_id.strip().lower()
+        found = await run_in_threadpool(
+            session_collection.find_one, {"account_id": account, "sessions.session_id": session_id}, {"_id": 1})
+        if not found:
+            await websocket.close(code=4404, reason="Session not found")
+            return
+        session_owners.set(session_id, account)
+    else:
+        account = await run_in_threadpool(session_owner, session_id)
+    # Sessions without a stored owner can chat but have no session record to update
+    known = not account.startswith("session:")
+
+    # Load the checkpoint into the checkpoint cache now rather than on the first turn
+    await run_in_threadpool(workflow.get_state, {"configurable": {"thread_id": session_id}})
+    channel = ChatChannel(websocket)
+    await channel.send({"type": "ready", "session_id": session_id})
+
+    async def on_message(message):
+        kind = message.get("type")
+        if kind == "turn":
+            if not channel.start_turn(message.get("id"), lambda scope: socket_turn(channel, scope, message, account, known)):
+                await channel.send({"type": "error", "id": message.get("id"), "code": "busy", "detail": "A turn is already running"})
+        elif kind == "rename":
+            name = str(message.get("name") or "").strip()
+            if not known or not name:
+                await channel.send({"type": "error", "code": "bad_rename", "detail": "Nothing to rename" if known else "Session not found"})
+            elif await run_in_threadpool(touch_session, account, session_id, name):
+                await channel.send({"type": "title", "title": name})
+        else:
+            await channel.send({"type": "error", "code": "bad_message", "detail": f"Unknown message type: {kind}"})
+
+    await channel.serve(on_message)
+
+
+async def socket_turn(channel: ChatChannel, scope: CancelScope, message: dict, account: str, known: bool):
+    """One turn received on a chat channel: /chat's work, with replies streamed as events"""
+    turn_id = message.get("id")
+    fields = {k: v for k, v in message.items() if k in APIInput.model_fields and k not in ("session_id", "account_id")}
+    try:
+        input = APIInput(**fields, session_id=channel.websocket.path_params["session_id"], account_id=account)
+    except ValidationError as e:
+        await channel.send({"type": "error", "id": turn_id, "code": "bad_turn", "detail": e.errors(include_url=False)})
+        return
+
+    def on_token(model, message_id, text):
+        channel.emit({"type": "token", "id": turn_id, "model": model, "message_id": message_id, "text": text})
+
+    def on_reply(model, reply):
+        channel.emit({"type": "model_done", "id": turn_id, "model": model, "content": reply.content})
+
+    calls = len(input.selected_models) + (1 if uses_web_context(input.role) else 0)
+    with tracer.span("chat", session_id=input.session_id, models=",".join(input.selected_models),
+                     role=input.role, query_chars=len(input.user_query), transport="websocket") as span:
+        try:
+            with tracer.span("admission", weight=calls):
+                ticket = await scheduler.acquire_async(account if known else ANONYMOUS_ACCOUNT, "interactive",
+                                                       calls, estimate_tokens(len(input.user_query), calls))
+        except SchedulerRejected as e:
+            ws_turns.inc(outcome="rejected")
+            await channel.send({"type": "error", "id": turn_id, "code": "rejected", "detail": str(e), "retry_after": e.retry_after})
+            return
+        try:
+            result = await run_in_scope(scope, run_chat, input, ticket, on_token, on_reply)
+        except RequestCancelled as e:
+            span.set_attribute("cancelled", True)
+            ws_turns.inc(outcome="cancelled")
+            await channel.send({"type": "turn_cancelled", "id": turn_id, "detail": str(e)})
+            return
+        except HTTPException as e:
+            ws_turns.inc(outcome="failed")
+            await channel.send({"type": "error", "id": turn_id, "code": "failed", "detail": e.detail})
+            return
+        except Exception as e:
+            logger.error("Chat turn over /ws failed: %s", e)
+            ws_turns.inc(outcome="failed")
+            await channel.send({"type": "error", "id": turn_id, "code": "failed", "detail": str(e)})
+            return
+        finally:
+            scheduler.release(ticket)
+    ws_turns.inc(outcome="completed")
+    await channel.send({"type": "turn_done", "id": turn_id, **result})
+
+    if not known:
+        return
+    await run_in_threadpool(touch_session, account, input.session_id)
+    await channel.send({"type": "activity", "last_activity": datetime.utcnow().isoformat()})
+    if message.get("title"):
+        replies = [{"role": "assistant", "content": text} for text in result["responses"].values()]
+        channel.spawn(socket_title(channel, input.session_id, account, [{"role": "user", "content": input.user_query}] + replies[:1],
+                                   message.get("title_model") or WS_TITLE_MODEL))
+
+
+async def socket_title(channel: ChatChannel, session_id: str, account: str, messages: List[Dict[str, str]], model: str):
+    try:
+        title = await make_title(messages, model, account)
+        await run_in_threadpool(touch_session, account, session_id, title)
+    except HTTPException as e:
+        await channel.send({"type": "error", "code": "title_failed", "detail": e.detail})
+        return
+    except Exception as e:
+        logger.error("Error generating title: %s", e)
+        await channel.send({"type": "error", "code": "title_failed", "detail": str(e)})
+        return
+    await channel.send({"type": "title", "title": title})
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=PORT)
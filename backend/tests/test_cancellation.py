@@ -0,0 +1,87 @@
+"""Key clients' transport: plain requests still work, and a cancelled scope aborts a call in flight"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from api_key_manager import ProviderType
+from cancellation import CancelScope, CancellableTransport, RequestCancelled, cancel_scope
+from constants import key_http_client
+from hedging import HedgedChatModel, hedge_policy
+
+SLOW_SECONDS = 5
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(SLOW_SECONDS)
+        body = b"x" * 100_000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_transport_serves_plain_requests(server_url):
+    with httpx.Client(transport=CancellableTransport()) as client:
+        response = client.get(f"{server_url}/fast")
+        assert response.status_code == 200
+        assert len(response.content) == 100_000
+        with client.stream("GET", f"{server_url}/fast") as streamed:
+            assert sum(len(chunk) for chunk in streamed.iter_bytes()) == 100_000
+
+
+def test_transport_raises_httpx_errors():
+    # The SDKs retry on httpx's exception types, not httpcore's
+    with httpx.Client(transport=CancellableTransport()) as client:
+        with pytest.raises(httpx.ConnectError):
+            client.get("http://127.0.0.1:9/")
+
+
+def test_cancel_aborts_a_key_client_call_in_flight(server_url):
+    client = key_http_client(ProviderType.OPENAI, "test-cancellation")
+    scope = CancelScope("/test")
+    threading.Timer(0.3, scope.cancel).start()
+    started = time.monotonic()
+    with cancel_scope(scope), pytest.raises(RequestCancelled):
+        client.get(f"{server_url}/slow")
+    # Without CancellableBackend on the key clients this waits out the whole response
+    assert time.monotonic() - started < SLOW_SECONDS / 2
+
+
+def test_hedge_aborts_the_losing_call(server_url, monkeypatch):
+    monkeypatch.setattr(hedge_policy, "delay", lambda provider, model: 0.2)
+    monkeypatch.setattr(hedge_policy, "take", lambda provider: True)
+    client = key_http_client(ProviderType.OPENAI, "test-hedge")
+    primary_ended = threading.Event()
+
+    def slow_call(_):
+        try:
+            return client.get(f"{server_url}/slow").status_code
+        finally:
+            primary_ended.set()
+
+    model = HedgedChatModel(ProviderType.OPENAI, "test", RunnableLambda(slow_call),
+                            lambda: RunnableLambda(lambda _: "backup"))
+    parent = CancelScope("/test")
+    with cancel_scope(parent):
+        assert model.invoke("hi") == "backup"
+    # Without its own scope the loser keeps its request open until the response is done
+    assert primary_ended.wait(SLOW_SECONDS / 2)
+    assert not parent.cancelled
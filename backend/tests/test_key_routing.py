@@ -0,0 +1,64 @@
+"""Latency-aware key routing against the fake provider with per-key latency profiles"""
+import random
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api_key_manager import APIKeyManager, ProviderType
+from loadtest.fake_provider import FakeConfig, create_app
+
+FAST_KEYS = ("test-openai-1", "test-openai-2")
+SLOW_KEYS = ("test-openai-3", "test-openai-4")
+PICKS = 120
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    for i, key in enumerate(FAST_KEYS + SLOW_KEYS, start=1):
+        monkeypatch.setenv(f"OPENAI_API_KEY_{i}", key)
+    manager = APIKeyManager()
+    manager.routing = "latency"
+    return manager
+
+
+@pytest.fixture
+def fake():
+    # Same as: fake_provider.py --latency fixed:10 --key-latency openai-3=fixed:150 --key-latency openai-4=fixed:150
+    config = FakeConfig(latency="fixed:10", key_latency={"openai-3": "fixed:150", "openai-4": "fixed:150"})
+    with TestClient(create_app(config)) as client:
+        yield client
+
+
+def call(fake, manager, model="gpt-4o-mini") -> str:
+    """One call the way the factories and ProviderMetricsCallback make it: pick a key, time the call, report it"""
+    api_key, key_id = manager.get_available_key(ProviderType.OPENAI)
+    started = time.perf_counter()
+    response = fake.post("/openai/v1/chat/completions", headers={"Authorization": f"Bearer {api_key}"},
+                         json={"model": model, "messages": [{"role": "user", "content": "hi"}]})
+    manager.record_latency(ProviderType.OPENAI, key_id, model, time.perf_counter() - started,
+                           success=response.status_code == 200)
+    return api_key
+
+
+def test_slow_keys_get_a_minority_of_picks(manager, fake):
+    random.seed(7)
+    picks = [call(fake, manager) for _ in range(PICKS)]
+    slow = sum(1 for key in picks if key in SLOW_KEYS)
+    # Round-robin would send them half the calls; warm-up and exploration are all they should get
+    assert slow < PICKS * 0.25, f"slow keys got {slow} of {PICKS} picks"
+    for key in SLOW_KEYS:
+        assert picks.count(key) < min(picks.count(fast) for fast in FAST_KEYS)
+    assert fake.get("/_stats").json()["openai"]["requests"] == PICKS
+
+
+def test_a_key_that_slows_down_loses_its_share(manager, fake):
+    random.seed(11)
+    fake.app.state.fake.key_latency = {}  # every key fast
+    for _ in range(40):
+        call(fake, manager)
+    fake.app.state.fake.key_latency = {"openai-1": lambda: 0.15}
+    picks = [call(fake, manager) for _ in range(PICKS)]
+    # The moving average has to catch up first; after that, key 1 is only explored
+    late = picks[PICKS // 2:]
+    assert late.count("test-openai-1") < len(late) * 0.1, f"key 1 got {late.count('test-openai-1')} of {len(late)} late picks"
@@ -0,0 +1,176 @@
+"""Crash consistency of write-behind flushes across the checkpoint and writes collections"""
+import pytest
+from pymongo import UpdateOne
+
+from write_behind import BufferedCollection, WriteBehindBuffer
+
+TURNS = 20
+# Each turn: 3 checkpoint upserts, each followed by a put_writes batch of 2
+OPS_PER_TURN = 9
+
+
+class Store:
+    """Shared apply log for several fake collections, failing after a set number of ops"""
+
+    def __init__(self, fail_after_ops: int = -1):
+        self.applied = []  # (collection name, filter key), in the order ops reached "Mongo"
+        self.docs = {}
+        self.fail_after_ops = fail_after_ops
+
+
+class FakeCollection:
+    def __init__(self, name: str, store: Store):
+        self.name = name
+        self.store = store
+
+    def _apply(self, op):
+        store = self.store
+        if store.fail_after_ops == 0:
+            raise ConnectionError("simulated crash")
+        if store.fail_after_ops > 0:
+            store.fail_after_ops -= 1
+        key = (self.name, tuple(sorted(op._filter.items())))
+        store.docs.setdefault(key, {}).update(op._doc.get("$set", {}))
+        store.applied.append(key)
+
+    def update_one(self, filter, update, upsert=False):
+        self._apply(UpdateOne(filter, update, upsert=upsert))
+
+    def bulk_write(self, requests, ordered=True):
+        for op in requests:
+            self._apply(op)
+
+    def find_one(self, filter, *args, **kwargs):
+        return None
+
+
+def simulate_turn(checkpoints, writes, thread_id: str, turn: int):
+    """The writes MongoDBSaver issues for one /chat turn with one model"""
+    for step in range(3):
+        checkpoint_id = f"{turn}-{step}"
+        checkpoints.update_one({"thread_id": thread_id, "checkpoint_id": checkpoint_id},
+                               {"$set": {"checkpoint": f"cp-{checkpoint_id}"}}, upsert=True)
+        writes.bulk_write([
+            UpdateOne({"thread_id": thread_id, "checkpoint_id": checkpoint_id, "idx": i},
+                      {"$set": {"value": f"w-{checkpoint_id}-{i}"}}, upsert=True)
+            for i in range(2)
+        ])
+
+
+def make_buffer() -> WriteBehindBuffer:
+    buffer = WriteBehindBuffer()
+    buffer.enabled = True
+    # Flushed explicitly only
+    buffer.max_batch = buffer.max_pending = 10 ** 9
+    buffer.flush_interval = 10 ** 6
+    return buffer
+
+
+def fill(store: Store, buffer: WriteBehindBuffer):
+    checkpoints = BufferedCollection(FakeCollection("checkpoints", store), buffer)
+    writes = BufferedCollection(FakeCollection("checkpoint_writes", store), buffer)
+    for n in range(TURNS):
+        simulate_turn(checkpoints, writes, "t", n)
+
+
+@pytest.fixture
+def reference() -> Store:
+    store = Store()
+    checkpoints, writes = FakeCollection("checkpoints", store), FakeCollection("checkpoint_writes", store)
+    for n in range(TURNS):
+        simulate_turn(checkpoints, writes, "t", n)
+    return store
+
+
+@pytest.mark.parametrize("fail_after_ops", [0, 1, 2, 3, 4, 5, 17, 100, TURNS * OPS_PER_TURN - 1])
+def test_failed_flush_leaves_ordered_prefix(reference, fail_after_ops):
+    store = Store(fail_after_ops)
+    buffer = make_buffer()
+    fill(store, buffer)
+
+    assert buffer.flush() is False
+    assert store.applied == reference.applied[:fail_after_ops]
+    # The failed op and everything after it, in both collections, is still queued
+    assert buffer.pending() >= len(reference.applied) - fail_after_ops
+
+
+def test_no_put_writes_land_without_their_checkpoint(reference):
+    # Fails on the first op of turn 5's first put_writes batch: its checkpoint is in, nothing later is
+    fail_at = 5 * OPS_PER_TURN + 1
+    store = Store(fail_at)
+    buffer = make_buffer()
+    fill(store, buffer)
+
+    assert buffer.flush() is False
+    checkpoints = {dict(key)["checkpoint_id"] for name, key in store.applied if name == "checkpoints"}
+    writes = {dict(key)["checkpoint_id"] for name, key in store.applied if name == "checkpoint_writes"}
+    assert writes <= checkpoints
+    assert max(checkpoints, key=lambda c: tuple(map(int, c.split("-")))) == "5-0"
+    assert "5-0" not in writes
+
+
+def test_retry_after_failure_converges(reference):
+    store = Store(40)
+    buffer = make_buffer()
+    fill(store, buffer)
+    assert buffer.flush() is False
+
+    store.fail_after_ops = -1
+    assert buffer.flush() is True
+    assert buffer.pending() == 0
+    assert store.docs == reference.docs
+    # Re-applied ops repeat a suffix of the log, never jump ahead of it
+    assert store.applied[:40] == reference.applied[:40]
+
+
+def test_repeated_failures_keep_the_prefix(reference):
+    store = Store()
+    buffer = make_buffer()
+    fill(store, buffer)
+    for budget in (7, 3, 11, 0, 25):
+        store.fail_after_ops = budget
+        assert buffer.flush() is False
+        applied = list(dict.fromkeys(store.applied))
+        assert applied == reference.applied[:len(applied)]
+    store.fail_after_ops = -1
+    assert buffer.flush() is True
+    assert store.docs == reference.docs
+
+
+def test_read_flushes_only_its_own_thread():
+    store = Store()
+    buffer = make_buffer()
+    checkpoints = BufferedCollection(FakeCollection("checkpoints", store), buffer)
+    writes = BufferedCollection(FakeCollection("checkpoint_writes", store), buffer)
+    simulate_turn(checkpoints, writes, "a", 0)
+    simulate_turn(checkpoints, writes, "b", 0)
+
+    checkpoints.find_one({"thread_id": "a", "checkpoint_ns": ""})
+    assert {dict(key)["thread_id"] for _, key in store.applied} == {"a"}
+    assert len(store.applied) == OPS_PER_TURN
+    assert buffer.pending() == OPS_PER_TURN
+
+    # A read that doesn't name a thread still sees everything
+    checkpoints.find_one({})
+    assert buffer.pending() == 0
+
+
+def test_scoped_flush_keeps_the_threads_order():
+    store = Store(4)
+    buffer = make_buffer()
+    checkpoints = BufferedCollection(FakeCollection("checkpoints", store), buffer)
+    writes = BufferedCollection(FakeCollection("checkpoint_writes", store), buffer)
+    for n in range(3):
+        simulate_turn(checkpoints, writes, "a", n)
+        simulate_turn(checkpoints, writes, "b", n)
+
+    assert buffer.flush(("thread_id", "b")) is False
+    store.fail_after_ops = -1
+    assert buffer.flush(("thread_id", "b")) is True
+    applied = list(dict.fromkeys(store.applied))
+    reference = Store()
+    ref_checkpoints, ref_writes = FakeCollection("checkpoints", reference), FakeCollection("checkpoint_writes", reference)
+    for n in range(3):
+        simulate_turn(ref_checkpoints, ref_writes, "b", n)
+    assert applied == reference.applied
+    assert buffer.pending() == 3 * OPS_PER_TURN
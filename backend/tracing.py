@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import random
+import secrets
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+
+from metrics import token_usage
+
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.sdk.trace import TracerProvider as _OtelSdkProvider  # noqa: F401 - only to detect the SDK
+except ImportError:  # the OpenTelemetry SDK is optional; without it spans stay in-process
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation; field names follow OTLP so exported JSON loads into OTel tooling"""
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.children: List["Span"] = []
+        self.status = "OK"
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self._start = time.perf_counter()
+        self.duration = 0.0
+        self.sampled = parent.sampled if parent else random.random() < tracer.sample_ratio
+        if parent:
+            with tracer._lock:
+                parent.children.append(self)
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, exc: BaseException):
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(exc).__name__
+        self.attributes["exception.message"] = str(exc)[:500]
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+        if self.parent is None:
+            self.tracer._export(self)
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent else "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": "STATUS_CODE_ERROR" if self.status == "ERROR" else "STATUS_CODE_OK"},
+        }
+
+
+class _NoopSpan:
+    """Stand-in when tracing is disabled, so call sites need no checks"""
+    name = ""
+    duration = 0.0
+    children: List[Span] = []
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+    def end(self):
+        pass
+
+    def walk(self):
+        return iter(())
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class InMemoryExporter:
+    """Keeps the most recent traces for GET /traces/recent"""
+
+    def __init__(self, max_traces: int):
+        self.traces: deque = deque(maxlen=max_traces)
+
+    def export(self, root: Span):
+        self.traces.append(root)
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        roots = list(self.traces)[-limit:]
+        return [
+            {"trace_id": r.trace_id, "name": r.name, "duration_ms": round(r.duration * 1000, 2),
+             "spans": [s.to_otlp() for s in r.walk()]}
+            for r in reversed(roots)
+        ]
+
+
+class ConsoleExporter:
+    """One OTLP-shaped JSON line per span on the tracing logger"""
+
+    def export(self, root: Span):
+        for span in root.walk():
+            logger.info(json.dumps(span.to_otlp()))
+
+
+class OtelExporter:
+    """Replays finished span trees into the globally configured OpenTelemetry SDK tracer"""
+
+    def __init__(self):
+        self.tracer = otel_trace.get_tracer("all-ai")
+
+    def export(self, root: Span):
+        def replay(span: Span, parent_ctx):
+            otel_span = self.tracer.start_span(span.name, context=parent_ctx, start_time=span.start_ns)
+            otel_span.set_attributes(span.attributes)
+            if span.status == "ERROR":
+                otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+            ctx = otel_trace.set_span_in_context(otel_span)
+            for child in list(span.children):
+                replay(child, ctx)
+            otel_span.end(end_time=span.end_ns)
+        replay(root, None)
+
+
+class Tracer:
+    """Span trees per request, propagated through contextvars (and so into LangGraph's worker threads)"""
+
+    def __init__(self):
+        self.enabled = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.sample_ratio = float(os.getenv("TRACING_SAMPLE_RATIO", "1.0"))
+        self._lock = threading.Lock()
+        self.memory = InMemoryExporter(int(os.getenv("TRACING_MEMORY_TRACES", "100")))
+        self.exporters = []
+        for name in os.getenv("TRACING_EXPORTERS", "memory").split(","):
+            name = name.strip().lower()
+            if name == "memory":
+                self.exporters.append(self.memory)
+            elif name == "console":
+                self.exporters.append(ConsoleExporter())
+            elif name == "otel":
+                if otel_trace is None:
+                    logger.warning("TRACING_EXPORTERS includes otel but opentelemetry-sdk is not installed")
+                else:
+                    self.exporters.append(OtelExporter())
+
+    def current(self) -> Optional[Span]:
+        return _current.get()
+
+    def start_span(self, name: str, parent: Optional[Span] = None, child_only: bool = False, **attributes):
+        """A span that is not made current; the caller must end() it
+
+        With ``child_only`` nothing is recorded outside a traced request, which
+        keeps background work (history reads, workers) from flooding the exporters.
+        """
+        parent = parent if parent is not None else _current.get()
+        if not self.enabled or (child_only and parent is None):
+            return NOOP_SPAN
+        return Span(self, name, parent, attributes)
+
+    @contextmanager
+    def span(self, name: str, child_only: bool = False, **attributes):
+        span = self.start_span(name, child_only=child_only, **attributes)
+        token = _current.set(span) if span is not NOOP_SPAN else None
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            if token is not None:
+                _current.reset(token)
+            span.end()
+
+    def _export(self, root: Span):
+        if not root.sampled:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(root)
+            except Exception as e:
+                logger.warning(f"Span export via {type(exporter).__name__} failed: {e}")
+
+
+def server_timing(root) -> str:
+    """Server-Timing header value: total, then time per span name summed over the tree"""
+    totals: Dict[str, float] = {}
+    for span in root.walk():
+        if span is not root:
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration
+    parts = [f"total;dur={root.duration * 1000:.1f}"]
+    parts.extend(f"{name.replace(' ', '_')};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+    return ", ".join(parts)
+
+
+def message_stats(messages: Sequence[Any]) -> Tuple[int, int]:
+    """(count, characters) of a message list, for span attributes"""
+    chars = 0
+    for msg in messages:
+        content = getattr(msg, "content", msg)
+        chars += len(content) if isinstance(content, str) else len(str(content))
+    return len(messages), chars
+
+
+def traced_node(name: str, fn):
+    """Wrap a graph node so each run gets a span with the model and message sizes"""
+    @wraps(fn)
+    def wrapper(state):
+        model = (state.get("selected_models") or {}).get(name)
+        count, chars = message_stats(state.get(f"{name.lower()}_messages") or [])
+        with tracer.span(f"node.{name}", child_only=True, model=model, input_messages=count, input_chars=chars) as span:
+            result = fn(state)
+            reply = (result or {}).get(f"{name.lower()}_messages")
+            if reply is not None:
+                span.set_attribute("output_chars", message_stats([reply])[1])
+            return result
+    return wrapper
+
+
+class ProviderTracingCallback(BaseCallbackHandler):
+    """A child span for every provider call, with key id and token counts"""
+
+    def __init__(self, provider, key_id: str, model: str):
+        self.provider = provider
+        self.key_id = key_id
+        self.model = model
+        self._spans: Dict[UUID, Any] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        count, chars = message_stats(messages[0] if messages else [])
+        self._spans[run_id] = tracer.start_span(
+            f"llm.{self.provider.value}", child_only=True, model=self.model, key_id=self.key_id, input_messages=count, input_chars=chars,
+        )
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            input_tokens, output_tokens = token_usage(response)
+            span.set_attributes(input_tokens=input_tokens, output_tokens=output_tokens)
+            span.end()
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.record_exception(error)
+            span.end()
+
+
+class TracedCheckpointSaver(BaseCheckpointSaver):
+    """Adds checkpoint.get / checkpoint.put spans around another saver"""
+
+    def __init__(self, saver: BaseCheckpointSaver):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+
+    def __getattr__(self, name):
+        # stats(), invalidate() and the like on the wrapped saver
+        if name == "saver":
+            raise AttributeError(name)
+        return getattr(self.saver, name)
+
+    @property
+    def config_specs(self) -> list:
+        return self.saver.config_specs
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with tracer.span("checkpoint.get", child_only=True) as span:
+            tup = self.saver.get_tuple(config)
+            span.set_attribute("found", tup is not None)
+            return tup
+
+    def list(self, config, *, filter=None, before=None, limit=None) -> Iterator[CheckpointTuple]:
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        with tracer.span("checkpoint.put", child_only=True, step=metadata.get("step")):
+            return self.saver.put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config: RunnableConfig, writes, task_id: str, task_path: str = "") -> None:
+        with tracer.span("checkpoint.put_writes", child_only=True, writes=len(writes)):
+            self.saver.put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.saver.delete_thread(thread_id)
+
+    def get_next_version(self, current, channel) -> Any:
+        return self.saver.get_next_version(current, channel)
+
+
+# Global instance
+tracer = Tracer()
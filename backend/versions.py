@@ -0,0 +1,64 @@
+import os
+from typing import Callable, Dict, Optional
+
+from fastapi import Request, Response
+
+ETAG_ENABLED = os.getenv("ETAG_ENABLED", "true").lower() in ("1", "true", "yes")
+# Browsers keep the response but revalidate it (If-None-Match) before every reuse
+CACHE_CONTROL = "private, no-cache"
+
+# Counter in each sessionManagement document, incremented by every write to it
+VERSION_FIELD = "version"
+
+
+def version_inc() -> Dict[str, Dict[str, int]]:
+    """The update fragment that goes with every write to an account's session document"""
+    return {"$inc": {VERSION_FIELD: 1}}
+
+
+def make_etag(kind: str, version) -> Optional[str]:
+    """Weak, since the same version goes out under different Content-Encodings; None when disabled"""
+    if not ETAG_ENABLED or version is None:
+        return None
+    return f'W/"{kind}-{version}"'
+
+
+def account_etag(collection, account_id: str) -> Optional[str]:
+    """From the account document's version counter, so writes by any worker change it; None if there's no account"""
+    if not ETAG_ENABLED:
+        return None
+    doc = collection.find_one({"account_id": account_id}, {VERSION_FIELD: 1, "_id": 0})
+    return make_etag("account", doc.get(VERSION_FIELD, 0)) if doc is not None else None
+
+
+def thread_etag(latest_id: Callable[[str, str], Optional[str]], thread_id: str) -> Optional[str]:
+    """From the thread's newest checkpoint id, which every turn replaces ("0" while it has none)"""
+    if not ETAG_ENABLED:
+        return None
+    return make_etag("thread", latest_id(thread_id, "") or "0")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison: W/ prefixes don't matter"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def cache_headers(etag: Optional[str]) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL} if etag else {}
+
+
+def not_modified(request: Request, etag: Optional[str]) -> Optional[Response]:
+    """A 304 when the request's If-None-Match already has ``etag``, else None
+
+    Take the etag before reading the data it covers: a write landing in
+    between then leaves a stale ETag on fresh data (one extra read later),
+    never the reverse.
+    """
+    if etag and etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    return None
@@ -0,0 +1,233 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Buffers MongoDB writes in memory and flushes them in bulk on a size or time trigger
+
+    Every buffered operation must be an idempotent upsert/update (``$set``,
+    ``$setOnInsert``, ``$max``) so a failed batch can simply be re-applied.
+    Writes carry an optional scope (a thread or an account) and are flushed in
+    enqueue order within it, stopping at the first failed bulk write, so after
+    a crash the database always holds a prefix of each scope's queued writes;
+    anything still in memory at that point is lost, which is the trade-off this
+    mode makes for not waiting on Mongo in the request path. A read flushes
+    only its own scope. Only consecutive writes to the same collection share a
+    round trip, so writes that alternate between collections batch poorly.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+        self.max_batch = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200"))
+        self.flush_interval = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "500")) / 1000
+        self.max_pending = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one full flush at a time keeps batches in order
+        self._pending: List[Tuple[Any, Any, Hashable, Hashable]] = []  # (collection, operation, scope, coalesce key)
+        self._coalesced: Dict[Hashable, int] = {}  # coalesce key -> index in _pending
+        self._inflight: Set[Hashable] = set()  # scopes with a batch being written right now
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.stats = {"queued": 0, "coalesced": 0, "flushed": 0, "batches": 0, "errors": 0}
+
+    def add(self, collection, operation, coalesce_key: Optional[Hashable] = None, scope: Optional[Hashable] = None):
+        """Queue a single write, replacing an earlier queued write with the same coalesce key"""
+        self.add_many(collection, [operation], coalesce_key, scope)
+
+    def add_many(self, collection, operations: List[Any], coalesce_key: Optional[Hashable] = None,
+                 scope: Optional[Hashable] = None):
+        """Queue a group of writes for one collection, under ``scope`` if given"""
+        if self._closed:
+            # After shutdown there is no flusher left, so write straight through
+            if operations:
+                collection.bulk_write(list(operations), ordered=True)
+            return
+
+        with self._cond:
+            if coalesce_key is not None and coalesce_key in self._coalesced:
+                # Later write wins; keep the original slot so ordering is unchanged
+                self._pending[self._coalesced[coalesce_key]] = (collection, operations[-1], scope, coalesce_key)
+                self.stats["coalesced"] += 1
+            else:
+                if coalesce_key is not None:
+                    self._coalesced[coalesce_key] = len(self._pending) + len(operations) - 1
+                self._pending.extend((collection, op, scope, None) for op in operations[:-1])
+                if operations:
+                    self._pending.append((collection, operations[-1], scope, coalesce_key))
+            self.stats["queued"] += len(operations)
+            pending = len(self._pending)
+            if pending >= self.max_batch:
+                self._cond.notify()
+        self._ensure_thread()
+
+        # Back-pressure: never let the buffer grow without bound if Mongo falls behind
+        if pending >= self.max_pending:
+            self.flush()
+
+    def pending(self) -> int:
+        """Number of writes waiting to be flushed"""
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self, scope: Optional[Hashable] = None) -> bool:
+        """Write buffered operations to MongoDB in bulk; False if any batch failed
+
+        With a ``scope``, only the writes queued under it are written, so a read
+        of one thread or account doesn't wait on everyone else's.
+        """
+        if scope is not None:
+            return self._flush(scope)
+        with self._flush_lock:
+            return self._flush(None)
+
+    def _flush(self, scope: Optional[Hashable]) -> bool:
+        with self._cond:
+            # Unscoped writes could touch anything, so a scoped flush takes them too
+            wanted = None if scope is None else {scope, None}
+            if wanted is not None:
+                # Its earlier writes may be in a batch being written right now; they land first
+                while wanted & self._inflight:
+                    self._cond.wait()
+            batch, rest = [], []
+            for entry in self._pending:
+                if entry[2] in self._inflight or (wanted is not None and entry[2] not in wanted):
+                    rest.append(entry)
+                else:
+                    batch.append(entry)
+            if not batch:
+                return True
+            self._pending = rest
+            self._reindex()
+            scopes = {entry[2] for entry in batch}
+            self._inflight |= scopes
+        try:
+            return self._write(batch)
+        finally:
+            with self._cond:
+                self._inflight -= scopes
+                self._cond.notify_all()
+
+    def _write(self, batch: List[Tuple[Any, Any, Hashable, Hashable]]) -> bool:
+        # Consecutive ops for the same collection go out as one bulk write, in enqueue order
+        runs: List[Tuple[Any, List[Any]]] = []
+        for n, (collection, op, _, _) in enumerate(batch):
+            if runs and runs[-1][0] is collection:
+                runs[-1][1].append(n)
+            else:
+                runs.append((collection, [n]))
+
+        for collection, indexes in runs:
+            ops = [batch[n][1] for n in indexes]
+            try:
+                collection.bulk_write(ops, ordered=True)
+                self.stats["flushed"] += len(ops)
+                self.stats["batches"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Write-behind flush of {len(ops)} ops failed, will retry: {e}")
+                # Stop here so later writes never land before this one; ops are idempotent,
+                # so the failed run is re-queued whole, ahead of everything after it
+                with self._cond:
+                    self._pending = batch[indexes[0]:] + self._pending
+                    self._reindex()
+                return False
+        return True
+
+    def _reindex(self):
+        self._coalesced = {entry[3]: n for n, entry in enumerate(self._pending) if entry[3] is not None}
+
+    def close(self):
+        """Stop the background flusher and write out everything still buffered"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=max(self.flush_interval * 4, 5))
+        self.flush()
+        if self.pending():
+            logger.error(f"Write-behind shutdown left {self.pending()} unflushed writes")
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                closed = self._closed
+            ok = self.flush()
+            if closed:
+                return
+            if not ok:
+                # Mongo is unhappy; don't spin on a failing batch
+                time.sleep(self.flush_interval)
+
+
+class BufferedCollection:
+    """Collection proxy that routes upserts through a WriteBehindBuffer
+
+    Only the write shapes used by the checkpointer (``update_one(..., upsert=True)``
+    and ``bulk_write``) are buffered, scoped by the ``scope_field`` of their
+    filter (the thread). A read whose filter names a scope flushes just that
+    scope's writes first, any other access flushes the whole buffer, so reads
+    always observe every write queued before them for what they read.
+    """
+
+    def __init__(self, collection, buffer: WriteBehindBuffer, scope_field: str = "thread_id"):
+        self._collection = collection
+        self._buffer = buffer
+        self._scope_field = scope_field
+
+    def _scope(self, filter) -> Optional[Hashable]:
+        value = filter.get(self._scope_field) if isinstance(filter, dict) else None
+        return (self._scope_field, value) if isinstance(value, str) else None
+
+    def update_one(self, filter, update, upsert: bool = False, **kwargs):
+        if not upsert or kwargs:
+            self._buffer.flush(self._scope(filter))
+            return self._collection.update_one(filter, update, upsert=upsert, **kwargs)
+        self._buffer.add(self._collection, UpdateOne(filter, update, upsert=True), scope=self._scope(filter))
+
+    def bulk_write(self, requests, ordered: bool = True, **kwargs):
+        requests = list(requests)
+        # pymongo keeps an operation's filter in _filter; a batch spanning scopes goes under none
+        scopes = {self._scope(getattr(op, "_filter", None)) for op in requests}
+        scope = scopes.pop() if len(scopes) == 1 else None
+        if not ordered or kwargs:
+            self._buffer.flush(scope)
+            return self._collection.bulk_write(requests, ordered=ordered, **kwargs)
+        self._buffer.add_many(self._collection, requests, scope=scope)
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._buffer.flush(self._scope(args[0] if args else kwargs.get("filter")))
+            return attr(*args, **kwargs)
+        return call
+
+
+# Global instance
+write_behind = WriteBehindBuffer()
+atexit.register(write_behind.close)
@@ -560,7 +560,7 @@ function App() {
         });
         
         // Generate title using LLM
-        const title = await generateTitleFromMessages(allMessages, token);
+        const title = await generateTitleFromMessages(allMessages, token, accountId, sessionIdToUse);
         if (title && title !== 'New Chat') {
           await updateConversationTitle(sessionIdToUse, title);
         }
@@ -724,6 +724,7 @@ function App() {
           session_id: sessionIdToUse,
           client_time: toLocalIsoWithOffset(timestamp),
           role: activeRole,
+          account_id: accountId || undefined,
         })
       })
 
@@ -902,7 +903,8 @@ function App() {
         const form = new FormData()
         form.append('file', f)
         // prompt left empty; we only want extraction now
-        const res = await fetch(chatUrl('/preprocess'), {
+        // With a session id, PDFs are indexed server-side and retrieved per turn instead of pasted
+        const res = await fetch(chatUrl(`/preprocess?session_id=${encodeURIComponent(sessionIdToUse!)}`), {
           method: 'POST',
           headers: {
             accept: 'application/json',
@@ -912,7 +914,7 @@ function App() {
         })
         if (!res.ok) throw new Error(await res.text())
         const data = await res.json().catch(() => ({} as any))
-        const extracted = (data?.extracted_text || '').toString()
+        const extracted = data?.indexed ? '' : (data?.extracted_text || '').toString()
 
         setPendingUploads(prev => ({
           ...prev,
@@ -34,7 +34,7 @@ export const setChatUrlFunction = (fn: (path: string) => string) => {
   chatUrlFunction = fn;
 };
 
-export const generateTitleFromMessages = async (messages: { role: string; content: string }[], token?: string): Promise<string> => {
+export const generateTitleFromMessages = async (messages: { role: string; content: string }[], token?: string, accountId?: string, sessionId?: string): Promise<string> => {
   if (!messages || messages.length === 0) {
     return 'New Chat';
   }
@@ -57,7 +57,9 @@ export const generateTitleFromMessages = async (messages: { role: string; conten
           role: m.role,
           content: m.content
         })),
-        model: 'gpt-3.5-turbo' // Default model, can be customized
+        model: 'gpt-3.5-turbo', // Default model, can be customized
+        account_id: accountId || undefined,
+        session_id: sessionId || undefined,
       })
     });
 